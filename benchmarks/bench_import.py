@@ -0,0 +1,76 @@
+""" Import-time benchmark of snuo1mpy.
+
+Each statement is run in fresh interpreters and the fastest import time is
+reported. It fails (exit status 1) if
+
+  * a light statement imports any of the heavy packages (astropy, pandas,
+    scipy, ysfitsutilpy), or
+  * an import is slower than its budget.
+
+Usage::
+
+    python benchmarks/bench_import.py [--repeat 5] [--scale 1.0]
+
+``--scale`` multiplies all the budgets (e.g., for slow CI machines).
+"""
+import argparse
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+
+HEAVY = ["astropy", "pandas", "scipy", "ysfitsutilpy"]
+
+# statement, budget (ms), whether heavy packages are allowed
+CASES = [("import snuo1mpy", 150, False),
+         ("from snuo1mpy import cards_gain_rdnoise", 150, False),
+         ("from snuo1mpy.utils import reset_dir", 150, False),
+         ("from snuo1mpy import Preprocessor", 1500, True)]
+
+CHILD = """
+import json, sys, time
+t0 = time.perf_counter()
+{stmt}
+dt = time.perf_counter() - t0
+heavy = sorted(m for m in {heavy!r} if m in sys.modules)
+print(json.dumps(dict(ms=dt*1000, heavy=heavy)))
+"""
+
+
+def run_case(stmt, repeat):
+    best = None
+    for _ in range(repeat):
+        code = CHILD.format(stmt=stmt, heavy=HEAVY)
+        out = subprocess.run([sys.executable, "-c", code], cwd=str(ROOT),
+                             stdout=subprocess.PIPE, check=True)
+        res = json.loads(out.stdout.decode().strip().splitlines()[-1])
+        if best is None or res["ms"] < best["ms"]:
+            best = res
+    return best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--scale", type=float, default=1.)
+    args = parser.parse_args(argv)
+
+    failed = False
+    for stmt, budget, heavy_ok in CASES:
+        res = run_case(stmt, args.repeat)
+        budget = budget*args.scale
+        problems = []
+        if res["ms"] > budget:
+            problems.append(f"slower than {budget:.0f} ms")
+        if res["heavy"] and not heavy_ok:
+            problems.append(f"imports {', '.join(res['heavy'])}")
+        failed |= bool(problems)
+        status = "FAIL: " + "; ".join(problems) if problems else "ok"
+        print(f"{stmt:<45s} {res['ms']:8.1f} ms  {status}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
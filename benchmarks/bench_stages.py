@@ -0,0 +1,135 @@
+""" Stage benchmark of `~snuo1mpy.Preprocessor` on synthetic nights.
+
+For each night size and binning, a synthetic raw night is written (see
+``synthetic.py``) and the stages are run in turn, each in a fresh
+interpreter through ``snuo1m`` (`snuo1mpy.cli`), so that the numbers of a
+stage are not mixed with the others. For each stage it reports
+
+  * the wall time, frames/s and MB/s of the ``snuo1m`` report,
+  * the peak RSS (``resource.getrusage``) of the stage process and of its
+    largest worker process,
+  * the bytes read and written (``/proc/self/io`` on Linux, including the
+    finished worker processes): ``rchar``/``wchar`` are all the bytes
+    through read/write calls, ``read_bytes``/``write_bytes`` those which
+    actually hit the storage.
+
+The results are printed as a table and, with ``--output``, appended as
+JSON lines.
+
+Usage::
+
+    python benchmarks/bench_stages.py [--size tiny small] [--binning 1 2]
+        [--jobs 1] [--stages organize bias dark flat preproc]
+        [--workdir DIR] [--keep] [--output bench.jsonl]
+"""
+import argparse
+import json
+import shutil
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+from synthetic import NIGHTS, make_night
+
+ROOT = Path(__file__).resolve().parents[1]
+
+STAGES = ["organize", "bias", "dark", "flat", "preproc"]
+
+CHILD = """
+import json, resource, sys
+from snuo1mpy.cli import main
+main({argv!r})
+io = {{}}
+try:
+    with open("/proc/self/io") as ff:
+        io = {{k: int(v) for k, v in (line.split(":") for line in ff)}}
+except OSError:  # not Linux
+    pass
+# ru_maxrss is in kB on Linux (bytes on macOS).
+unit = 1 if sys.platform == "darwin" else 1024
+self_ = resource.getrusage(resource.RUSAGE_SELF)
+child = resource.getrusage(resource.RUSAGE_CHILDREN)
+print(json.dumps(dict(rss_peak=self_.ru_maxrss*unit,
+                      rss_peak_worker=child.ru_maxrss*unit,
+                      cpu_user=self_.ru_utime + child.ru_utime,
+                      cpu_sys=self_.ru_stime + child.ru_stime,
+                      rchar=io.get("rchar"), wchar=io.get("wchar"),
+                      read_bytes=io.get("read_bytes"),
+                      write_bytes=io.get("write_bytes"))))
+"""
+
+
+def run_stage(stage, topdir, jobs, memory_limit=None):
+    report = topdir / "snuo1m.jsonl"
+    argv = [stage, str(topdir), "--jobs", str(jobs),
+            "--report", str(report)]
+    if memory_limit is not None:
+        argv += ["--memory-limit", memory_limit]
+    out = subprocess.run([sys.executable, "-c", CHILD.format(argv=argv)],
+                         cwd=str(ROOT), stdout=subprocess.PIPE, check=True)
+    res = json.loads(out.stdout.decode().strip().splitlines()[-1])
+    with open(report) as ff:
+        res.update(json.loads(ff.read().strip().splitlines()[-1]))
+    return res
+
+
+def _mb(nbytes):
+    return float("nan") if nbytes is None else nbytes/1.e6
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", nargs="+", default=["tiny", "small"],
+                        choices=list(NIGHTS))
+    parser.add_argument("--binning", nargs="+", type=int, default=[1, 2])
+    parser.add_argument("--jobs", type=int, default=1)
+    parser.add_argument("--memory-limit", default=None)
+    parser.add_argument("--stages", nargs="+", default=STAGES)
+    parser.add_argument("--workdir", type=Path, default=None,
+                        help="Where the nights are made (default: a "
+                             + "temporary directory).")
+    parser.add_argument("--keep", action="store_true",
+                        help="Do not remove the nights after the run.")
+    parser.add_argument("--output", type=Path, default=None)
+    args = parser.parse_args(argv)
+
+    workdir = args.workdir
+    if workdir is None:
+        workdir = Path(tempfile.mkdtemp(prefix="snuo1m_bench_"))
+
+    print(f"{'size':<7s}{'bin':>4s} {'stage':<10s}{'frames':>7s}"
+          + f"{'wall [s]':>10s}{'frames/s':>10s}{'MB/s':>8s}"
+          + f"{'RSS [MB]':>10s}{'read [MB]':>11s}{'write [MB]':>11s}")
+    try:
+        for size in args.size:
+            for binning in args.binning:
+                topdir = workdir / f"{size}_bin{binning}"
+                if topdir.exists():
+                    shutil.rmtree(topdir)
+                make_night(topdir / "rawdata", binning=binning,
+                           **NIGHTS[size])
+                for stage in args.stages:
+                    res = run_stage(stage, topdir, args.jobs,
+                                    args.memory_limit)
+                    res.update(size=size, binning=binning)
+                    rss = max(res["rss_peak"], res["rss_peak_worker"])
+                    print(f"{size:<7s}{binning:>4d} {stage:<10s}"
+                          + f"{res['n_input']:>7d}{res['duration']:>10.2f}"
+                          + f"{res['frames_per_s']:>10.2f}"
+                          + f"{res['mb_per_s']:>8.1f}{rss/1.e6:>10.1f}"
+                          + f"{_mb(res['rchar']):>11.1f}"
+                          + f"{_mb(res['wchar']):>11.1f}")
+                    if args.output is not None:
+                        with open(args.output, 'a') as ff:
+                            ff.write(json.dumps(res) + "\n")
+                if not args.keep:
+                    shutil.rmtree(topdir)
+    finally:
+        if args.workdir is None and not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
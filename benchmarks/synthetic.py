@@ -0,0 +1,180 @@
+""" Synthetic raw nights of the SNUO 1-m (STX16803) for the benchmarks.
+
+The frames are uint16 FITS with the headers MaxIm DL writes (the
+`~snuo1mpy.utils.USEFUL_KEYS`, site and binning keywords) and the file
+names ``organize_raw`` parses::
+
+    cali-0001bias.fit     bias
+    cali-0004dk60.fit     dark (EXPTIME 60 s)
+    skyflat-0010V.fit     sky flat
+    M51-0016V.fit         science frame
+
+Usage::
+
+    python benchmarks/synthetic.py <rawdir> [--size small] [--binning 1]
+"""
+import argparse
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import numpy as np
+from astropy.io import fits
+
+SHAPE = (4096, 4096)  # unbinned STX16803
+GAIN = 1.36  # e/ADU
+RDNOISE = 9.0  # e
+
+# The number of frames: bias, dark (per EXPTIME), flat (per filter) and
+# science frames.
+NIGHTS = dict(tiny=dict(n_bias=3, n_dark=3, n_flat=3, n_science=4),
+              small=dict(n_bias=5, n_dark=5, n_flat=5, n_science=10),
+              medium=dict(n_bias=10, n_dark=10, n_flat=7, n_science=40),
+              large=dict(n_bias=20, n_dark=15, n_flat=9, n_science=120))
+
+SITE = dict(SITELAT="+37 27 25.00", SITELONG="126 57 12.00", HEIGHT=147.)
+TARGET = dict(OBJCTRA="13 29 52.70", OBJCTDEC="+47 11 43.0",
+              OBJCTALT="65.1234")
+
+
+class _Sky():
+    ''' The fixed patterns of a night: bias, dark current and flat.
+    '''
+    def __init__(self, shape, rng):
+        ny, nx = shape
+        self.shape = shape
+        self.rng = rng
+        self.bias = (1000 + rng.normal(0, 2, nx)[None, :]
+                     + np.zeros(shape)).astype(np.float32)
+        self.dark = np.full(shape, 0.02, dtype=np.float32)  # ADU/s
+        hot = rng.integers(0, ny*nx, ny*nx//10000)
+        self.dark.flat[hot] = rng.uniform(1, 50, hot.size)
+        yy, xx = np.ogrid[-1:1:ny*1j, -1:1:nx*1j]
+        self.flat = (1 - 0.08*(xx**2 + yy**2)).astype(np.float32)
+        self.flat *= rng.normal(1, 0.005, shape).astype(np.float32)
+        self.flat /= np.median(self.flat)
+
+    def frame(self, exptime=0., level=0., nstar=0):
+        ''' bias + dark + level*flat (+ stars) with the noise, in ADU.
+        '''
+        sig = self.dark*exptime
+        if level:
+            sig = sig + level*self.flat
+        if nstar:
+            sig = sig + self.flat*self.stars(nstar)
+        noise = self.rng.standard_normal(self.shape, dtype=np.float32)
+        noise *= np.sqrt(RDNOISE**2 + GAIN*np.clip(sig, 0, None))/GAIN
+        return np.clip(self.bias + sig + noise, 0, 65535)
+
+    def stars(self, nstar, fwhm=4., box=15):
+        img = np.zeros(self.shape, dtype=np.float32)
+        ny, nx = self.shape
+        rr = box//2
+        dy, dx = np.mgrid[-rr:rr + 1, -rr:rr + 1]
+        sig2 = 2*(fwhm/2.3548)**2
+        for _ in range(nstar):
+            x0 = self.rng.uniform(rr, nx - rr - 1)
+            y0 = self.rng.uniform(rr, ny - rr - 1)
+            ix, iy = int(x0), int(y0)
+            amp = 10**self.rng.uniform(2, 4.3)
+            img[iy - rr:iy + rr + 1, ix - rr:ix + rr + 1] += amp*np.exp(
+                -((dx + ix - x0)**2 + (dy + iy - y0)**2)/sig2)
+        return img
+
+
+def _header(imagetyp, obj, exptime, filt, dateobs, binning, ccdtemp):
+    hdr = fits.Header()
+    hdr["EXPTIME"] = (exptime, "Exposure time in seconds")
+    hdr["EXPOSURE"] = (exptime, "Exposure time in seconds")
+    hdr["SET-TEMP"] = (-25.0, "CCD temperature setpoint in C")
+    hdr["CCD-TEMP"] = (ccdtemp, "CCD temperature at start of exposure in C")
+    hdr["XBINNING"] = (binning, "Binning factor in width")
+    hdr["YBINNING"] = (binning, "Binning factor in height")
+    hdr["IMAGETYP"] = (imagetyp, "Type of image")
+    hdr["DATE-OBS"] = (dateobs, "YYYY-MM-DDThh:mm:ss observation start, UT")
+    hdr["INSTRUME"] = ("SBIG STX-16803 3 CCD Camera", "instrument or camera")
+    hdr["FILTER"] = (filt, "Filter used when taking image")
+    hdr["OBJECT"] = obj
+    for key, val in SITE.items():
+        hdr[key] = val
+    if imagetyp == "Light Frame":
+        for key, val in TARGET.items():
+            hdr[key] = val
+    return hdr
+
+
+def make_night(rawdir, n_bias=5, n_dark=5, n_flat=5, n_science=10,
+               binning=1, filters=("V", "R"), exptimes=(60., 120.),
+               flat_exptime=5., nstar=300, obj="M51",
+               start="2018-04-12T10:30:00", seed=0):
+    ''' Writes the raw frames of a night.
+    Parameters
+    ----------
+    rawdir : path-like
+        The directory of the raw frames (made if it does not exist).
+
+    n_bias, n_dark, n_flat, n_science : int, optional
+        The number of bias, dark (for each EXPTIME of the science frames
+        and the flats), sky flat (for each filter) and science frames.
+        The science frames cycle through ``filters`` and ``exptimes``.
+
+    binning : int, optional
+        The binning of the frames (4096 // binning pixels on a side).
+
+    Returns
+    -------
+    paths : list of Path
+        The frames, in the order they are "taken".
+    '''
+    rawdir = Path(rawdir)
+    rawdir.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    sky = _Sky((SHAPE[0]//binning, SHAPE[1]//binning), rng)
+    tt = datetime.fromisoformat(start)
+    counter = 0
+    paths = []
+
+    def _write(prefix, suffix, data, imagetyp, obj, exptime, filt):
+        nonlocal tt, counter
+        counter += 1
+        dateobs = tt.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3]
+        hdr = _header(imagetyp, obj, exptime, filt, dateobs, binning,
+                      round(-25 + rng.normal(0, 0.2), 2))
+        path = rawdir / f"{prefix}-{counter:04d}{suffix}.fit"
+        fits.PrimaryHDU(data.astype(np.uint16), header=hdr).writeto(
+            path, overwrite=True)
+        paths.append(path)
+        tt += timedelta(seconds=exptime + 10)
+
+    for _ in range(n_bias):
+        _write("cali", "bias", sky.frame(), "Bias Frame", "", 0., "V")
+    darktimes = sorted(set(exptimes) | {flat_exptime})
+    for exptime in darktimes:
+        for _ in range(n_dark):
+            _write("cali", f"dk{exptime:.0f}", sky.frame(exptime),
+                   "Dark Frame", "", exptime, "V")
+    for filt in filters:
+        for _ in range(n_flat):
+            _write("skyflat", filt, sky.frame(flat_exptime, 20000.),
+                   "Flat Field", "skyflat", flat_exptime, filt)
+    for i in range(n_science):
+        filt = filters[i % len(filters)]
+        exptime = exptimes[(i//len(filters)) % len(exptimes)]
+        _write(obj, filt, sky.frame(exptime, 5*exptime, nstar),
+               "Light Frame", obj, exptime, filt)
+    return paths
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("rawdir", type=Path)
+    parser.add_argument("--size", default="small", choices=list(NIGHTS))
+    parser.add_argument("--binning", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    paths = make_night(args.rawdir, binning=args.binning, seed=args.seed,
+                       **NIGHTS[args.size])
+    print(f"{len(paths)} frames written to {args.rawdir}")
+
+
+if __name__ == "__main__":
+    main()
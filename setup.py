@@ -11,7 +11,7 @@ install_requires = ['numpy>=1.14',
 
 classifiers = ["Intended Audience :: Science/Research",
                "Operating System :: OS Independent",
-               "Programming Language :: Python :: 3.6"]
+               "Programming Language :: Python :: 3.7"]
 
 setup(
     name="snuo1mpy",
@@ -24,5 +24,6 @@ setup(
     url="https://github.com/ysBach/SNU1Mpy",
     classifiers=classifiers,
     packages=find_packages(),
-    python_requires='>=3.6',
+    python_requires='>=3.7',
+    entry_points={"console_scripts": ["snuo1m = snuo1mpy.cli:main"]},
     install_requires=install_requires )
@@ -1,2 +1,17 @@
+from . import utils as _utils
 from .utils import *
-from .preprocessor import Preprocessor
\ No newline at end of file
+
+__all__ = _utils.__all__ + ["Preprocessor"]
+
+
+def __getattr__(name):
+    # Preprocessor (and astropy, pandas, ysfitsutilpy, ...) is imported
+    # only when it is first used, so ``import snuo1mpy`` is cheap (PEP 562).
+    if name == "Preprocessor":
+        from .preprocessor import Preprocessor
+        return Preprocessor
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | {"Preprocessor"})
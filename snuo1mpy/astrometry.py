@@ -0,0 +1,614 @@
+import json
+import os
+import shutil
+import signal
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+from astropy import units as u
+from astropy.coordinates import Angle
+from astropy.io import fits
+from astropy.wcs import WCS
+from astropy.wcs.utils import proj_plane_pixel_scales
+
+from .utils import run_jobs
+
+__all__ = ["SOLVE_OPTIONS", "CFG_TEMPLATE", "write_cfg", "write_script",
+           "hint_options", "hints_from_summary", "wcs_hint",
+           "xylist_options", "solve_field_command", "merge_wcs",
+           "solve_field", "run_astrometry"]
+
+# It just simply assumes 1-pixel binning (no binnig).
+SOLVE_OPTIONS = ["--nsigma", "5", "--downsample", "4",
+                 "--radius", "0.2", "-u", "app", "-L", "0.30", "-U", "0.33",
+                 "--cpulimit", "300", "--no-plot", "--overwrite",
+                 "--no-remove-lines"]
+
+# SOLVE_OPTIONS without the position & scale, which are given by hints.
+BASE_OPTIONS = ["--nsigma", "5", "--downsample", "4", "--cpulimit", "300",
+                "--no-plot", "--overwrite", "--no-remove-lines"]
+
+# The pixel scale range (arcsec/pix) of the unbinned STX16803 at SNUO.
+SCALE_LOW = 0.30
+SCALE_HIGH = 0.33
+
+CFG_TEMPLATE = """
+# This is a config file for the Astrometry.net 'astrometry-engine'
+# program - it contains information about where indices are stored,
+# and "site policy" items.
+
+# Check the indices in parallel?
+#
+# -if the indices you are using take less than 2 GB of space, and you have at least
+#  as much physical memory as indices, then you want this enabled.
+#
+# -if you are using a 64-bit machine and you have enough physical memory to contain
+#  the indices you are using, then you want this enabled.
+#
+# -otherwise, leave it commented-out.
+
+inparallel
+
+# If no scale estimate is given, use these limits on field width.
+# minwidth 0.1
+# maxwidth 180
+
+# If no depths are given, use these:
+#depths 10 20 30 40 50 60 70 80 90 100
+
+# Maximum CPU time to spend on a field, in seconds:
+# default is 600 (ten minutes), which is probably way overkill.
+cpulimit 300
+
+# In which directories should we search for indices?
+add_path {:s}
+
+# Load any indices found in the directories listed above.
+autoindex
+
+## Or... explicitly list the indices to load.
+#index index-219
+#index index-218
+#index index-217
+#index index-216
+#index index-215
+#index index-214
+#index index-213
+#index index-212
+#index index-211
+#index index-210
+#index index-209
+#index index-208
+#index index-207
+#index index-206
+#index index-205
+#index index-204-00
+#index index-204-01
+#index index-204-02
+#index index-204-03
+#index index-204-04
+#index index-204-05
+#index index-204-06
+#index index-204-07
+#index index-204-08
+#index index-204-09
+#index index-204-10
+#index index-204-11
+#index index-203-00
+#index index-203-01
+#index index-203-02
+#index index-203-03
+#index index-203-04
+#index index-203-05
+#index index-203-06
+#index index-203-07
+#index index-203-08
+#index index-203-09
+#index index-203-10
+#index index-203-11
+#index index-202-00
+#index index-202-01
+#index index-202-02
+#index index-202-03
+#index index-202-04
+#index index-202-05
+#index index-202-06
+#index index-202-07
+#index index-202-08
+#index index-202-09
+#index index-202-10
+#index index-202-11
+#index index-201-00
+#index index-201-01
+#index index-201-02
+#index index-201-03
+#index index-201-04
+#index index-201-05
+#index index-201-06
+#index index-201-07
+#index index-201-08
+#index index-201-09
+#index index-201-10
+#index index-201-11
+#index index-200-00
+#index index-200-01
+#index index-200-02
+#index index-200-03
+#index index-200-04
+#index index-200-05
+#index index-200-06
+#index index-200-07
+#index index-200-08
+#index index-200-09
+#index index-200-10
+#index index-200-11
+"""
+
+
+def write_cfg(cfg, indexdir):
+    ''' Writes the astrometry.net config file using ``CFG_TEMPLATE``.
+    '''
+    with open(Path(cfg), 'w+') as ff:
+        ff.write(CFG_TEMPLATE.format(str(Path(indexdir).resolve())))
+
+
+def hint_options(ra=None, dec=None, radius=0.2, xbin=1, ybin=1,
+                 scale_low=SCALE_LOW, scale_high=SCALE_HIGH,
+                 base=BASE_OPTIONS):
+    ''' The solve-field options with the position & scale hints.
+    Parameters
+    ----------
+    ra, dec : float or None, optional
+        The approximate center of the field in degrees. If either is
+        ``None``, no position hint is given (i.e., blind solve).
+
+    radius : float, optional
+        The search radius (deg) around ``(ra, dec)``.
+
+    xbin, ybin : int, optional
+        The binning of the frame. The pixel scale bounds (for unbinned
+        pixels) are scaled by them: the lower bound by the smaller and the
+        upper bound by the larger binning.
+
+    scale_low, scale_high : float, optional
+        The pixel scale bounds (arcsec/pix) for the unbinned pixels.
+    '''
+    xbin, ybin = _binning(xbin), _binning(ybin)
+    opts = ["-u", "app",
+            "-L", f"{scale_low*min(xbin, ybin):.4f}",
+            "-U", f"{scale_high*max(xbin, ybin):.4f}"]
+    if ra is not None and dec is not None:
+        opts += ["--ra", f"{ra:.6f}", "--dec", f"{dec:.6f}",
+                 "--radius", f"{radius}"]
+    return opts + list(base)
+
+
+def _binning(val):
+    try:
+        val = int(val)
+    except (TypeError, ValueError):
+        return 1
+    return max(val, 1)
+
+
+def _to_deg(val, unit):
+    if val is None or (isinstance(val, float) and np.isnan(val)):
+        return None
+    try:
+        return float(Angle(val, unit=unit).to_value(u.deg))
+    except (ValueError, TypeError):
+        return None
+
+
+def hints_from_summary(summary, ra_key="OBJCTRA", dec_key="OBJCTDEC",
+                       xbin_key="XBINNING", ybin_key="YBINNING",
+                       group_key="OBJECT"):
+    ''' The hints for `run_astrometry` from a summary table.
+    Parameters
+    ----------
+    summary : pandas.DataFrame
+        The summary table (e.g., ``summary_reduced.csv``).
+
+    xxx_key : str, optional
+        The columns for RA (hourangle), DEC (deg), binnings, and the group
+        in which the WCS of the solved frame is reused for the next.
+
+    Returns
+    -------
+    hints : list of dict
+        ``ra``, ``dec`` (deg or ``None``), ``xbin``, ``ybin``, and
+        ``group`` for each row of ``summary``.
+    '''
+    hints = []
+    for _, row in summary.iterrows():
+        hints.append(dict(ra=_to_deg(row.get(ra_key), u.hourangle),
+                          dec=_to_deg(row.get(dec_key), u.deg),
+                          xbin=_binning(row.get(xbin_key, 1)),
+                          ybin=_binning(row.get(ybin_key, 1)),
+                          group=row.get(group_key, None)))
+    return hints
+
+
+def wcs_hint(fpath):
+    ''' The center (deg) and pixel scale (arcsec/pix) of a solved frame.
+    Returns ``None`` if the frame has no celestial WCS.
+    '''
+    hdr = fits.getheader(fpath)
+    try:
+        wcs = WCS(hdr)
+    except Exception:
+        return None
+    if not wcs.has_celestial:
+        return None
+    ny, nx = hdr["NAXIS2"], hdr["NAXIS1"]
+    ra, dec = wcs.celestial.all_pix2world((nx - 1)/2, (ny - 1)/2, 0)
+    # CUNIT of celestial WCS is always deg.
+    scale = np.mean(np.abs(proj_plane_pixel_scales(wcs.celestial)))*3600
+    return dict(ra=float(ra), dec=float(dec), scale=float(scale))
+
+
+def write_script(fpaths, output, options=SOLVE_OPTIONS,
+                 executable="solve-field", xylists=None, new_wcs="new-wcs"):
+    ''' Writes the shell script to run solve-field one by one.
+    Parameters
+    ----------
+    fpaths : list of path-like
+        The FITS files to be solved. Each is moved to ``input.fits`` in
+        its directory, solved, and the solved file is saved at the
+        original path.
+
+    output : path-like
+        The path to the shell script.
+
+    options : list of str, or list of such, optional
+        The options for solve-field. If it is a list of lists, each is
+        used for the frame of the same index (e.g., from `hint_options`).
+
+    xylists : list of path-like or None, optional
+        The xylist of each frame (``None`` elements are solved from the
+        image). The xylist is solved in ``<stem>_astrometry/`` next to the
+        frame, and the WCS is merged to the frame by ``new_wcs`` (the
+        ``new-wcs`` of astrometry.net).
+    '''
+    fpaths = list(fpaths)
+    if options and not isinstance(options[0], str):
+        per_frame = list(options)
+    else:
+        per_frame = [options]*len(fpaths)
+    if xylists is None:
+        xylists = [None]*len(fpaths)
+
+    str_time = (r'current_date_time="`date +%Y-%m-%d\ %H:%M:%S`";'
+                + 'echo $current_date_time;')
+    str_mv = "mv {} {}/input.fits"
+    str_wcs = executable + " {}/input.fits -N {} {}"
+    str_xyls = executable + " {} -D {} -o input {}"
+    str_merge = new_wcs + " -i {0} -w {1}/input.wcs -o {1}/solved.fits -d"
+
+    with open(Path(output), "w+") as astrometry:
+        astrometry.write(str_time)
+        astrometry.write("\n")
+        for fpath, opts, xylist in zip(fpaths, per_frame, xylists):
+            fpath = Path(fpath)
+            fparent = fpath.parent
+            if xylist is None:
+                astrometry.write(str_mv.format(fpath, fparent))
+                astrometry.write("\n")
+                astrometry.write(str_wcs.format(fparent, fpath,
+                                                " ".join(opts)))
+                astrometry.write("\n")
+            else:
+                scratch = fparent / f"{fpath.stem}_astrometry"
+                opts = xylist_options(xylist) + list(opts)
+                astrometry.write(str_xyls.format(xylist, scratch,
+                                                 " ".join(opts)))
+                astrometry.write("\n")
+                astrometry.write(str_merge.format(fpath, scratch)
+                                 + f" && mv {scratch}/solved.fits {fpath}")
+                astrometry.write("\n")
+                astrometry.write(f"rm -r {scratch}\n")
+            astrometry.write(str_time)
+            astrometry.write("\n")
+        astrometry.write(f"rm {fparent}/input.*\n")
+        astrometry.write(str_time)
+
+
+def xylist_options(xylist):
+    ''' The solve-field options to read an xylist of
+    `~snuo1mpy.extract.write_xylist`.
+    '''
+    hdr = fits.getheader(xylist, 1)
+    return ["--x-column", "X", "--y-column", "Y", "--sort-column", "FLUX",
+            "--width", str(hdr["IMAGEW"]), "--height", str(hdr["IMAGEH"])]
+
+
+def solve_field_command(inpath, newpath, scratch, options=SOLVE_OPTIONS,
+                        executable="solve-field", cfg=None):
+    ''' The solve-field command as a list of arguments.
+    Parameters
+    ----------
+    inpath : path-like
+        The input FITS file (image or xylist).
+
+    newpath : path-like or None
+        The path to save the input with the WCS (``-N``). ``None`` for an
+        xylist, for which there is no image to save.
+
+    scratch : path-like
+        The directory for all the other outputs of solve-field (``-D``).
+    '''
+    cmd = [executable, str(inpath)]
+    if newpath is not None:
+        cmd += ["-N", str(newpath)]
+    cmd += ["-D", str(scratch)]
+    if cfg is not None:
+        cmd += ["--config", str(cfg)]
+    return cmd + list(options)
+
+
+def merge_wcs(fpath, wcspath):
+    ''' Updates the header of ``fpath`` with the WCS (incl. SIP) in the
+    ``.wcs`` file from solve-field.
+    '''
+    wcs = WCS(fits.getheader(wcspath))
+    with fits.open(fpath, mode="update") as hdul:
+        hdul[0].header.update(wcs.to_header(relax=True))
+
+
+def solve_field(fpath, scratchdir, options=SOLVE_OPTIONS,
+                executable="solve-field", cfg=None, timeout=None, retries=0,
+                keep_scratch=False, xylist=None):
+    ''' Runs solve-field on one frame in its own scratch directory.
+    Parameters
+    ----------
+    fpath : path-like
+        The FITS file to be solved. It is replaced by the solved file
+        (with WCS) only if solve-field succeeds.
+
+    scratchdir : path-like
+        The directory in which a scratch directory for this frame is
+        made (``<stem>_xxxxxxxx``, unique even for the frames of the same
+        name in different directories). Since each frame has its own
+        scratch directory, many solve-field can run at the same time.
+
+    timeout : float or None, optional
+        The time limit (in seconds) of each trial. The process is killed
+        when exceeded.
+
+    retries : int, optional
+        The number of re-trials after a failure or a timeout.
+
+    keep_scratch : bool, optional
+        If ``True``, the scratch directory (``scratch`` of the returned
+        log) is not removed (e.g., for debugging).
+
+    xylist : path-like or None, optional
+        If given, the sources in it (see `~snuo1mpy.extract`) are given to
+        solve-field instead of the image, so that solve-field does not
+        extract the sources by itself. The solved WCS is written to the
+        header of ``fpath``.
+
+    Returns
+    -------
+    log : dict
+        The ``file``, ``status`` (``"solved"``, ``"failed"``, or
+        ``"timeout"``), number of ``attempts``, ``duration`` (s),
+        ``message`` (last lines of the output) and ``scratch`` directory.
+    '''
+    fpath = Path(fpath)
+    Path(scratchdir).mkdir(parents=True, exist_ok=True)
+    scratch = Path(tempfile.mkdtemp(prefix=f"{fpath.stem}_",
+                                    dir=scratchdir))
+    t0 = time.time()
+    status, message = "failed", ""
+    if xylist is not None:
+        options = xylist_options(xylist) + list(options)
+
+    for attempt in range(1, retries + 2):
+        # Nothing of the previous trial is left.
+        shutil.rmtree(scratch, ignore_errors=True)
+        scratch.mkdir(parents=True)
+        if xylist is None:
+            inpath = scratch / "input.fits"
+            newpath = scratch / "solved.fits"
+            os.symlink(fpath.resolve(), inpath)
+        else:
+            inpath = scratch / "input.xyls"
+            newpath = None
+            os.symlink(Path(xylist).resolve(), inpath)
+        cmd = solve_field_command(inpath, newpath, scratch, options=options,
+                                  executable=executable, cfg=cfg)
+        # solve-field runs astrometry-engine as its child, which is not
+        # killed with solve-field. So solve-field is started in its own
+        # session (process group) and the whole group is killed at timeout.
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT,
+                                start_new_session=True)
+        try:
+            stdout, _ = proc.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            _kill_group(proc)
+            status, message = "timeout", f"Timeout after {timeout} s"
+            continue
+        except BaseException:
+            # e.g., KeyboardInterrupt: no solver is left running.
+            _kill_group(proc)
+            raise
+        message = "\n".join(stdout.decode(errors="replace")
+                            .strip().splitlines()[-3:])
+        if proc.returncode == 0 and (scratch / "input.solved").exists():
+            if newpath is None and (scratch / "input.wcs").exists():
+                merge_wcs(fpath, scratch / "input.wcs")
+                status = "solved"
+                break
+            elif newpath is not None and newpath.exists():
+                shutil.move(str(newpath), str(fpath))
+                status = "solved"
+                break
+        status = "failed"
+
+    if not keep_scratch:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    return dict(file=str(fpath), status=status, attempts=attempt,
+                duration=time.time() - t0, message=message,
+                scratch=str(scratch))
+
+
+def _kill_group(proc):
+    ''' Kills the process group of ``proc`` (started with
+    ``start_new_session=True``) and waits for ``proc``.
+    '''
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    proc.communicate()
+
+
+def _solve_hinted(fpath, hint, seed, xylist, scratchdir, options,
+                  executable, cfg, timeout, retries, keep_scratch, radius):
+    ''' Solves a frame with the options from its hint, or (if ``seed``,
+    the `wcs_hint` of another frame of the same field with its
+    ``"xbin"`` and ``"ybin"``, is given) around the center and pixel
+    scale of the seed.
+    '''
+    if hint is None:
+        opts = options
+    elif seed is not None:
+        # The same field: search only near the solution of the seed. Its
+        # scale is of its own (binned) pixels, i.e., the mean of the x and
+        # y scales, so it is converted to the unbinned pixels first.
+        unbinned = 2*seed["scale"]/(seed["xbin"] + seed["ybin"])
+        opts = hint_options(ra=seed["ra"], dec=seed["dec"], radius=radius,
+                            scale_low=0.95*unbinned,
+                            scale_high=1.05*unbinned,
+                            xbin=hint["xbin"], ybin=hint["ybin"])
+    else:
+        opts = hint_options(ra=hint["ra"], dec=hint["dec"], radius=radius,
+                            xbin=hint["xbin"], ybin=hint["ybin"])
+    return solve_field(fpath, scratchdir, options=opts,
+                       executable=executable, cfg=cfg, timeout=timeout,
+                       retries=retries, keep_scratch=keep_scratch,
+                       xylist=xylist)
+
+
+def run_astrometry(fpaths, scratchdir="astrometry_scratch", log=None,
+                   n_jobs=1, options=SOLVE_OPTIONS, executable="solve-field",
+                   cfg=None, timeout=None, retries=0, keep_scratch=False,
+                   hints=None, reuse_wcs=True, radius=0.2, xylists=None):
+    ''' Runs solve-field on many frames concurrently.
+    Parameters
+    ----------
+    fpaths : list of path-like
+        The FITS files to be solved (each is replaced by the solved one).
+
+    scratchdir : path-like, optional
+        The directory for the scratch directories of the frames.
+
+    log : path-like or None, optional
+        If given, the result of each frame (see `solve_field`) is appended
+        to it as a JSON line as soon as the frame is done, so that the
+        results are kept even if the run fails or is killed. The lines are
+        in the order the frames are done; the last line of a file is its
+        latest result.
+
+    n_jobs : int or None, optional
+        The number of solve-field processes running at the same time.
+        ``None`` or ``-1`` means the number of CPUs.
+
+    options, executable, cfg, timeout, retries, keep_scratch : optional
+        See `solve_field`. ``options`` is ignored if ``hints`` is given.
+
+    hints : list of dict or None, optional
+        The hints for each frame (see `hints_from_summary`). If given, the
+        position (``--ra``, ``--dec``, ``--radius``) and the binning-scaled
+        pixel scale bounds are passed to solve-field.
+
+    reuse_wcs : bool, optional
+        If ``True`` (and ``hints`` is given), the first frame of each
+        ``"group"`` (e.g., OBJECT) is solved first, and then the other
+        frames of the group are searched around its center and pixel
+        scale (from their own hints if it is not solved). The scale is
+        rescaled to the binning of each frame, so a group can mix the
+        binnings. Both steps run ``n_jobs`` solve-field at a time over
+        all the groups.
+
+    radius : float, optional
+        The search radius (deg) around the hinted position.
+
+    xylists : list of path-like or None, optional
+        The xylist of each frame (see `solve_field`). An element can be
+        ``None`` to solve the frame from its image.
+
+    Returns
+    -------
+    logs : list of dict
+        The results of the frames, in the order of ``fpaths``.
+    '''
+    fpaths = list(fpaths)
+    if xylists is None:
+        xylists = [None]*len(fpaths)
+    if hints is None:
+        hints = [None]*len(fpaths)
+    # The index of the first frame of the group, for the other frames of
+    # the group (if ``reuse_wcs``). They wait for the first ones.
+    first_of = {}
+    if reuse_wcs:
+        groups = {}
+        for i, hint in enumerate(hints):
+            if hint is not None:
+                groups.setdefault(str(hint.get("group")), []).append(i)
+        for idxs in groups.values():
+            first_of.update({i: idxs[0] for i in idxs[1:]})
+
+    logs = [None]*len(fpaths)
+    seeds = {}
+    ll = None if log is None else open(log, 'a')
+    try:
+        for step in range(2):
+            idxs = [i for i in range(len(fpaths))
+                    if (i in first_of) == step]
+
+            def _done(k, item):
+                logs[idxs[k]] = item
+                if ll is not None:
+                    ll.write(json.dumps(item) + "\n")
+                    ll.flush()
+
+            # solve-field runs as a separate process, so threads are
+            # enough.
+            run_jobs(_solve_hinted,
+                     [(fpaths[i], hints[i], seeds.get(first_of.get(i)),
+                       xylists[i], scratchdir, options, executable, cfg,
+                       timeout, retries, keep_scratch, radius)
+                      for i in idxs],
+                     n_jobs=n_jobs,
+                     thread=True,
+                     callback=_done)
+            if step == 0:
+                seeds = _seeds(fpaths, hints, logs, set(first_of.values()))
+    finally:
+        if ll is not None:
+            ll.close()
+    return logs
+
+
+def _seeds(fpaths, hints, logs, firsts):
+    ''' The `wcs_hint` of each solved first frame of a group (see
+    ``reuse_wcs`` of `run_astrometry`), with its binning.
+    '''
+    seeds = {}
+    for i in firsts:
+        seed = None
+        if logs[i]["status"] == "solved":
+            seed = wcs_hint(fpaths[i])
+        if seed is not None:
+            # The frames of a group may differ in binning.
+            seed.update(xbin=hints[i]["xbin"], ybin=hints[i]["ybin"])
+            seeds[i] = seed
+    return seeds
+
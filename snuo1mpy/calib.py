@@ -0,0 +1,284 @@
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+from astropy.io import fits
+
+from .fitsio import CARD, read_header
+from .utils import LazyModule
+
+# astropy.nddata imports astropy.coordinates, which is slow to import.
+_nddata = LazyModule("astropy.nddata")
+
+__all__ = ["MasterCache", "calibrate", "to_integer", "write_image"]
+
+# The number of rows calibrated at a time (see `calibrate`): 64 rows of a
+# 4k float32 frame is 1 MB, i.e., the block stays in the CPU cache while
+# all the corrections are applied to it.
+BLOCK_ROWS = 64
+
+
+class MasterCache():
+    def __init__(self, max_bytes=2**30):
+        """ LRU cache of master (bias, dark, flat) frames in memory.
+        Parameters
+        ----------
+        max_bytes : int or None, optional
+            The memory cap of the cache in bytes. If the total size of the
+            cached frames exceeds it, the least recently used frames are
+            evicted. The most recently used frame is always kept, even if
+            it alone exceeds the cap. ``None`` means no cap.
+
+        Notes
+        -----
+        The frames are identified by ``(kind, key, path)``, where ``kind``
+        is one of ``"bias"``, ``"dark"``, ``"flat"`` and ``key`` is the
+        key of ``Preprocessor.biaspaths`` (or darkpaths, flatpaths). The
+        modification time of the file is also remembered, so a master
+        re-made on disk is read again rather than served from the cache.
+        """
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._frames = OrderedDict()
+
+    def __len__(self):
+        return len(self._frames)
+
+    def get(self, kind, key, path):
+        ''' Returns the master frame as CCDData, reading it if needed.
+        Parameters
+        ----------
+        kind : str
+            The kind of the master, e.g., ``"bias"``.
+
+        key : hashable
+            The calibration-group key of the master, e.g., ``("bias",)``.
+
+        path : path-like or None
+            The path to the master frame. If ``None``, ``None`` is
+            returned.
+        '''
+        if path is None:
+            return None
+        return self._get((kind, key, str(path)), path,
+                         lambda: _nddata.CCDData.read(path), _ccd_nbytes)
+
+    def get_array(self, kind, key, path, reciprocal=False):
+        ''' Returns the data of the master frame as a float32 ndarray.
+        If ``reciprocal``, ``1/data`` is returned (e.g., for the flat, so
+        that the frames are multiplied rather than divided by it). Cached
+        separately from `get`.
+        '''
+        if path is None:
+            return None
+
+        def _read():
+            data = fits.getdata(path).astype(np.float32)
+            if reciprocal:
+                with np.errstate(divide="ignore"):
+                    np.reciprocal(data, out=data)
+            return data
+
+        form = "reciprocal" if reciprocal else "array"
+        return self._get((kind, key, str(path), form), path, _read,
+                         lambda data: data.nbytes)
+
+    def get_header(self, kind, key, path):
+        ''' Returns the header of the master frame (e.g., to see if the
+        dark is a rate), so that it is not parsed again for every frame.
+        Cached separately from `get` and `get_array`.
+        '''
+        if path is None:
+            return None
+        return self._get((kind, key, str(path), "header"), path,
+                         lambda: read_header(path),
+                         lambda header: CARD*len(header))
+
+    def _get(self, ckey, path, read, sizeof):
+        mtime = Path(path).stat().st_mtime_ns
+        try:
+            cached_mtime, frame, nbytes = self._frames[ckey]
+        except KeyError:
+            pass
+        else:
+            if cached_mtime == mtime:
+                self._frames.move_to_end(ckey)
+                self.hits += 1
+                return frame
+            # else: the file has been changed since it was cached.
+            self._pop(ckey)
+
+        self.misses += 1
+        frame = read()
+        nbytes = sizeof(frame)
+        self._frames[ckey] = (mtime, frame, nbytes)
+        self.nbytes += nbytes
+        self._evict()
+        return frame
+
+    def clear(self):
+        self._frames.clear()
+        self.nbytes = 0
+
+    def resize(self, max_bytes):
+        ''' Changes the memory cap, evicting the frames beyond it now.
+        '''
+        self.max_bytes = max_bytes
+        self._evict()
+
+    def _pop(self, ckey):
+        _, _, nbytes = self._frames.pop(ckey)
+        self.nbytes -= nbytes
+
+    def _evict(self):
+        if self.max_bytes is None:
+            return
+        while self.nbytes > self.max_bytes and len(self._frames) > 1:
+            self._pop(next(iter(self._frames)))
+
+
+def _ccd_nbytes(ccd):
+    nbytes = ccd.data.nbytes
+    if ccd.mask is not None:
+        nbytes += ccd.mask.nbytes
+    if ccd.uncertainty is not None:
+        nbytes += ccd.uncertainty.array.nbytes
+    return nbytes
+
+
+def calibrate(raw, bscale=1., bzero=0., bias=None, dark=None,
+              dark_scale=None, flat_inv=None, out=None,
+              block_rows=BLOCK_ROWS):
+    ''' Bias, dark and flat corrections in float32, in place.
+    Parameters
+    ----------
+    raw : 2-D ndarray
+        The stored (not scaled) data, e.g., the uint16/int16 memory map
+        of a raw frame opened with ``do_not_scale_image_data=True``.
+
+    bscale, bzero : float, optional
+        The BSCALE and BZERO of ``raw``.
+
+    bias, dark : 2-D ndarray or None, optional
+        The master bias and dark (float32).
+
+    dark_scale : float or None, optional
+        If given, ``dark`` is the dark current rate and ``dark_scale``
+        times it is subtracted (i.e., the EXPTIME of the frame).
+
+    flat_inv : 2-D ndarray or None, optional
+        The reciprocal of the master flat (see `MasterCache.get_array`).
+
+    out : 2-D ndarray or None, optional
+        The float32 array for the result. Made if ``None``.
+
+    block_rows : int, optional
+        The number of rows processed at a time.
+
+    Returns
+    -------
+    out : 2-D ndarray
+        ``((raw*bscale + bzero) - bias - dark)*flat_inv`` in float32.
+
+    Notes
+    -----
+    The data are converted to float32 only once, and all the corrections
+    are done on a block of rows while it is in the CPU cache, without any
+    temporary full-frame array. So the memory per frame is the float32
+    result (64 MB for a 4k frame) plus the masters shared by the frames.
+    The reciprocal flat is the same as the division within the float32
+    round-off.
+    '''
+    if out is None:
+        out = np.empty(raw.shape, dtype=np.float32)
+    ny = raw.shape[0]
+    tmp = None
+    if dark is not None and dark_scale is not None:
+        tmp = np.empty((min(block_rows, ny),) + raw.shape[1:],
+                       dtype=np.float32)
+    for i in range(0, ny, block_rows):
+        rows = slice(i, min(i + block_rows, ny))
+        blk = out[rows]
+        blk[:] = raw[rows]
+        if bscale != 1:
+            blk *= bscale
+        if bzero != 0:
+            blk += bzero
+        if bias is not None:
+            blk -= bias[rows]
+        if dark is not None:
+            if dark_scale is None:
+                blk -= dark[rows]
+            else:
+                scaled = tmp[:rows.stop - rows.start]
+                np.multiply(dark[rows], dark_scale, out=scaled)
+                blk -= scaled
+        if flat_inv is not None:
+            blk *= flat_inv[rows]
+    return out
+
+
+# BZERO of the unsigned 16-bit integers in FITS
+_UINT16_ZERO = 32768
+
+
+def to_integer(data, dtype="uint16", bscale=1.):
+    ''' Scales float data to 16-bit integers as FITS stores them.
+    Parameters
+    ----------
+    data : ndarray
+        The (calibrated) data.
+
+    dtype : str, optional
+        ``"uint16"`` (0 to ``65535*bscale``) or ``"int16"``
+        (``-32768*bscale`` to ``32767*bscale``). The values out of the
+        range are clipped.
+
+    bscale : float, optional
+        The quantization step, e.g., ``0.1`` for 0.1 ADU. It should be
+        much smaller than the noise.
+
+    Returns
+    -------
+    stored : ndarray of int16
+        The values stored in the file.
+
+    bscale, bzero : float
+        The BSCALE and BZERO, i.e., ``data ~ stored*bscale + bzero``.
+    '''
+    if dtype not in ["uint16", "int16"]:
+        raise ValueError("dtype must be 'uint16' or 'int16'.")
+    bzero = _UINT16_ZERO*bscale if dtype == "uint16" else 0.
+    stored = np.empty(data.shape, dtype=np.int16)
+    info = np.iinfo(np.int16)
+    for i in range(0, data.shape[0], BLOCK_ROWS):
+        rows = slice(i, i + BLOCK_ROWS)
+        blk = (data[rows] - np.float32(bzero))/np.float32(bscale)
+        np.rint(blk, out=blk)
+        np.clip(blk, info.min, info.max, out=blk)
+        stored[rows] = blk
+    return stored, bscale, bzero
+
+
+def write_image(output, data, header, dtype="float32", bscale=1.,
+                overwrite=True):
+    ''' Writes the image in float32 (or other float) or scaled 16-bit
+    integers (see `to_integer`).
+    '''
+    header = header.copy()
+    for key in ["BZERO", "BSCALE"]:
+        header.remove(key, ignore_missing=True)
+    if np.dtype(dtype).kind == 'f':
+        hdu = fits.PrimaryHDU(data.astype(dtype, copy=False), header=header)
+    else:
+        stored, bscale, bzero = to_integer(data, dtype=np.dtype(dtype).name,
+                                           bscale=bscale)
+        hdu = fits.PrimaryHDU(stored, header=header,
+                              do_not_scale_image_data=True)
+        # Set after the HDU is made, otherwise astropy drops them.
+        hdu.header["BSCALE"] = bscale
+        hdu.header["BZERO"] = bzero
+    hdu.writeto(output, output_verify='fix', overwrite=overwrite)
+    return Path(output)
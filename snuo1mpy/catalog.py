@@ -0,0 +1,199 @@
+import json
+import sqlite3
+from contextlib import closing
+from pathlib import Path
+
+import pandas as pd
+
+__all__ = ["Catalog", "INDEX_KEYS"]
+
+# The summary columns indexed for the lookup.
+INDEX_KEYS = ["OBJECT", "FILTER", "EXPTIME", "DATE-OBS"]
+
+
+def _py(val):
+    ''' numpy scalars to Python scalars (for sqlite3 & json).
+    '''
+    return val.item() if hasattr(val, "item") else val
+
+
+class Catalog():
+    def __init__(self, path):
+        """ The SQLite store of the paths, master frames and summaries.
+        Parameters
+        ----------
+        path : path-like
+            The SQLite database file. It is made when something is first
+            saved.
+
+        Notes
+        -----
+        There are three kinds of tables:
+
+          * ``paths``: the lists of files (``kind`` is ``"raw"``,
+            ``"new"``, ``"obj"``, or ``"reduced"``), in order, with the
+            file each one is made from (``source``), e.g., the raw file of
+            a renamed file.
+          * ``masters``: the paths to the master frames (``kind`` is
+            ``"bias"``, ``"dark"``, or ``"flat"``) with the key of the
+            calibration group, i.e., the ``Preprocessor.<kind>paths``.
+          * ``summary_<stage>``: the summary table (``stage`` is ``"raw"``
+            or ``"reduced"``), indexed by `INDEX_KEYS`.
+
+        The ``kind`` saved in ``paths`` and ``masters`` are recorded in
+        ``kinds``, so that a kind saved with no row (e.g., no object
+        frame) is told from the one never saved.
+        """
+        self.path = Path(path)
+
+    def _connect(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        return closing(sqlite3.connect(str(self.path)))
+
+    def _has_table(self, con, table):
+        cur = con.execute("SELECT 1 FROM sqlite_master "
+                          + "WHERE type='table' AND name=?", (table,))
+        return cur.fetchone() is not None
+
+    def _read(self, table, sql, params=()):
+        ''' Runs a SELECT if the table exists, otherwise returns ``None``.
+        '''
+        if not self.path.exists():
+            return None
+        with closing(sqlite3.connect(str(self.path))) as con:
+            if not self._has_table(con, table):
+                return None
+            return con.execute(sql, params).fetchall()
+
+    def _set_saved(self, con, table, kind):
+        con.execute("CREATE TABLE IF NOT EXISTS kinds (tbl TEXT, "
+                    + "kind TEXT, PRIMARY KEY (tbl, kind))")
+        con.execute("INSERT OR IGNORE INTO kinds VALUES (?, ?)",
+                    (table, kind))
+
+    def _is_saved(self, table, kind):
+        return bool(self._read("kinds", "SELECT 1 FROM kinds "
+                               + "WHERE tbl=? AND kind=?", (table, kind)))
+
+    def set_paths(self, kind, paths, sources=None):
+        ''' Saves (replaces) the list of files of ``kind``.
+        '''
+        paths = list(paths)
+        if sources is None:
+            sources = [None]*len(paths)
+        rows = [(kind, i, str(p), None if s is None else str(s))
+                for i, (p, s) in enumerate(zip(paths, sources))]
+        with self._connect() as con, con:
+            con.execute("CREATE TABLE IF NOT EXISTS paths (kind TEXT, "
+                        + "idx INTEGER, path TEXT, source TEXT, "
+                        + "PRIMARY KEY (kind, idx))")
+            con.execute("DELETE FROM paths WHERE kind=?", (kind,))
+            con.executemany("INSERT INTO paths VALUES (?, ?, ?, ?)", rows)
+            self._set_saved(con, "paths", kind)
+
+    def get_paths(self, kind):
+        ''' The list of files of ``kind`` (empty if saved with no file), or
+        ``None`` if never saved.
+        '''
+        rows = self._read("paths",
+                          "SELECT path FROM paths WHERE kind=? ORDER BY idx",
+                          (kind,))
+        if not rows and not self._is_saved("paths", kind):
+            return None
+        return [Path(row[0]) for row in rows]
+
+    def get_sources(self, kind):
+        ''' The dict of the files of ``kind`` to their sources.
+        '''
+        rows = self._read("paths",
+                          "SELECT path, source FROM paths WHERE kind=?",
+                          (kind,))
+        return {} if rows is None else {Path(p): s for p, s in rows}
+
+    def set_masters(self, kind, masters):
+        ''' Saves (replaces) the master frames of ``kind``.
+        Parameters
+        ----------
+        masters : dict
+            The paths to the masters with the keys (tuples of header
+            values) of the calibration groups.
+        '''
+        rows = [(kind, json.dumps([_py(v) for v in key]), str(path))
+                for key, path in masters.items()]
+        with self._connect() as con, con:
+            con.execute("CREATE TABLE IF NOT EXISTS masters (kind TEXT, "
+                        + "key TEXT, path TEXT, PRIMARY KEY (kind, key))")
+            con.execute("DELETE FROM masters WHERE kind=?", (kind,))
+            con.executemany("INSERT INTO masters VALUES (?, ?, ?)", rows)
+            self._set_saved(con, "masters", kind)
+
+    def get_masters(self, kind):
+        ''' The master frames of ``kind`` as ``{key: path}``, or ``None``
+        if never saved.
+        '''
+        rows = self._read("masters",
+                          "SELECT key, path FROM masters WHERE kind=?",
+                          (kind,))
+        if not rows and not self._is_saved("masters", kind):
+            return None
+        return {tuple(json.loads(key)): Path(path) for key, path in rows}
+
+    def set_summary(self, stage, table):
+        ''' Saves (replaces) the summary table of ``stage``.
+        '''
+        table = table.copy()
+        if "file" in table:
+            table["file"] = table["file"].astype(str)
+        name = f"summary_{stage}"
+        with self._connect() as con, con:
+            table.to_sql(name, con, if_exists="replace", index=False)
+            for key in INDEX_KEYS:
+                if key in table:
+                    con.execute("CREATE INDEX IF NOT EXISTS "
+                                + f'"ix_{name}_{key}" ON "{name}" ("{key}")')
+
+    def get_summary(self, stage):
+        ''' The summary table of ``stage``, or ``None`` if never saved.
+        '''
+        return self.query(stage)
+
+    def query(self, stage="raw", where=None, date_range=None,
+              date_key="DATE-OBS"):
+        ''' The rows of a summary table matching the conditions.
+        Parameters
+        ----------
+        stage : str, optional
+            ``"raw"`` or ``"reduced"``.
+
+        where : dict, optional
+            The values of the columns to be matched, e.g.,
+            ``{"OBJECT": "M51", "FILTER": "V"}``.
+
+        date_range : tuple of str, optional
+            The first and last ``date_key`` (inclusive, ISOT strings).
+
+        Returns
+        -------
+        table : pandas.DataFrame or None
+            ``None`` if the summary of ``stage`` was never saved.
+        '''
+        name = f"summary_{stage}"
+        if not self.path.exists():
+            return None
+
+        clauses, params = [], []
+        for key, val in ({} if where is None else where).items():
+            clauses.append(f'"{key}" = ?')
+            params.append(_py(val))
+        if date_range is not None:
+            clauses.append(f'"{date_key}" BETWEEN ? AND ?')
+            params.extend(date_range)
+        sql = f'SELECT * FROM "{name}"'
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY rowid"
+
+        with closing(sqlite3.connect(str(self.path))) as con:
+            if not self._has_table(con, name):
+                return None
+            return pd.read_sql_query(sql, con, params=params)
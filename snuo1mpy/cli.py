@@ -0,0 +1,245 @@
+""" The ``snuo1m`` command.
+
+Runs a stage of `~snuo1mpy.Preprocessor` on a night and prints a JSON
+report of the timing and throughput, e.g.::
+
+    snuo1m organize 180412 --jobs 8
+    snuo1m bias 180412 --memory-limit 2G --resume
+    snuo1m preproc 180412 --jobs 8 --report perf.jsonl
+"""
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+
+from .utils import n_workers
+
+__all__ = ["main", "parse_size"]
+
+STAGES = ["organize", "bias", "dark", "flat", "preproc", "astrometry"]
+
+_UNITS = {"": 1, "K": 2**10, "M": 2**20, "G": 2**30, "T": 2**40}
+
+
+def parse_size(text):
+    ''' Parses a size like ``"512M"``, ``"2G"`` or ``"1048576"`` to bytes.
+    '''
+    text = str(text).strip().upper().rstrip("B")
+    unit = text[-1] if text and text[-1] in _UNITS else ""
+    try:
+        return int(float(text[:len(text) - len(unit)])*_UNITS[unit])
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid size: {text!r}")
+
+
+def _size(fpath):
+    try:
+        return Path(fpath).stat().st_size
+    except (OSError, TypeError):
+        return 0
+
+
+def _ran(prep, stage, before):
+    ''' The manifest entries recorded by ``stage``, i.e., the jobs which
+    were actually run (not skipped by ``--resume``), or ``None`` if the
+    stage does not use the manifest. ``before`` is a copy of the entries
+    before the stage.
+    '''
+    if stage == "astrometry":
+        return None
+    prefixes = [f"{stage}:"]
+    if stage == "preproc":
+        prefixes.append("extract:")  # the xylists made with the frames
+    return [entry for key, entry in prep.manifest.entries.items()
+            if key.startswith(tuple(prefixes))
+            and entry is not before.get(key)]
+
+
+def _stage_inputs(prep, stage):
+    ''' The files read by ``stage``, found before it runs.
+    '''
+    if stage == "organize":
+        return list(prep.rawpaths)
+    prep.initialize_self()
+    if stage in ["bias", "dark", "flat"]:
+        st = prep.summary_raw
+        if st is None:
+            return []
+        for k, v in zip(getattr(prep, f"{stage}_type_key"),
+                        getattr(prep, f"{stage}_type_val")):
+            st = st[st[k] == v]
+        return st["file"].tolist()
+    if stage == "preproc":
+        return list(prep.objpaths or [])
+    if prep.summary_red is None:
+        return []
+    return prep.summary_red["file"].tolist()
+
+
+def _stage_outputs(prep, stage):
+    ''' The files made by ``stage``, found after it runs.
+    '''
+    if stage == "organize":
+        return list(prep.newpaths or [])
+    if stage in ["bias", "dark", "flat"]:
+        return list((getattr(prep, f"{stage}paths") or {}).values())
+    if stage == "preproc":
+        return list(prep.reducedpaths or [])
+    if prep.summary_red is None:
+        return []
+    return prep.summary_red["file"].tolist()
+
+
+def _run_stage(prep, args):
+    stage = args.stage
+    if stage == "organize":
+        prep.organize_raw(n_jobs=args.jobs, resume=args.resume)
+    elif stage in ["bias", "dark", "flat"]:
+        getattr(prep, f"make_{stage}")(n_jobs=args.jobs,
+                                       memory_limit=args.memory_limit,
+                                       resume=args.resume)
+    elif stage == "preproc":
+        kw = {}
+        if args.memory_limit is not None:
+            # The master cache is per process.
+            kw["cache_limit"] = args.memory_limit//n_workers(args.jobs)
+        prep.do_preproc(n_jobs=args.jobs, resume=args.resume,
+                        extract=args.extract, **kw)
+    else:
+        logs = prep.run_astrometry(n_jobs=args.jobs,
+                                   indexdir=args.indexdir,
+                                   cfg=args.cfg,
+                                   timeout=args.timeout,
+                                   use_hints=not args.no_hints,
+                                   use_xylist=args.xylist)
+        return dict(solved=sum(log["status"] == "solved" for log in logs))
+    return {}
+
+
+def _parser():
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("topdir", type=Path,
+                        help="The top directory of the night.")
+    common.add_argument("--rawdir", type=Path, default=None,
+                        help="The raw data directory "
+                             + "(default: <topdir>/rawdata).")
+    common.add_argument("--instrument", default="STX16803")
+    common.add_argument("-j", "--jobs", type=int, default=1,
+                        help="The number of processes (-1: all CPUs).")
+    common.add_argument("--memory-limit", type=parse_size, default=None,
+                        help="The total memory (e.g., 2G) for combine, "
+                             + "or the master caches of all the processes "
+                             + "for preproc.")
+    common.add_argument("--resume", action="store_true",
+                        help="Skip the outputs up to date in the manifest.")
+    common.add_argument("--dark-scalable", action="store_true",
+                        help="Use the dark current rate (scaled darks).")
+    common.add_argument("--summary-format", default="csv",
+                        choices=["csv", "parquet", "feather"])
+    common.add_argument("--report", type=Path, default=None,
+                        help="Append the JSON report to this file.")
+    common.add_argument("--telemetry", type=Path, default=None,
+                        help="Append the time and bytes of each sub-step "
+                             + "to this JSON lines file.")
+    common.add_argument("--profile-dir", type=Path, default=None,
+                        help="Save the cProfile stats of the stage here.")
+    common.add_argument("--trace-memory", action="store_true",
+                        help="Trace the peak memory by tracemalloc.")
+
+    parser = argparse.ArgumentParser(
+        prog="snuo1m",
+        description="Data reduction of the SNUO 1-m telescope.")
+    subs = parser.add_subparsers(dest="stage", metavar="STAGE")
+    subs.required = True
+    for stage in STAGES:
+        sub = subs.add_parser(stage, parents=[common],
+                              help=f"Run the {stage} stage.")
+        if stage == "preproc":
+            sub.add_argument("--extract", action="store_true",
+                             help="Extract the sources for astrometry.")
+        elif stage == "astrometry":
+            sub.add_argument("--indexdir", type=Path, default=Path('.'))
+            sub.add_argument("--cfg", type=Path,
+                             default=Path("astrometry.cfg"))
+            sub.add_argument("--timeout", type=float, default=None)
+            sub.add_argument("--no-hints", action="store_true",
+                             help="Do not give RA/DEC/binning hints.")
+            sub.add_argument("--xylist", action="store_true",
+                             help="Solve from the extracted sources.")
+    return parser
+
+
+def main(argv=None):
+    ''' The entry point of ``snuo1m``. Returns the exit status.
+    '''
+    args = _parser().parse_args(argv)
+
+    from .preprocessor import Preprocessor
+    from .telemetry import Telemetry
+
+    telemetry = None
+    if (args.telemetry is not None or args.profile_dir is not None
+            or args.trace_memory):
+        telemetry = Telemetry(
+            sinks=None if args.telemetry is None else [args.telemetry],
+            profile_dir=args.profile_dir,
+            trace_memory=args.trace_memory)
+
+    rawdir = args.topdir / "rawdata" if args.rawdir is None else args.rawdir
+    prep = Preprocessor(args.topdir, rawdir, instrument=args.instrument,
+                        dark_scalable=args.dark_scalable,
+                        summary_format=args.summary_format,
+                        telemetry=telemetry)
+
+    # The sizes are taken before the stage, as organize moves the files.
+    inputs = {str(fpath): _size(fpath)
+              for fpath in _stage_inputs(prep, args.stage)}
+    before = dict(prep.manifest.entries)
+    start = time.time()
+    t0 = time.perf_counter()
+    extra = _run_stage(prep, args)
+    duration = time.perf_counter() - t0
+    outputs = [str(fpath) for fpath in _stage_outputs(prep, args.stage)]
+
+    # Only the jobs run, not those skipped as up to date (``--resume``).
+    ran = _ran(prep, args.stage, before)
+    if ran is not None:
+        ran_inputs = set().union(*[entry["inputs"] for entry in ran])
+        inputs = {p: size for p, size in inputs.items() if p in ran_inputs}
+        outputs = set().union(*[entry["outputs"] for entry in ran])
+    bytes_read = sum(inputs.values())
+    bytes_written = sum(_size(fpath) for fpath in outputs)
+
+    # ``None`` (JSON null) rather than NaN, which is not valid JSON.
+    rate = 1/duration if duration > 0 else None
+    report = dict(stage=args.stage,
+                  topdir=str(args.topdir),
+                  start=start,
+                  duration=duration,
+                  jobs=args.jobs,
+                  memory_limit=args.memory_limit,
+                  resume=args.resume,
+                  n_input=len(inputs),
+                  n_output=len(outputs),
+                  bytes_read=bytes_read,
+                  bytes_written=bytes_written,
+                  frames_per_s=None if rate is None else len(inputs)*rate,
+                  mb_per_s=(None if rate is None
+                            else (bytes_read + bytes_written)/1.e6*rate),
+                  **extra)
+    if telemetry is not None:
+        report["steps"] = telemetry.totals()
+        for rec in telemetry.records:
+            if rec.get("kind") == "stage" and "mem_peak" in rec:
+                report["mem_peak"] = rec["mem_peak"]
+    line = json.dumps(report)
+    print(line)
+    if args.report is not None:
+        with open(args.report, 'a') as ff:
+            ff.write(line + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
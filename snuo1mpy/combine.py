@@ -0,0 +1,209 @@
+from pathlib import Path
+
+import numpy as np
+from astropy.io import fits
+from astropy.time import Time
+
+from .calib import to_integer
+from .fitsio import LazyImage, trim_header
+from .utils import ccdproc_version
+
+__all__ = ["stream_combine", "can_stream"]
+
+# The integers are stored with BZERO (and BSCALE = 1) by `to_integer`.
+BITPIX = {"uint16": 16, "int16": 16, "float32": -32, "float64": -64}
+
+
+def can_stream(comb_kwargs):
+    ''' Whether ``comb_kwargs`` (for ``combine_ccd``) can be done by
+    `stream_combine`, i.e., a plain median combine without rejection.
+    '''
+    return (comb_kwargs.get("combine_method", "median") == "median"
+            and comb_kwargs.get("reject_method", None) is None)
+
+
+def stream_combine(fpaths, output, memory_limit=2**28, dtype='float32',
+                   normalize_average=False, subtract=None, rate=None,
+                   per_second=False, exptime_key="EXPTIME", geometry=None,
+                   overwrite=True):
+    ''' Median-combines FITS images block by block with a bounded memory.
+    Parameters
+    ----------
+    fpaths : list of path-like
+        The FITS files to be combined. The data must be in the primary
+        HDU and have the same shape.
+
+    output : path-like
+        The path to save the combined image. The header of the first
+        frame is used (with NCOMBINE and HISTORY added).
+
+    memory_limit : int, optional
+        The approximate upper limit of the memory (in bytes) for the
+        pixel stack. The frames are memory-mapped and only as many rows as
+        fit in this limit are loaded and median-combined at a time, and
+        the result is written to ``output`` right after.
+
+    dtype : str or numpy.dtype, optional
+        The data type of the combined image: ``"float32"``,
+        ``"float64"``, or ``"uint16"``/``"int16"`` (rounded and clipped
+        by `~snuo1mpy.calib.to_integer` with BSCALE = 1).
+
+    normalize_average : bool, optional
+        If ``True``, each frame is divided by its average before the
+        combine (as ``combine_ccd(normalize_average=True)``, e.g., for
+        sky flats). The averages are calculated in a first pass over the
+        frames, also block by block.
+
+    subtract : list of path-like or None, optional
+        The frames (e.g., master bias and dark) to be subtracted from each
+        frame before the averages are calculated and the combine is done.
+
+    rate : path-like or None, optional
+        The dark current rate image (per second) to be subtracted from
+        each frame after multiplied by the ``exptime_key`` of the frame.
+
+    per_second : bool, optional
+        If ``True``, each frame (after the subtractions) is divided by its
+        ``exptime_key``, i.e., the result is the rate per second (and its
+        ``exptime_key`` is set to 1).
+
+    geometry : dict or None, optional
+        The detector geometry (see `~snuo1mpy.utils.GEOMETRY`). If given,
+        the overscan level of each frame in ``fpaths`` is subtracted and
+        only the science region is read and combined. ``subtract`` and
+        ``rate`` must be the masters of the science region.
+
+    overwrite : bool, optional
+        Whether to overwrite ``output`` if it exists.
+
+    Returns
+    -------
+    output : Path
+        The path to the combined image.
+    '''
+    dtype = np.dtype(dtype).name
+    if dtype not in BITPIX:
+        raise ValueError(f"dtype must be one of {list(BITPIX)}; "
+                         + f"got {dtype!r}.")
+    fpaths = [Path(fpath) for fpath in fpaths]
+    output = Path(output)
+    subtract = [] if subtract is None else [p for p in subtract
+                                            if p is not None]
+    nframe = len(fpaths)
+    if nframe == 0:
+        raise ValueError("No frame to combine.")
+
+    # Each image is closed below even if a later one (or its geometry)
+    # fails.
+    opened, sub_opened, rate_opened = [], [], []
+
+    def _bd_block(k, rows, out):
+        opened[k].block(rows, out)
+        tmp = None  # reused for all the frames subtracted
+        for img in sub_opened:
+            tmp = img.block(rows, tmp)
+            out -= tmp
+        for img in rate_opened:
+            tmp = img.block(rows, tmp)
+            tmp *= exptimes[k]
+            out -= tmp
+        if per_second:
+            out /= exptimes[k]
+        return out
+
+    try:
+        for fpath in fpaths:
+            opened.append(LazyImage(fpath))
+            opened[-1].apply_geometry(geometry)
+        for fpath in subtract:
+            sub_opened.append(LazyImage(fpath))
+        if rate is not None:
+            rate_opened.append(LazyImage(rate))
+        shape = opened[0].shape
+        for img in opened + sub_opened + rate_opened:
+            if img.shape != shape:
+                raise ValueError(f"{img.path} has shape {img.shape} "
+                                 + f"!= {shape}.")
+
+        # The stack (float32) and a temporary copy inside np.median.
+        nx = int(np.prod(shape[1:]))
+        nrow = max(1, int(memory_limit // (2*4*nframe*nx)))
+        blocks = [slice(i, min(i + nrow, shape[0]))
+                  for i in range(0, shape[0], nrow)]
+
+        if rate is not None or per_second:
+            exptimes = [img.header[exptime_key] for img in opened]
+
+        scales = np.ones(nframe, dtype=np.float64)
+        if normalize_average:
+            for k in range(nframe):
+                total = 0.
+                for rows in blocks:
+                    buf = np.empty((rows.stop - rows.start,) + shape[1:],
+                                   dtype=np.float32)
+                    total += _bd_block(k, rows, buf).sum(dtype=np.float64)
+                scales[k] = total/(shape[0]*nx)
+
+        hdr = opened[0].header.copy()
+        for key in ["BZERO", "BSCALE", "OVERSCAN"]:
+            hdr.remove(key, ignore_missing=True)
+        hdr["NAXIS1"], hdr["NAXIS2"] = shape[1], shape[0]
+        trim_header(hdr, opened[0].trim)
+        if any(img.offset for img in opened):
+            hdr.add_history("Overscan level subtracted from each image")
+        hdr["BITPIX"] = BITPIX[dtype]
+        integer = BITPIX[dtype] > 0
+        if integer:
+            _, bscale, bzero = to_integer(np.zeros((0,)), dtype=dtype)
+            hdr["BSCALE"] = bscale
+            hdr["BZERO"] = bzero
+        # The same keys as combine_ccd.
+        hdr["FITS-TLM"] = (Time.now().isot[:19],
+                           "UT of last modification of this FITS file")
+        combver = ccdproc_version()
+        if combver is not None:
+            hdr["COMBVER"] = (combver, "ccdproc version used for combine.")
+        hdr["NCOMBINE"] = (nframe, "Number of combined images")
+        hdr["COMBMETH"] = ("median", "Combining method")
+        if "BUNIT" not in hdr:
+            hdr["BUNIT"] = "adu"
+        hdr.add_history(f"Median combined {nframe} images by stream_combine "
+                        + f"(memory_limit={memory_limit})")
+        for fpath in subtract:
+            hdr.add_history(f"Subtracted {fpath} before combine")
+        if rate is not None:
+            hdr.add_history(f"Subtracted {rate} x {exptime_key} "
+                            + "before combine")
+        if per_second:
+            hdr[exptime_key] = 1.
+            hdr.add_history(f"Each image divided by its {exptime_key}")
+        if normalize_average:
+            hdr.add_history("Each image normalized by its average")
+
+        if output.exists():
+            if not overwrite:
+                raise FileExistsError(f"{output} exists.")
+            output.unlink()
+
+        shdu = fits.StreamingHDU(output, hdr)
+        try:
+            for rows in blocks:
+                stack = np.empty((nframe, rows.stop - rows.start) + shape[1:],
+                                 dtype=np.float32)
+                for k in range(nframe):
+                    _bd_block(k, rows, stack[k])
+                    if normalize_average:
+                        stack[k] /= scales[k]
+                combined = np.median(stack, axis=0)
+                if integer:
+                    shdu.write(to_integer(combined, dtype=dtype)[0])
+                else:
+                    shdu.write(combined.astype(dtype))
+        finally:
+            shdu.close()
+
+    finally:
+        for img in opened + sub_opened + rate_opened:
+            img.close()
+
+    return output
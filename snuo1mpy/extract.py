@@ -0,0 +1,197 @@
+from pathlib import Path
+
+import numpy as np
+from astropy.io import fits
+from scipy import ndimage
+
+__all__ = ["background", "find_peaks", "extract_sources", "xylist_path",
+           "write_xylist", "extract_file"]
+
+
+def background(data, box=64, nsigma=3., maxiters=3):
+    ''' The background map and noise from sigma-clipped medians in a mesh.
+    Parameters
+    ----------
+    data : 2-D ndarray
+        The image.
+
+    box : int, optional
+        The size (pixels) of the square mesh. The pixels at the right/top
+        edges which do not fill a whole mesh are not used for the
+        estimation (but the map covers them).
+
+    nsigma, maxiters : float, int, optional
+        The sigma-clipping in each mesh: the pixels deviating more than
+        ``nsigma`` times the (MAD) standard deviation from the median are
+        rejected, ``maxiters`` times.
+
+    Returns
+    -------
+    bkg : 2-D ndarray
+        The background map (float32), bilinearly interpolated from the
+        3x3 median-filtered mesh.
+
+    rms : float
+        The median of the standard deviations of the meshes.
+    '''
+    ny, nx = data.shape
+    my, mx = max(ny//box, 1), max(nx//box, 1)
+    by, bx = min(box, ny), min(box, nx)
+    # All meshes at once: (my, mx, by*bx)
+    mesh = (np.asarray(data[:my*by, :mx*bx], dtype=np.float32)
+            .reshape(my, by, mx, bx).swapaxes(1, 2).reshape(my, mx, by*bx))
+    for _ in range(maxiters):
+        med = np.nanmedian(mesh, axis=-1, keepdims=True)
+        std = 1.4826*np.nanmedian(np.abs(mesh - med), axis=-1, keepdims=True)
+        clip = np.abs(mesh - med) > nsigma*std
+        if not clip.any():
+            break
+        mesh = np.where(clip, np.nan, mesh)
+
+    med = np.nanmedian(mesh, axis=-1)
+    std = 1.4826*np.nanmedian(np.abs(mesh - med[..., None]), axis=-1)
+    med = ndimage.median_filter(med, size=3, mode="nearest")
+    # Mesh centers to pixels:
+    yy = (np.arange(ny) - (by - 1)/2)/by
+    xx = (np.arange(nx) - (bx - 1)/2)/bx
+    yy, xx = np.meshgrid(np.clip(yy, 0, my - 1), np.clip(xx, 0, mx - 1),
+                         indexing="ij")
+    bkg = ndimage.map_coordinates(med, [yy, xx], order=1, mode="nearest")
+    return bkg.astype(np.float32), float(np.nanmedian(std))
+
+
+def find_peaks(data, bkg, rms, nsigma=5., fwhm=3., box=5, border=10):
+    ''' Finds the local maxima and their centroids.
+    Parameters
+    ----------
+    data, bkg : 2-D ndarray
+        The image and its background map.
+
+    rms : float
+        The noise of the background.
+
+    nsigma : float, optional
+        The detection threshold of the Gaussian-smoothed image, in units
+        of the noise of the smoothed image.
+
+    fwhm : float, optional
+        The FWHM (pixels) of the Gaussian smoothing kernel.
+
+    box : int, optional
+        The size of the maximum filter, which is also the window for the
+        centroid (the odd number not smaller than it).
+
+    border : int, optional
+        The peaks within this many pixels from the edges are discarded.
+
+    Returns
+    -------
+    x, y, flux : 1-D ndarray
+        The centroids (0-indexed) and the background-subtracted sums in
+        the window, sorted by the flux (brightest first).
+    '''
+    sub = np.asarray(data, dtype=np.float32) - bkg
+    sigma = fwhm/(2*np.sqrt(2*np.log(2)))
+    smooth = ndimage.gaussian_filter(sub, sigma)
+    # Noise of the smoothed image: rms*sqrt(sum(kernel**2)).
+    thresh = nsigma*rms/(2*np.sqrt(np.pi)*sigma)
+    peaks = ((smooth == ndimage.maximum_filter(smooth, size=box))
+             & (smooth > thresh))
+    ny, nx = peaks.shape
+    half = max(box//2, border)
+    peaks[:half] = peaks[ny - half:] = False
+    peaks[:, :half] = peaks[:, nx - half:] = False
+    iy, ix = np.nonzero(peaks)
+
+    # Centroids of all the peaks at once: windows of (npeak, n, n)
+    rr = box//2
+    dy, dx = np.mgrid[-rr:rr + 1, -rr:rr + 1]
+    win = sub[iy[:, None, None] + dy, ix[:, None, None] + dx]
+    win = np.clip(win, 0, None)
+    flux = win.sum(axis=(1, 2))
+    good = flux > 0
+    win, flux, iy, ix = win[good], flux[good], iy[good], ix[good]
+    x = ix + (win*dx).sum(axis=(1, 2))/flux
+    y = iy + (win*dy).sum(axis=(1, 2))/flux
+    order = np.argsort(flux)[::-1]
+    return x[order], y[order], flux[order]
+
+
+def extract_sources(data, box=64, nsigma=5., fwhm=3., max_sources=1000):
+    ''' The sources for solve-field.
+    Parameters
+    ----------
+    data : 2-D ndarray
+        The (reduced) image.
+
+    box : int, optional
+        The mesh size of the background (see `background`).
+
+    nsigma, fwhm : float, optional
+        The detection threshold and the smoothing (see `find_peaks`).
+
+    max_sources : int or None, optional
+        The maximum number of (the brightest) sources.
+
+    Returns
+    -------
+    x, y, flux : 1-D ndarray
+        The centroids in FITS (1-indexed) convention, as solve-field
+        expects, and the fluxes, brightest first.
+    '''
+    data = np.asarray(data, dtype=np.float32)
+    bkg, rms = background(data, box=box)
+    x, y, flux = find_peaks(data, bkg, rms, nsigma=nsigma, fwhm=fwhm)
+    if max_sources is not None:
+        x, y, flux = x[:max_sources], y[:max_sources], flux[:max_sources]
+    return x + 1, y + 1, flux
+
+
+def xylist_path(fpath):
+    ''' The path to the xylist of a FITS file (``.xyls`` next to it).
+    '''
+    return Path(fpath).with_suffix(".xyls")
+
+
+def write_xylist(output, x, y, flux, shape, overwrite=True):
+    ''' Writes the xylist (X, Y, FLUX in the first extension).
+    Parameters
+    ----------
+    shape : tuple of int
+        The shape of the image, saved as IMAGEH and IMAGEW.
+    '''
+    cols = [fits.Column(name="X", format="E", array=x),
+            fits.Column(name="Y", format="E", array=y),
+            fits.Column(name="FLUX", format="E", array=flux)]
+    table = fits.BinTableHDU.from_columns(cols)
+    table.header["IMAGEW"] = (shape[1], "Image width (pixels)")
+    table.header["IMAGEH"] = (shape[0], "Image height (pixels)")
+    fits.HDUList([fits.PrimaryHDU(), table]).writeto(output,
+                                                     overwrite=overwrite)
+    return Path(output)
+
+
+def extract_file(fpath, output=None, extract_kw=None, data=None):
+    ''' Extracts the sources of a FITS file and writes the xylist.
+    Defined at the top level so that it can be sent to the workers of a
+    process pool.
+    Parameters
+    ----------
+    output : path-like or None, optional
+        The path to the xylist. Defaults to `xylist_path`.
+
+    extract_kw : dict or None, optional
+        The keyword arguments of `extract_sources`.
+
+    data : 2-D ndarray or None, optional
+        If given, it is used instead of reading ``fpath`` (e.g., the
+        array just reduced in the same process).
+    '''
+    if output is None:
+        output = xylist_path(fpath)
+    if extract_kw is None:
+        extract_kw = {}
+    if data is None:
+        data = fits.getdata(fpath)
+    x, y, flux = extract_sources(data, **extract_kw)
+    return write_xylist(output, x, y, flux, data.shape)
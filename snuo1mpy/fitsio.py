@@ -0,0 +1,239 @@
+from pathlib import Path
+from warnings import warn
+
+import numpy as np
+import pandas as pd
+from astropy.io import fits
+
+from .utils import frame_sections, run_jobs
+
+__all__ = ["read_header", "scan_headers", "summary_from_headers",
+           "LazyImage", "trim_header"]
+
+# The FITS files are made of 2880-byte blocks of 36 80-byte cards.
+BLOCK = 2880
+CARD = 80
+END_CARD = b"END" + b" "*(CARD - 3)
+
+
+def _has_end(block):
+    for i in range(0, BLOCK, CARD):
+        if block[i:i + CARD] == END_CARD:
+            return True
+    return False
+
+
+def read_header(fpath):
+    ''' Reads the primary header of a FITS file without touching its data.
+    Parameters
+    ----------
+    fpath : path-like
+        The path to the FITS file.
+
+    Notes
+    -----
+    Only the 2880-byte header blocks are read (until the END card) and
+    parsed by `~astropy.io.fits.Header.fromstring`. The data are not read
+    by `~astropy.io.fits.getheader` either, but it opens the file as an
+    HDU list (file object, HDU classes, header verification), which costs
+    a few times more per file than this.
+    '''
+    blocks = []
+    with open(fpath, 'rb') as ff:
+        while True:
+            block = ff.read(BLOCK)
+            if len(block) < BLOCK:
+                raise OSError(f"{fpath}: END card not found in the header.")
+            blocks.append(block)
+            if _has_end(block):
+                break
+    raw = b"".join(blocks)
+    try:
+        text = raw.decode("ascii")
+    except UnicodeDecodeError:
+        # As fits.getheader: replaced by "?" (one character per byte, so
+        # that the cards stay 80 characters), rather than failing the
+        # whole scan for one card written by the observatory.
+        warn(f"{fpath}: non-ASCII characters in the header are replaced "
+             + "by \"?\".")
+        text = raw.decode("ascii", errors="replace").replace("\ufffd", "?")
+    return fits.Header.fromstring(text)
+
+
+class LazyImage():
+    def __init__(self, fpath):
+        """ The primary image of a FITS file, memory-mapped.
+        Parameters
+        ----------
+        fpath : path-like
+            The FITS file (uncompressed), e.g., a raw uint16 frame.
+
+        Notes
+        -----
+        The stored data (``self.raw``, e.g., int16 with BZERO = 32768 for
+        the raw frames) are memory-mapped, i.e., nothing is copied to the
+        memory until it is used, and the pages are shared through the
+        page cache. BSCALE and BZERO (and the overscan level, see
+        `apply_geometry`) are applied only to the rows asked (`block`),
+        into a float32 buffer. Use it as a context manager, or `close` it,
+        to release the file.
+        """
+        self.path = Path(fpath)
+        self._hdul = fits.open(self.path, memmap=True,
+                               do_not_scale_image_data=True)
+        try:
+            self.header = self._hdul[0].header
+            self.raw = self._hdul[0].data
+        except Exception:
+            self._hdul.close()
+            raise
+        self.bscale = self.header.get("BSCALE", 1)
+        self.bzero = self.header.get("BZERO", 0)
+        self.offset = 0.
+        self.trim = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def shape(self):
+        return self.raw.shape
+
+    def block(self, rows=slice(None), out=None):
+        ''' The scaled (BSCALE, BZERO) data of ``rows`` in float32.
+        Parameters
+        ----------
+        rows : slice, optional
+            The rows (the first axis) to be read.
+
+        out : ndarray or None, optional
+            The float32 buffer (of the shape of the rows) to be filled.
+            Made if ``None``.
+        '''
+        raw = self.raw[rows]
+        if out is None:
+            out = np.empty(raw.shape, dtype=np.float32)
+        out[:] = raw
+        if self.bscale != 1:
+            out *= self.bscale
+        if self.bzero - self.offset != 0:
+            out += self.bzero - self.offset
+        return out
+
+    def apply_geometry(self, geometry):
+        ''' Subtracts the overscan level and trims to the science region.
+        Parameters
+        ----------
+        geometry : dict or None
+            The detector geometry (see `~snuo1mpy.utils.GEOMETRY`). Nothing
+            is done if ``None``.
+
+        Notes
+        -----
+        The median of BIASSEC is saved as ``self.offset`` (subtracted in
+        `block`), and ``self.raw`` becomes the TRIMSEC of the memory map
+        (a view, so the pixels outside are never read). Returns ``self``.
+        '''
+        if geometry is None:
+            return self
+        trim, bias = frame_sections(self.header, geometry)
+        if bias is not None:
+            over = self.raw[bias].astype(np.float32)
+            self.offset = float(np.median(over))*self.bscale + self.bzero
+        if trim is not None:
+            self.raw = self.raw[trim]
+            self.trim = trim
+        return self
+
+    def read(self):
+        ''' The whole scaled data in float32.
+        '''
+        return self.block()
+
+    def close(self):
+        # The memmap is closed with the file (astropy keeps it open while
+        # self.raw is referenced).
+        self.raw = None
+        self._hdul.close()
+
+
+def trim_header(header, trim=None, offset=0.):
+    ''' Records the trim and overscan (of `LazyImage.apply_geometry`)
+    in ``header`` (in place). The offset of the trimmed pixels is saved
+    as LTV1/LTV2, as IRAF does.
+    '''
+    if trim is not None:
+        ysl, xsl = trim
+        header["LTV1"] = (-xsl.start, "Offset of x from the untrimmed frame")
+        header["LTV2"] = (-ysl.start, "Offset of y from the untrimmed frame")
+        header.add_history(f"Trimmed to [{xsl.start + 1}:{xsl.stop},"
+                           + f"{ysl.start + 1}:{ysl.stop}]")
+    if offset:
+        header["OVERSCAN"] = (offset, "[ADU] Overscan level subtracted")
+
+
+def scan_headers(fpaths, n_jobs=None):
+    ''' Reads the primary headers of many FITS files using threads.
+    Parameters
+    ----------
+    fpaths : list of path-like
+        The paths to the FITS files.
+
+    n_jobs : int or None, optional
+        The number of threads. ``None`` or ``-1`` means the number of
+        CPUs. Since reading headers is I/O bound (especially on network
+        storage), it can be larger than the number of CPUs.
+
+    Returns
+    -------
+    headers : list of `~astropy.io.fits.Header`
+        The headers in the same order as ``fpaths``.
+    '''
+    return run_jobs(read_header, [(fpath,) for fpath in fpaths],
+                    n_jobs=n_jobs, thread=True)
+
+
+def summary_from_headers(fpaths, headers, keywords, output=None,
+                         sort_by="file"):
+    ''' Makes the summary table from headers already in memory.
+    Parameters
+    ----------
+    fpaths : list of path-like
+        The paths to the FITS files.
+
+    headers : list of `~astropy.io.fits.Header` or dict-like
+        The headers of the files, in the same order as ``fpaths``.
+
+    keywords : list of str
+        The header keywords to be the columns of the summary. The
+        keywords not in the header are left empty.
+
+    output : path-like or None, optional
+        If given, the summary is saved as CSV to this path.
+
+    sort_by : str or None, optional
+        The column to sort the rows.
+
+    Notes
+    -----
+    The columns are the same as ``ysfitsutilpy.make_summary``, i.e.,
+    ``"file"``, ``"filesize"`` and ``keywords``, but no file is opened
+    again.
+    '''
+    rows = []
+    for fpath, hdr in zip(fpaths, headers):
+        row = dict(file=str(fpath), filesize=Path(fpath).stat().st_size)
+        for key in keywords:
+            row[key] = hdr.get(key, None)
+        rows.append(row)
+
+    summary = pd.DataFrame(rows, columns=["file", "filesize"] + list(keywords))
+    if sort_by is not None:
+        summary = summary.sort_values(sort_by).reset_index(drop=True)
+
+    if output is not None:
+        summary.to_csv(output, index=False)
+    return summary
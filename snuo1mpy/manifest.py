@@ -0,0 +1,126 @@
+import hashlib
+import json
+from pathlib import Path
+
+__all__ = ["Manifest"]
+
+
+def _digest(params):
+    dumped = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha1(dumped.encode()).hexdigest()
+
+
+class Manifest():
+    def __init__(self, path, use_hash=False):
+        """ Records which inputs and parameters made each output.
+        Parameters
+        ----------
+        path : path-like
+            The JSON file of the manifest. It is loaded if it exists.
+
+        use_hash : bool, optional
+            If ``True``, the files are identified by the SHA-1 hash of
+            their contents. Otherwise (default), by their size and
+            modification time, which is much cheaper and enough unless
+            the files are touched by other programs.
+
+        Notes
+        -----
+        Each entry is identified by a key, e.g., ``"bias:bias.fits"`` or
+        ``"preproc:<path to reduced>"``, and holds the signatures of the input
+        and output files and the digest of the parameters. An entry is
+        "fresh" if none of them has changed since it was recorded, so that
+        the task can be skipped when the pipeline is re-run.
+        """
+        self.path = Path(path)
+        self.use_hash = use_hash
+        self.entries = {}
+        if self.path.exists():
+            with open(self.path, 'r') as ff:
+                self.entries = json.load(ff)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def signature(self, fpath):
+        ''' The signature of a file, or ``None`` if it does not exist.
+        '''
+        fpath = Path(fpath)
+        try:
+            stat = fpath.stat()
+        except FileNotFoundError:
+            return None
+
+        if not self.use_hash:
+            return [stat.st_size, stat.st_mtime_ns]
+
+        sha = hashlib.sha1()
+        with open(fpath, 'rb') as ff:
+            for chunk in iter(lambda: ff.read(2**20), b""):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    def signatures(self, fpaths):
+        return {str(p): self.signature(p) for p in fpaths if p is not None}
+
+    def record(self, key, inputs, outputs, params=None, input_sigs=None):
+        ''' Records (or replaces) an entry.
+        Parameters
+        ----------
+        key : str
+            The key of the entry.
+
+        inputs, outputs : list of path-like
+            The input and output files. ``None`` elements are ignored.
+
+        params : dict, optional
+            The parameters affecting the outputs. It must be JSON
+            serializable (otherwise ``str`` of it is used).
+
+        input_sigs : dict, optional
+            The signatures of the inputs, if they have been taken already
+            (e.g., the input file is moved by the task).
+        '''
+        if input_sigs is None:
+            input_sigs = self.signatures(inputs)
+        self.entries[key] = dict(inputs=input_sigs,
+                                 outputs=self.signatures(outputs),
+                                 params=_digest(params))
+
+    def outputs(self, key):
+        return [Path(p) for p in self.entries[key]["outputs"]]
+
+    def keys(self, prefix=""):
+        return [k for k in self.entries if k.startswith(prefix)]
+
+    def intact(self, key, which="outputs"):
+        ''' Whether the ``which`` (inputs or outputs) files of the entry
+        are unchanged since recorded.
+        '''
+        try:
+            sigs = self.entries[key][which]
+        except KeyError:
+            return False
+        return all(self.signature(p) == sig for p, sig in sigs.items())
+
+    def is_fresh(self, key, inputs, params=None, check_inputs=True):
+        ''' Whether the entry is made from the same ``inputs`` and
+        ``params``, and its outputs are intact. If ``check_inputs`` is
+        ``False``, the contents of the inputs are not checked (e.g., the
+        inputs have been moved away after the task).
+        '''
+        try:
+            entry = self.entries[key]
+        except KeyError:
+            return False
+
+        inputs = set(str(p) for p in inputs if p is not None)
+        return (entry["params"] == _digest(params)
+                and set(entry["inputs"]) == inputs
+                and (not check_inputs or self.intact(key, "inputs"))
+                and self.intact(key, "outputs"))
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, 'w+') as ff:
+            json.dump(self.entries, ff, indent=1)
@@ -0,0 +1,237 @@
+import numpy as np
+import pandas as pd
+
+from .fitsio import read_header
+from .utils import KEYMAP
+
+__all__ = ["TOLERANCES", "snap_groups", "MasterIndex"]
+
+# The largest difference of a header value of a frame from that of its
+# master (the same unit as the header). The numeric group keys not here
+# must be equal (within the float round-off). "DATE-OBS" is in days;
+# ``None`` means no limit, i.e., it only chooses among the masters which
+# match equally well.
+TOLERANCES = {"EXPTIME": 0.01,
+              "EXPOSURE": 0.01,
+              "EXPOS": 0.01,
+              "CCD-TEMP": 1.,
+              "SET-TEMP": 0.5,
+              "DATE-OBS": None}
+
+_EPS = 1.e-6
+
+
+def _tol(key, tolerances):
+    tol = tolerances.get(key, _EPS)
+    return _EPS if tol is None else max(tol, _EPS)
+
+
+def _is_numeric(column):
+    return (pd.api.types.is_numeric_dtype(column)
+            and not pd.api.types.is_bool_dtype(column))
+
+
+def _days(values):
+    ''' DATE-OBS (str or datetime) to days (float), NaN if invalid.
+    '''
+    tt = pd.to_datetime(pd.Series(values), errors="coerce")
+    days = tt.values.astype("datetime64[ns]").astype(np.int64)/8.64e13
+    days[tt.isna().values] = np.nan
+    return days
+
+
+def snap_groups(table, group_key, tolerances=None):
+    ''' Merges the near-equal numeric values of ``group_key`` (e.g.,
+    EXPTIME of 30.0 and 30.0001) so that ``groupby`` puts them together.
+    Parameters
+    ----------
+    table : pandas.DataFrame
+        The summary table of the frames to be grouped.
+
+    group_key : list of str
+        The columns to group by.
+
+    tolerances : dict, optional
+        The tolerance of each column (see `TOLERANCES`).
+
+    Returns
+    -------
+    table : pandas.DataFrame
+        A copy of ``table``, where the values of each numeric column in
+        ``group_key`` are replaced by the most common value of their
+        cluster (the smallest one if tied).
+
+    Notes
+    -----
+    The sorted values are clustered from the smallest one (the seed): the
+    values within the tolerance from the seed are in its cluster, and the
+    next value is the seed of the next cluster. Hence all members are
+    within the tolerance from the snapped value, i.e., the master made
+    from a cluster is found for each member by `MasterIndex` with the
+    same ``tolerances``.
+    '''
+    tolerances = TOLERANCES if tolerances is None else tolerances
+    table = table.copy()
+    for key in group_key:
+        if key not in table or not _is_numeric(table[key]):
+            continue
+        vals = table[key].to_numpy(dtype=np.float64, copy=True)
+        ok = np.isfinite(vals)
+        if not ok.any():
+            continue
+        uniq, inv, counts = np.unique(vals[ok], return_inverse=True,
+                                      return_counts=True)
+        tol = _tol(key, tolerances)
+        snapped = np.empty_like(uniq)
+        start = 0
+        while start < uniq.size:
+            stop = np.searchsorted(uniq, uniq[start] + tol, side="right")
+            snapped[start:stop] = uniq[start + np.argmax(counts[start:stop])]
+            start = stop
+        vals[ok] = snapped[inv.ravel()]
+        table[key] = vals
+    return table
+
+
+class MasterIndex():
+    def __init__(self, paths, type_val, group_key, tolerances=None,
+                 dates=None):
+        """ The masters of a kind, sorted once to find the master of many
+        frames at a time.
+        Parameters
+        ----------
+        paths : dict
+            The paths to the masters (e.g., ``Preprocessor.darkpaths``)
+            with the keys of ``type_val`` followed by the values of
+            ``group_key``.
+
+        type_val, group_key : list
+            The ``_type_val`` and ``_group_key`` of the kind.
+
+        tolerances : dict, optional
+            The tolerance of each key (see `TOLERANCES`).
+
+        dates : dict or None, optional
+            The DATE-OBS of each master (with the same keys as
+            ``paths``). If ``None``, read from the headers of the masters
+            which exist.
+
+        Notes
+        -----
+        The non-numeric keys (e.g., FILTER) must be equal. The numeric
+        keys must be within their tolerances, and among the masters which
+        are, the nearest one is used: the smallest sum of the differences
+        in the units of the tolerances, and then the closest DATE-OBS.
+        The masters are sorted by the first numeric key (per the values
+        of the non-numeric keys), so the candidates of all frames are
+        found by one ``searchsorted``.
+        """
+        self.tolerances = TOLERANCES if tolerances is None else tolerances
+        self.ntype = len(type_val)
+        self.type_val = tuple(type_val)
+        self.group_key = list(group_key)
+        self.keys = [key for key in paths if len(key) == (self.ntype
+                                                          + len(group_key))]
+        if dates is None:
+            dates = {key: _date_of(path) for key, path in paths.items()}
+        self.days = _days([dates.get(key) for key in self.keys])
+        self.values = pd.DataFrame([key[self.ntype:] for key in self.keys],
+                                   columns=self.group_key)
+
+    def match(self, table):
+        ''' The key of the master for each row of ``table``.
+        Parameters
+        ----------
+        table : pandas.DataFrame
+            The summary table of the frames to be calibrated.
+
+        Returns
+        -------
+        keys : list of (tuple or None)
+            The key (of ``paths``) of the master of each row, in the same
+            order as ``table``. ``None`` if there is no master within the
+            tolerances.
+        '''
+        nrow = len(table)
+        if not self.group_key:
+            # The master is fully specified by _type_val.
+            key = self.type_val if self.type_val in self.keys else None
+            return [key]*nrow
+        if (nrow == 0 or not self.keys
+                or not set(self.group_key).issubset(table.columns)):
+            return [None]*nrow
+        matched = np.full(nrow, -1, dtype=np.int64)
+
+        numkeys = [key for key in self.group_key
+                   if _is_numeric(table[key])]
+        strkeys = [key for key in self.group_key if key not in numkeys]
+        # The frames and masters with the same non-numeric values.
+        mcode, fcode = _codes(self.values[strkeys], table[strkeys])
+        mnum = self.values[numkeys].apply(pd.to_numeric, errors="coerce")
+        mnum = mnum.to_numpy(dtype=np.float64).reshape(len(self.keys), -1)
+        fnum = table[numkeys].to_numpy(dtype=np.float64).reshape(nrow, -1)
+        tols = np.array([_tol(key, self.tolerances) for key in numkeys])
+        fdays = _days(table[KEYMAP["DATE-OBS"]]) if (
+            KEYMAP["DATE-OBS"] in table) else np.full(nrow, np.nan)
+        maxdays = self.tolerances.get("DATE-OBS")
+
+        for code in np.unique(mcode):
+            frows = np.flatnonzero(fcode == code)
+            if frows.size == 0:
+                continue
+            mrows = np.flatnonzero(mcode == code)
+            if numkeys:
+                mrows = mrows[np.argsort(mnum[mrows, 0], kind="stable")]
+                prim = mnum[mrows, 0]
+                lo = np.searchsorted(prim, fnum[frows, 0] - tols[0], "left")
+                hi = np.searchsorted(prim, fnum[frows, 0] + tols[0], "right")
+            else:
+                lo = np.zeros(frows.size, dtype=np.int64)
+                hi = np.full(frows.size, mrows.size)
+            width = int((hi - lo).max(initial=0))
+            if width == 0:
+                continue
+            # The candidates (frame, window) and their distances.
+            cand = lo[:, None] + np.arange(width)
+            valid = cand < hi[:, None]
+            cand = mrows[np.minimum(cand, mrows.size - 1)]
+            diff = np.abs(mnum[cand] - fnum[frows][:, None, :])/tols
+            with np.errstate(invalid="ignore"):
+                valid &= (diff <= 1).all(axis=2)
+                dday = np.abs(self.days[cand] - fdays[frows][:, None])
+                if maxdays is not None:
+                    valid &= ~(dday > maxdays)
+            dist = np.where(valid, diff.sum(axis=2), np.inf)
+            best = dist.min(axis=1)
+            dday = np.where(dist <= best[:, None] + _EPS,
+                            np.nan_to_num(dday, nan=np.inf), np.inf)
+            # The closest DATE-OBS among the nearest ones (the first of
+            # them if the dates are unknown).
+            choice = np.where(np.isfinite(dday).any(axis=1),
+                              np.argmin(dday, axis=1),
+                              np.argmin(dist, axis=1))
+            ok = np.isfinite(best)
+            matched[frows[ok]] = cand[ok, choice[ok]]
+
+        return [self.keys[i] if i >= 0 else None for i in matched]
+
+
+def _codes(mvals, fvals):
+    ''' Integer codes of the rows of the masters and the frames, equal if
+    the rows are equal (-1 for the frames equal to no master).
+    '''
+    if mvals.shape[1] == 0:
+        return np.zeros(len(mvals), dtype=np.int64), np.zeros(len(fvals),
+                                                               dtype=np.int64)
+    mtup = pd.Index(list(mvals.astype(str).itertuples(index=False,
+                                                      name=None)))
+    ftup = list(fvals.astype(str).itertuples(index=False, name=None))
+    uniq = mtup.unique()
+    return uniq.get_indexer(mtup), uniq.get_indexer(pd.Index(ftup))
+
+
+def _date_of(path):
+    try:
+        return read_header(path).get(KEYMAP["DATE-OBS"])
+    except (OSError, TypeError):
+        return None
@@ -0,0 +1,258 @@
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing
+from pathlib import Path
+
+import pandas as pd
+from astropy.time import Time
+
+from .fitsio import read_header
+from .matching import TOLERANCES
+from .preprocessor import Preprocessor
+from .utils import KEYMAP, n_workers, run_jobs
+
+__all__ = ["MasterLibrary", "reduce_nights"]
+
+# The stages run for all the nights before the next stage starts.
+STAGES = ["organize", "bias", "dark", "flat", "preproc"]
+
+
+def _num(val):
+    ''' float or None (for missing header values or NaN in the summary).
+    '''
+    try:
+        val = float(val)
+    except (TypeError, ValueError):
+        return None
+    return None if val != val else val
+
+
+class MasterLibrary():
+    def __init__(self, path, temp_tol=2., max_days=30.):
+        """ The master frames of many nights, to be used for the nights
+        without their own masters.
+        Parameters
+        ----------
+        path : path-like
+            The SQLite database file of the library.
+
+        temp_tol : float, optional
+            The maximum difference (deg C) of CCD-TEMP between a frame and
+            the master to be used for it.
+
+        max_days : float or None, optional
+            The maximum difference (days) of DATE-OBS between a frame and
+            the master to be used for it. ``None`` means no limit.
+
+        Notes
+        -----
+        Each master is indexed by its kind (bias/dark/flat), instrument,
+        binning, CCD-TEMP, EXPTIME, FILTER and DATE-OBS (as MJD), from the
+        header of the master (i.e., its first combined frame).
+        """
+        self.path = Path(path)
+        self.temp_tol = temp_tol
+        self.max_days = max_days
+
+    def _connect(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        con = sqlite3.connect(str(self.path))
+        con.execute("CREATE TABLE IF NOT EXISTS masters (path TEXT PRIMARY "
+                    + "KEY, kind TEXT, instrument TEXT, xbin INTEGER, "
+                    + "ybin INTEGER, ccdtemp REAL, exptime REAL, "
+                    + "filter TEXT, mjd REAL, night TEXT, rate INTEGER)")
+        con.execute("CREATE INDEX IF NOT EXISTS ix_masters ON masters "
+                    + "(kind, instrument, xbin, ybin)")
+        return closing(con)
+
+    def add(self, kind, paths, instrument, night=None):
+        ''' Adds (or updates) the masters of ``kind``.
+        Parameters
+        ----------
+        paths : list of path-like
+            The master frames. Those which do not exist are ignored.
+
+        instrument : str
+            The instrument of the masters.
+
+        night : str, optional
+            The night (e.g., the ``topdir``) the masters are made from.
+        '''
+        rows = []
+        for path in paths:
+            path = Path(path)
+            if not path.exists():
+                continue
+            hdr = read_header(path)
+            try:
+                mjd = Time(hdr[KEYMAP["DATE-OBS"]]).mjd
+            except (KeyError, ValueError):
+                mjd = None
+            rows.append((str(path), kind, instrument,
+                         int(hdr.get("XBINNING", 1)),
+                         int(hdr.get("YBINNING", 1)),
+                         _num(hdr.get("CCD-TEMP")),
+                         _num(hdr.get(KEYMAP["EXPTIME"])),
+                         hdr.get(KEYMAP["FILTER"]),
+                         mjd,
+                         None if night is None else str(night),
+                         int(bool(hdr.get("DARKRATE", False)))))
+        with self._connect() as con, con:
+            con.executemany("INSERT OR REPLACE INTO masters VALUES "
+                            + "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def nearest(self, kind, row, instrument):
+        ''' The master closest in time which can be used for a frame.
+        Parameters
+        ----------
+        kind : str
+            ``"bias"``, ``"dark"``, or ``"flat"``.
+
+        row : dict-like
+            The header or the row of the summary table of the frame.
+
+        instrument : str
+            The instrument of the frame.
+
+        Returns
+        -------
+        path : Path or None
+            The master with the same instrument and binning (and EXPTIME
+            for dark unless it is a dark current rate image, FILTER for
+            flat), CCD-TEMP within ``temp_tol`` and
+            DATE-OBS within ``max_days``. ``None`` if there is none.
+        '''
+        if not self.path.exists():
+            return None
+
+        def _get(key, default=None):
+            val = row.get(key, default)
+            return default if val is None or pd.isna(val) else val
+
+        clauses = ["kind = ?", "instrument = ?", "xbin = ?", "ybin = ?"]
+        params = [kind, instrument,
+                  int(_get("XBINNING", 1)), int(_get("YBINNING", 1))]
+        if kind == "dark":
+            # The dark current rate can be scaled to any EXPTIME.
+            # The same tolerance as the masters of the night (see
+            # `~snuo1mpy.matching.TOLERANCES`).
+            clauses.append("(rate = 1 OR ABS(exptime - ?) <= ?)")
+            params.extend([_num(_get(KEYMAP["EXPTIME"])),
+                           TOLERANCES.get(KEYMAP["EXPTIME"], 0.)])
+        elif kind == "flat":
+            clauses.append("filter = ?")
+            params.append(_get(KEYMAP["FILTER"]))
+
+        ccdtemp = _num(_get("CCD-TEMP"))
+        if ccdtemp is not None and kind != "flat":
+            clauses.append("(ccdtemp IS NULL OR ABS(ccdtemp - ?) <= ?)")
+            params.extend([ccdtemp, self.temp_tol])
+
+        try:
+            mjd = Time(_get(KEYMAP["DATE-OBS"])).mjd
+        except (TypeError, ValueError):
+            mjd = None
+        sql = "SELECT path FROM masters WHERE " + " AND ".join(clauses)
+        if mjd is not None:
+            if self.max_days is not None:
+                sql += " AND ABS(mjd - ?) <= ?"
+                params.extend([mjd, self.max_days])
+            # The undated masters (NULL mjd) only after all the dated ones.
+            sql += " ORDER BY mjd IS NULL, ABS(mjd - ?)"
+            params.append(mjd)
+        with self._connect() as con:
+            for (path, ) in con.execute(sql, params):
+                # A master may have been removed since it was added.
+                if Path(path).exists():
+                    return Path(path)
+        return None
+
+
+def _night_stage(topdir, rawdir, stage, library, prep_kw, stage_kw):
+    ''' Runs one stage of a night. Defined at the top level so that it can
+    be sent to the workers of a process pool.
+    '''
+    prep = Preprocessor(topdir, Path(topdir) / rawdir,
+                        master_library=library, **prep_kw)
+    if stage == "organize":
+        prep.organize_raw(**stage_kw)
+    elif stage == "preproc":
+        prep.do_preproc(**stage_kw)
+    else:
+        getattr(prep, f"make_{stage}")(**stage_kw)
+        return prep.instrument, [str(p) for p in
+                                 getattr(prep, f"{stage}paths").values()]
+    return prep.instrument, []
+
+
+def reduce_nights(topdirs, library, rawdir="rawdata", n_jobs=1,
+                  organize=True, prep_kw=None, organize_kw=None,
+                  bias_kw=None, dark_kw=None, flat_kw=None, preproc_kw=None):
+    ''' Reduces many nights in parallel, sharing the masters among them.
+    Parameters
+    ----------
+    topdirs : list of path-like
+        The ``topdir`` of each night (see `Preprocessor`).
+
+    library : `MasterLibrary` or path-like
+        The library of the masters. The masters made are added to it.
+
+    rawdir : str, optional
+        The raw data directory under each ``topdir``.
+
+    n_jobs : int or None, optional
+        The number of nights processed at the same time. ``None`` or
+        ``-1`` means all the CPUs.
+
+    organize : bool, optional
+        Whether to run ``organize_raw`` first.
+
+    prep_kw : dict, optional
+        The keyword arguments of `Preprocessor`.
+
+    organize_kw, bias_kw, dark_kw, flat_kw, preproc_kw : dict, optional
+        The keyword arguments of ``organize_raw``, ``make_bias``,
+        ``make_dark``, ``make_flat`` and ``do_preproc``. Use ``resume``
+        in them to skip what has been done in the previous runs.
+
+    Returns
+    -------
+    library : `MasterLibrary`
+
+    Notes
+    -----
+    Each stage is done for all the nights (in parallel) before the next
+    stage starts, and the masters made are added to ``library`` right
+    after. So, when a night has no bias (dark, flat) of a group, e.g., a
+    flat of a night without dark, the nearest valid master of the other
+    nights is used (see `MasterLibrary.nearest`) instead of skipping the
+    correction. Each master is made only once, in its own night.
+    '''
+    if not isinstance(library, MasterLibrary):
+        library = MasterLibrary(library)
+    topdirs = [Path(topdir) for topdir in topdirs]
+    prep_kw = {} if prep_kw is None else prep_kw
+    stage_kws = dict(organize=organize_kw, bias=bias_kw, dark=dark_kw,
+                     flat=flat_kw, preproc=preproc_kw)
+    stages = STAGES if organize else STAGES[1:]
+
+    executor = None
+    if n_workers(n_jobs) > 1 and len(topdirs) > 1:
+        executor = ProcessPoolExecutor(
+            max_workers=min(n_workers(n_jobs), len(topdirs)))
+    try:
+        for stage in stages:
+            kw = stage_kws[stage]
+            kw = {} if kw is None else kw
+            results = run_jobs(_night_stage,
+                               [(topdir, rawdir, stage, library, prep_kw, kw)
+                                for topdir in topdirs],
+                               n_jobs=n_jobs,
+                               executor=executor)
+            for topdir, (instrument, paths) in zip(topdirs, results):
+                if paths:
+                    library.add(stage, paths, instrument, night=topdir)
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True)
+    return library
@@ -0,0 +1,188 @@
+import time
+from concurrent.futures import (FIRST_COMPLETED, CancelledError,
+                                ProcessPoolExecutor, ThreadPoolExecutor,
+                                wait)
+
+from .utils import n_workers
+
+__all__ = ["Task", "DAGRunner"]
+
+
+def _timed(func, args):
+    ''' Calls ``func(*args)`` and returns the result with the start & end
+    (wall clock) time. Defined at the top level so that it can be sent to
+    the workers of a process pool.
+    '''
+    t0 = time.time()
+    result = func(*args)
+    return result, t0, time.time()
+
+
+class Task():
+    def __init__(self, name, func, args=(), deps=()):
+        """ A node of the pipeline.
+        Parameters
+        ----------
+        name : str
+            The unique name of the task, e.g., ``"flat:V.fits"``.
+
+        func : callable
+            The function to be called as ``func(*args)``. It must be
+            picklable (defined at the top level of a module) if the tasks
+            are run on a process pool.
+
+        args : tuple, optional
+            The positional arguments of ``func``.
+
+        deps : iterable of str, optional
+            The names of the tasks which must be finished before this task
+            starts.
+        """
+        self.name = name
+        self.func = func
+        self.args = tuple(args)
+        self.deps = set(deps)
+
+    def __repr__(self):
+        return f"Task({self.name!r}, deps={sorted(self.deps)})"
+
+
+class DAGRunner():
+    def __init__(self, n_jobs=1, executor=None, thread=False, verbose=True):
+        """ Runs tasks as soon as all of their dependencies are finished.
+        Parameters
+        ----------
+        n_jobs : int or None, optional
+            The number of tasks running at the same time. If ``1``
+            (default), the tasks are run one by one in this process (in a
+            topological order). ``None`` or ``-1`` means all the CPUs.
+
+        executor : `~concurrent.futures.Executor` or None, optional
+            If given, it is used instead of making a new pool.
+
+        thread : bool, optional
+            If ``True``, a thread pool is used instead of a process pool.
+
+        verbose : bool, optional
+            Whether to print the timing of each task when it is finished.
+
+        Notes
+        -----
+        After `run`, ``self.timings`` has the name, start & end time (UNIX
+        time) and duration (s) of each task, in the order of completion.
+        """
+        self.n_jobs = n_jobs
+        self.executor = executor
+        self.thread = thread
+        self.verbose = verbose
+        self.timings = []
+
+    def _done(self, task, start, end, result, callback=None):
+        timing = dict(name=task.name, start=start, end=end,
+                      duration=end - start)
+        self.timings.append(timing)
+        if self.verbose:
+            print(f"{task.name:<50s} {timing['duration']:9.3f} s")
+        if callback is not None:
+            callback(task.name, result)
+
+    def run(self, tasks, callback=None):
+        ''' Runs the tasks.
+        Parameters
+        ----------
+        tasks : list of `Task`
+            The tasks. The dependencies which are not in ``tasks`` are
+            regarded as already finished.
+
+        callback : callable, optional
+            Called as ``callback(name, result)`` in this process as soon as
+            each task is finished (e.g., to record it to the manifest). If
+            a task raises, the tasks not started yet are cancelled, but
+            those already running are waited for and passed to
+            ``callback`` before the error is raised.
+
+        Returns
+        -------
+        results : dict
+            The returned values of the tasks, with the task names as keys.
+        '''
+        tasks = {task.name: task for task in tasks}
+        if len(tasks) == 0:
+            return {}
+        waiting = {name: set(task.deps).intersection(tasks)
+                   for name, task in tasks.items()}
+        for name, deps in waiting.items():
+            if name in deps:
+                raise ValueError(f"Task {name} depends on itself.")
+        results = {}
+        self.timings = []
+
+        def _ready():
+            names = [name for name, deps in waiting.items() if not deps]
+            for name in names:
+                del waiting[name]
+            return names
+
+        def _finish(name):
+            for deps in waiting.values():
+                deps.discard(name)
+
+        if self.executor is None and self.n_jobs == 1:
+            ready = _ready()
+            while ready:
+                for name in ready:
+                    task = tasks[name]
+                    results[name], t0, t1 = _timed(task.func, task.args)
+                    self._done(task, t0, t1, results[name], callback)
+                    _finish(name)
+                ready = _ready()
+            if waiting:
+                raise ValueError(f"Cyclic dependencies among {list(waiting)}")
+            return results
+
+        if self.executor is None:
+            pool = ThreadPoolExecutor if self.thread else ProcessPoolExecutor
+            executor = pool(max_workers=min(n_workers(self.n_jobs),
+                                            len(tasks)))
+        else:
+            executor = self.executor
+
+        try:
+            running = {}
+            error = None
+            for name in _ready():
+                task = tasks[name]
+                running[executor.submit(_timed, task.func, task.args)] = name
+
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        results[name], t0, t1 = future.result()
+                    except CancelledError:
+                        continue
+                    except Exception as err:
+                        if error is None:
+                            error = err
+                            for other in running:
+                                other.cancel()
+                        continue
+                    self._done(tasks[name], t0, t1, results[name], callback)
+                    _finish(name)
+                if error is not None:
+                    # Only wait for those already running.
+                    continue
+                for name in _ready():
+                    task = tasks[name]
+                    future = executor.submit(_timed, task.func, task.args)
+                    running[future] = name
+            if error is not None:
+                raise error
+        finally:
+            if self.executor is None:
+                executor.shutdown(wait=True)
+
+        if waiting:
+            raise ValueError(f"Cyclic dependencies among {list(waiting)}")
+        return results
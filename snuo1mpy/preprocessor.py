@@ -1,34 +1,582 @@
+import functools
+import inspect
 import pickle
+import time
 from pathlib import Path
 from warnings import warn
 
-import pandas as pd
 from astropy.io import fits
 from astropy.io.fits import Card
-from astropy.nddata import CCDData
+import pandas as pd
 from astropy.time import Time
 
-from .utils import KEYMAP, MEDCOMB_KEYS, USEFUL_KEYS, cards_gain_rdnoise
-
-try:
-    import ysfitsutilpy as yfu
-except ImportError:
-    raise ImportError(
-        "Please install ysfitsutilspy at: https://github.com/ysBach/ysfitsutilpy")
+from .calib import MasterCache, calibrate, write_image
+from .catalog import Catalog
+from .combine import can_stream, stream_combine
+from .fitsio import (LazyImage, read_header, scan_headers,
+                     summary_from_headers, trim_header)
+from .manifest import Manifest
+from .matching import TOLERANCES, MasterIndex, snap_groups
+from .pipeline import DAGRunner, Task
+from .summary import SUMMARY_FORMATS, apply_schema, read_summary, write_summary
+from .telemetry import Recorder, Telemetry, file_size
+from .utils import (GEOMETRY, KEYMAP, MEDCOMB_KEYS, USEFUL_KEYS, LazyModule,
+                    cards_gain_rdnoise, ccdproc_version, n_workers,
+                    run_jobs)
+
+# Imported when first used, so that the modules not needed for a task
+# (e.g., astrometry for the reduction) do not slow down the start up.
+yfu = LazyModule(
+    "ysfitsutilpy",
+    hint="Please install ysfitsutilspy at: https://github.com/ysBach/ysfitsutilpy")
+_nddata = LazyModule("astropy.nddata")  # astropy.coordinates is heavy
+_airmass = LazyModule(f"{__package__}.airmass")
+_astrometry = LazyModule(f"{__package__}.astrometry")
+_extract = LazyModule(f"{__package__}.extract")
 
 
 __all__ = ["Preprocessor"]
 
+# The cache of master frames in this process (i.e., in each worker of the
+# pool). Each worker reads a master only once, no matter how many object
+# frames it reduces, as long as it fits in the cache. It is cleared at the
+# end of do_preproc (and run), so that the masters are not kept in the
+# main process (the workers of a pool made there go away with the pool).
+_CACHE = None
+
+
+def _master_cache(max_bytes):
+    global _CACHE
+    if _CACHE is None:
+        _CACHE = MasterCache(max_bytes=max_bytes)
+    else:
+        _CACHE.resize(max_bytes)
+    return _CACHE
+
+
+def _clear_master_cache():
+    if _CACHE is not None:
+        _CACHE.clear()
+
+
+def _preproc_frame(fpath, savepath, masters, bdf_kw, extract_kw,
+                   cache_limit, record=False):
+    ''' Reduces one object frame. Defined at the top level so that it can
+    be sent to the workers of a process pool.
+    Parameters
+    ----------
+    masters : dict
+        The ``(key, path)`` of the master bias, dark and flat, with the
+        keys ``"bias"``, ``"dark"``, ``"flat"``.
+
+    bdf_kw : dict
+        The keyword arguments of ``bdf_process``, and ``in_place``,
+        ``bscale`` and ``geometry`` (see ``do_preproc``).
+
+    extract_kw : dict or None
+        If not ``None``, the sources are extracted from the reduced data
+        (still in memory) and saved as the xylist. See
+        `~snuo1mpy.extract.extract_file`.
+
+    record : bool, optional
+        Whether to time the sub-steps (see `~snuo1mpy.telemetry`).
+
+    Returns
+    -------
+    savepath : Path
+
+    records : list of dict
+        The telemetry records (empty unless ``record``).
+    '''
+    rec = Recorder(record, frame=str(fpath))
+    bdf_kw = dict(bdf_kw)
+    in_place = bdf_kw.pop("in_place", False)
+    bscale = bdf_kw.pop("bscale", 1.)
+    geometry = bdf_kw.pop("geometry", None)
+    if in_place and not bdf_kw.get("do_crrej", False):
+        data = _calibrate_frame(fpath, savepath, masters, bdf_kw["dtype"],
+                                bscale, geometry, cache_limit, rec)
+    else:
+        data = _bdf_frame(fpath, savepath, masters, bdf_kw, geometry,
+                          cache_limit, rec)
+
+    if extract_kw is not None:
+        with rec.span("extract"):
+            _extract.extract_file(savepath, extract_kw=extract_kw,
+                                  data=data)
+    return savepath, rec.records
+
+
+def _bdf_frame(fpath, savepath, masters, bdf_kw, geometry, cache_limit,
+               rec):
+    ''' Reduces one frame by ``bdf_process``. Returns the reduced data.
+    '''
+    cache = _master_cache(cache_limit)
+    with rec.span("master", bytes_read=0) as span:
+        mccds = {}
+        for kind, (key, path) in masters.items():
+            misses = cache.misses
+            mccds[kind] = cache.get(kind, key, path)
+            if cache.misses > misses:
+                span["bytes_read"] += file_size(path)
+
+    with rec.span("read", bytes_read=file_size(fpath)):
+        objccd = _read_ccd(fpath, geometry)
+
+    # The cosmic-ray rejection is done after bdf_process (as it does), so
+    # that it is timed on its own.
+    do_crrej = bdf_kw.pop("do_crrej", False)
+    crrej_kwargs = bdf_kw.pop("crrej_kwargs", None)
+    verbose_crrej = bdf_kw.pop("verbose_crrej", False)
+    with rec.span("calibrate"):
+        redccd = yfu.bdf_process(objccd,
+                                 output=None,
+                                 unit=None,
+                                 mbias=mccds["bias"],
+                                 mdark=_scale_dark(mccds["dark"],
+                                                   objccd.header),
+                                 mflat=mccds["flat"],
+                                 **bdf_kw)
+    if do_crrej:
+        with rec.span("crrej"):
+            redccd = _crrej(redccd, crrej_kwargs, verbose_crrej)
+
+    with rec.span("write") as span:
+        redccd.write(savepath, output_verify='fix', overwrite=True)
+        span["bytes_written"] = file_size(savepath)
+    return redccd.data
+
+
+def _crrej(ccd, crrej_kwargs=None, verbose=False):
+    ''' The cosmic-ray rejection of the calibrated ``ccd``, as
+    ``bdf_process(do_crrej=True)`` does: with the GAIN and RDNOISE of the
+    header.
+    '''
+    if crrej_kwargs is None:
+        crrej_kwargs = {}
+        warn("You are not specifying CR-rejection parameters! It can be"
+             + " dangerous to use defaults blindly.")
+    yfu.set_ccd_gain_rdnoise(ccd, verbose=False, update_header=True)
+    ccd, _ = yfu.crrej(ccd,
+                       propagate_crmask=False,
+                       update_header=True,
+                       gain=ccd.gain,
+                       rdnoise=ccd.rdnoise,
+                       verbose=verbose,
+                       **crrej_kwargs)
+    return ccd
+
+
+def _calibrate_frame(fpath, savepath, masters, dtype, bscale, geometry,
+                     cache_limit, rec):
+    ''' Reduces one frame by `~snuo1mpy.calib.calibrate`: float32, in
+    place, with the reciprocal of the flat. Returns the reduced data.
+    '''
+    cache = _master_cache(cache_limit)
+    with rec.span("master", bytes_read=0) as span:
+        arrays = {}
+        for kind, (key, path) in masters.items():
+            misses = cache.misses
+            arrays[kind] = cache.get_array(kind, key, path,
+                                           reciprocal=(kind == "flat"))
+            if cache.misses > misses:
+                span["bytes_read"] += file_size(path)
+        # Whether the dark is a rate, from the cached header rather than
+        # the file for every frame.
+        dark_rate = _is_dark_rate(masters["dark"][1], cache=cache,
+                                  key=masters["dark"][0])
+
+    # The raw data are memory-mapped, i.e., actually read while they are
+    # calibrated.
+    with LazyImage(fpath) as img:
+        with rec.span("read", bytes_read=file_size(fpath)):
+            img.apply_geometry(geometry)
+        hdr = img.header.copy()
+        trim_header(hdr, img.trim, img.offset)
+        dark_scale = None
+        if dark_rate:
+            dark_scale = hdr[KEYMAP["EXPTIME"]]
+        with rec.span("calibrate"):
+            data = calibrate(img.raw,
+                             bscale=img.bscale,
+                             bzero=img.bzero - img.offset,
+                             bias=arrays["bias"],
+                             dark=arrays["dark"],
+                             dark_scale=dark_scale,
+                             flat_inv=arrays["flat"])
+    _add_process(hdr, {kind: path for kind, (_, path) in masters.items()},
+                 dark_scale)
+
+    with rec.span("write") as span:
+        write_image(savepath, data, hdr, dtype=dtype, bscale=bscale)
+        span["bytes_written"] = file_size(savepath)
+    return data
+
+
+# The keys and HISTORY of ``bdf_process`` for each kind of the masters:
+# (command, its short name (the key of the arguments), the arguments,
+# HISTORY).
+_BDF_LOGS = {
+    "bias": ("SUBTRACT_BIAS", "SUBBIAS", "ccd=<CCDData>, master=<CCDData>",
+             "Bias subtracted (see BIASFRM)"),
+    "dark": ("SUBTRACT_DARK", "SUBDARK",
+             "ccd=<CCDData>, master=<CCDData>, dark_exposure=None, "
+             + "data_exposure=None, exposure_time={}, exposure_unit=s, "
+             + "scale=False",
+             "Dark subtracted (see DARKFRM)"),
+    "flat": ("FLAT_CORRECT", "FLATCOR",
+             "ccd=<CCDData>, flat=<CCDData>, min_value=None, "
+             + "norm_value=1.0",
+             "Flat corrected by image/flat*flat_norm_value "
+             + "(see FLATFRM; FLATNORM)")
+}
+
+
+def _add_process(header, masters, dark_scale=None):
+    ''' Adds the same keys as ``bdf_process`` (CCDPROCV, BIASFRM, SUBBIAS,
+    ..., PROCESS such as ``"B-D-F"``) and HISTORY for the corrections
+    done by `~snuo1mpy.calib.calibrate` with ``masters`` (``{kind:
+    path}``, ``None`` if not done), so that the reduced frames are the
+    same regardless of ``in_place``.
+    '''
+    ccdprocv = ccdproc_version()
+    if ccdprocv is not None and header.get("CCDPROCV") != ccdprocv:
+        if "CCDPROCV" in header:
+            header.add_history("The ccdproc version prior to this "
+                               + f"modification was {header['CCDPROCV']}.")
+        header["CCDPROCV"] = (ccdprocv, "ccdproc version used for processing.")
+
+    done = []
+    for kind, path in masters.items():
+        if path is None:
+            continue
+        done.append(kind[0].upper())
+        header[f"{kind.upper()}FRM"] = (str(path),
+                                        f"applied {kind.upper()} frame")
+        if kind == "dark" and dark_scale is not None:
+            header.add_history(f"Dark scaling using {KEYMAP['EXPTIME']}")
+        if kind == "flat":
+            header["FLATNORM"] = (1.0, "flat_norm_value (none = mean of "
+                                  + "input flat)")
+
+    for kind, path in masters.items():
+        if path is None:
+            continue
+        command, short, args, history = _BDF_LOGS[kind]
+        header[f"HIERARCH {command}"] = (short.lower(), "Shortened name for "
+                                         + "ccdproc command")
+        header[short] = args.format(KEYMAP["EXPTIME"])
+        header.add_history(history)
+
+    if "PROCESS" in header:
+        done = str(header["PROCESS"]).split("-") + done
+    else:
+        header.add_comment("Standard items for PROCESS includes B=bias, "
+                           + "D=dark, F=flat, T=trim, W=WCS, O=Overscan, "
+                           + "I=Illumination, C=CRrej, R=fringe, P=fixpix, "
+                           + "X=crosstalk.")
+    header["PROCESS"] = ("-".join(done),
+                         "Process (order: 1-2-3-...): see comment.")
+
+
+def _header_of_float(img):
+    ''' The header of the float32 data of `~snuo1mpy.fitsio.LazyImage`
+    (trimmed and overscan subtracted if so).
+    '''
+    header = img.header.copy()
+    for key in ["BZERO", "BSCALE"]:
+        header.remove(key, ignore_missing=True)
+    trim_header(header, img.trim, img.offset)
+    return header
+
+
+def _read_ccd(fpath, geometry=None):
+    ''' Reads the frame as float32 CCDData through its memory map, rather
+    than ``CCDData.read`` (float64 for the scaled integers). Only the
+    science region is read if ``geometry`` is given (see
+    `~snuo1mpy.fitsio.LazyImage.apply_geometry`).
+    '''
+    with LazyImage(fpath) as img:
+        img.apply_geometry(geometry)
+        return _nddata.CCDData(img.read(),
+                               unit=img.header.get("BUNIT", "adu").lower(),
+                               header=_header_of_float(img))
+
+
+def _read_ccds(fpaths, geometry=None):
+    ''' ``fpaths`` as they are (to be read by ``combine_ccd``), or the
+    trimmed CCDData if ``geometry`` is given.
+    '''
+    if geometry is None:
+        return fpaths
+    return [_read_ccd(fpath, geometry) for fpath in fpaths]
+
+
+def _bd_ccd(fpath, biaspath, darkpath=None, cache=None, geometry=None):
+    ''' The bias (and dark) subtracted frame as float32 CCDData (ADU),
+    calibrated from the memory map of ``fpath`` (see
+    `~snuo1mpy.calib.calibrate`) with the float32 masters from ``cache``.
+    '''
+    if cache is None:
+        cache = MasterCache(max_bytes=None)
+    mbias = cache.get_array("bias", None, biaspath)
+    mdark = cache.get_array("dark", None, darkpath)
+    with LazyImage(fpath) as img:
+        img.apply_geometry(geometry)
+        hdr = _header_of_float(img)
+        dark_scale = None
+        if _is_dark_rate(darkpath, cache=cache):
+            dark_scale = hdr[KEYMAP["EXPTIME"]]
+        data = calibrate(img.raw, bscale=img.bscale,
+                         bzero=img.bzero - img.offset,
+                         bias=mbias, dark=mdark, dark_scale=dark_scale)
+    _add_process(hdr, dict(bias=biaspath, dark=darkpath), dark_scale)
+    return _nddata.CCDData(data, unit='adu', header=hdr)
+
+
+def _scale_dark(mdark, header):
+    ''' Scales the dark current rate image (DARKRATE = T, see
+    ``_make_dark``) to the EXPTIME in ``header``. Other darks are
+    returned as they are.
+    '''
+    if mdark is None or not mdark.header.get("DARKRATE", False):
+        return mdark
+    exptime = header[KEYMAP["EXPTIME"]]
+    return _nddata.CCDData(mdark.data*exptime, unit=mdark.unit,
+                           header=mdark.header)
+
+
+def _is_dark_rate(darkpath, cache=None, key=None):
+    ''' Whether the master dark is a rate (see ``_make_dark``). The header
+    is taken from ``cache`` (`~snuo1mpy.calib.MasterCache`) if given.
+    '''
+    if darkpath is None:
+        return False
+    if cache is None:
+        header = read_header(darkpath)
+    else:
+        header = cache.get_header("dark", key, darkpath)
+    return bool(header.get("DARKRATE", False))
+
+
+def _total_size(fpaths):
+    return sum(file_size(fpath) or 0 for fpath in fpaths)
+
+
+def _streamable(memory_limit, comb_kwargs):
+    if memory_limit is None:
+        return False
+    if not can_stream(comb_kwargs):
+        warn("memory_limit is ignored: only median combine without "
+             + "rejection can be done within the memory limit.")
+        return False
+    return True
+
+
+def _make_bias(fpaths, output, dtype, comb_kwargs, type_key, type_val,
+               geometry, memory_limit, record=False):
+    ''' Combines one group of bias frames. Defined at the top level so
+    that it can be sent to the workers of a process pool.
+    The master makers return the output and the telemetry records (empty
+    unless ``record``, see ``_preproc_frame``). The masters are of the
+    science region of ``geometry`` (the whole frame if ``None``).
+    '''
+    rec = Recorder(record, group=Path(output).name)
+    with rec.span("combine", nframe=len(fpaths),
+                  bytes_read=_total_size(fpaths)) as span:
+        if _streamable(memory_limit, comb_kwargs):
+            stream_combine(fpaths,
+                           output=output,
+                           memory_limit=memory_limit,
+                           dtype=dtype,
+                           geometry=geometry)
+        else:
+            _ = yfu.combine_ccd(_read_ccds(fpaths, geometry),
+                                output=output,
+                                dtype=dtype,
+                                **comb_kwargs,
+                                type_key=type_key,
+                                type_val=type_val)
+        span["bytes_written"] = file_size(output)
+    return output, rec.records
+
+
+def _make_dark(fpaths, output, biaspath, dtype, comb_kwargs, type_key,
+               type_val, scalable, geometry, memory_limit, record=False):
+    ''' Combines one group of dark frames and subtracts the bias.
+    If ``scalable``, each dark is bias subtracted and divided by its
+    EXPTIME before the combine, i.e., the master is the dark current rate
+    (per second, with ``DARKRATE = T`` in the header) to be scaled to the
+    EXPTIME of each frame to be calibrated.
+    '''
+    rec = Recorder(record, group=Path(output).name)
+    if _streamable(memory_limit, comb_kwargs):
+        # median(dark_i) - bias = median(dark_i - bias)
+        with rec.span("combine", nframe=len(fpaths),
+                      bytes_read=_total_size(fpaths)) as span:
+            stream_combine(fpaths,
+                           output=output,
+                           memory_limit=memory_limit,
+                           dtype=dtype,
+                           subtract=[biaspath],
+                           per_second=scalable,
+                           exptime_key=KEYMAP["EXPTIME"],
+                           geometry=geometry)
+            if scalable:
+                fits.setval(output, "DARKRATE", value=True,
+                            comment="Dark current rate (per 1 s EXPTIME)")
+            span["bytes_written"] = file_size(output)
+        return output, rec.records
+
+    if scalable:
+        cache = MasterCache(max_bytes=None)
+        rates = []
+        for fpath in fpaths:
+            with rec.span("calibrate", frame=str(fpath),
+                          bytes_read=file_size(fpath)):
+                ccd = _bd_ccd(fpath, biaspath, cache=cache,
+                              geometry=geometry)
+                ccd.data /= ccd.header[KEYMAP["EXPTIME"]]
+                rates.append(ccd)
+        with rec.span("combine", nframe=len(rates)):
+            mdark = yfu.combine_ccd(rates,
+                                    output=None,
+                                    dtype=dtype,
+                                    **comb_kwargs,
+                                    type_key=type_key,
+                                    type_val=type_val)
+        mdark.header[KEYMAP["EXPTIME"]] = 1.
+        mdark.header["DARKRATE"] = (True,
+                                    "Dark current rate (per 1 s EXPTIME)")
+    else:
+        with rec.span("combine", nframe=len(fpaths),
+                      bytes_read=_total_size(fpaths)):
+            mdark = yfu.combine_ccd(_read_ccds(fpaths, geometry),
+                                    output=None,
+                                    dtype=dtype,
+                                    **comb_kwargs,
+                                    type_key=type_key,
+                                    type_val=type_val)
+
+        with rec.span("calibrate", bytes_read=file_size(biaspath)):
+            mdark = yfu.bdf_process(mdark,
+                                    mbiaspath=biaspath,
+                                    dtype=dtype,
+                                    unit=None)
+
+    with rec.span("write") as span:
+        mdark.write(output, output_verify='fix', overwrite=True)
+        span["bytes_written"] = file_size(output)
+    return output, rec.records
+
+
+def _make_flat(fpaths, output, biaspath, darkpath, dtype, comb_kwargs,
+               type_key, type_val, save_bd, geometry, memory_limit,
+               record=False):
+    ''' Subtracts bias and dark from one group of flat frames and
+    combines them after normalizing by the average.
+    '''
+    # Do BD preproc before combine. The BD-processed flats are kept in
+    # memory (or BD is done block by block while combining if streaming),
+    # and saved to ``<stem>_BD.fits`` only if asked.
+    rec = Recorder(record, group=Path(output).name)
+    stream = _streamable(memory_limit, comb_kwargs)
+    flat_bds = []
+    if save_bd or not stream:
+        cache = MasterCache(max_bytes=None)
+        for flat_orig_path in fpaths:
+            flat_orig_path = Path(flat_orig_path)
+            with rec.span("calibrate", frame=str(flat_orig_path),
+                          bytes_read=file_size(flat_orig_path)):
+                ccd = _bd_ccd(flat_orig_path, biaspath, darkpath,
+                              cache=cache, geometry=geometry)
+            if save_bd:
+                flat_bd_path = (flat_orig_path.parent
+                                / (flat_orig_path.stem + "_BD.fits"))
+                with rec.span("write", frame=str(flat_orig_path)) as span:
+                    ccd.write(flat_bd_path, output_verify='fix',
+                              overwrite=True)
+                    span["bytes_written"] = file_size(flat_bd_path)
+            if not stream:
+                flat_bds.append(ccd)
+
+    with rec.span("combine", nframe=len(fpaths)) as span:
+        if stream:
+            if _is_dark_rate(darkpath):
+                subtract, rate = [biaspath], darkpath
+            else:
+                subtract, rate = [biaspath, darkpath], None
+            span["bytes_read"] = _total_size(list(fpaths) + subtract + [rate])
+            stream_combine(fpaths,
+                           output=output,
+                           memory_limit=memory_limit,
+                           dtype=dtype,
+                           normalize_average=True,  # Since skyflat!!
+                           subtract=subtract,
+                           rate=rate,
+                           exptime_key=KEYMAP["EXPTIME"],
+                           geometry=geometry)
+        else:
+            _ = yfu.combine_ccd(flat_bds,
+                                output=output,
+                                dtype=dtype,
+                                **comb_kwargs,
+                                normalize_average=True,  # Since skyflat!!
+                                type_key=type_key,
+                                type_val=type_val)
+        span["bytes_written"] = file_size(output)
+    return output, rec.records
+
+
+# The arguments of the stages which ``Preprocessor.run`` takes for all
+# the stages at once.
+_RUN_KEYS = ["n_jobs", "executor", "resume", "memory_limit", "cache_limit"]
+
+
+def _stage_kwargs(method, plan, kw, name, run_keys=_RUN_KEYS):
+    ''' The items of ``kw`` (e.g., ``bias_kw`` of ``Preprocessor.run``) for
+    ``plan`` (e.g., ``_plan_bias``). ``kw`` must be the arguments of the
+    stage ``method`` (e.g., ``make_bias``) except ``run_keys``; the ones
+    ``plan`` does not need (e.g., ``delimiter`` of ``do_preproc``) are
+    dropped.
+    '''
+    for key in kw:
+        if key in run_keys:
+            raise TypeError(f"{name} cannot have {key!r}: give it to run() "
+                            + "for all the stages.")
+    accepted = inspect.signature(method).parameters
+    unknown = [key for key in kw if key not in accepted or key == "self"]
+    if unknown:
+        raise TypeError(f"{name} has {unknown}, which are not the arguments "
+                        + f"of {method.__name__}.")
+    needed = inspect.signature(plan).parameters
+    return {key: val for key, val in kw.items() if key in needed}
+
+
+def _stage(name):
+    ''' Runs the method as the stage ``name`` of ``self.telemetry``.
+    '''
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.telemetry.session(name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
 
 class Preprocessor():
     def __init__(self, topdir, rawdir, instrument="STX16803",
                  bias_type_key=["OBJECT"], bias_type_val=["bias"],
                  bias_group_key=[],
                  dark_type_key=["OBJECT"], dark_type_val=["dark"],
-                 dark_group_key=["EXPTIME"],
+                 dark_group_key=["EXPTIME"], dark_scalable=False,
+                 dark_rate_group_key=["SET-TEMP"],
                  flat_type_key=["OBJECT"], flat_type_val=["skyflat"],
                  flat_group_key=["FILTER"],
-                 summary_keywords=USEFUL_KEYS):
+                 summary_keywords=USEFUL_KEYS, summary_format="csv",
+                 master_library=None, telemetry=None, geometry=None,
+                 match_tol=None):
         """
         Parameters
         ----------
@@ -60,8 +608,58 @@ class Preprocessor():
             choice can be ``['EXPTIME']``, and for flat frames,
             ``["FILTER"]``.
 
+        dark_scalable : bool, optional
+            If ``True``, each master dark is the bias-subtracted dark
+            current rate (per second) of the dark frames grouped by
+            ``dark_rate_group_key`` (instead of ``dark_group_key``), and it
+            is scaled by the EXPTIME of each frame to be calibrated. So the
+            darks of every EXPTIME are not needed. Note that the rate is
+            the median of the rates of the frames, i.e., not weighted by
+            their EXPTIME: the short darks (whose rates are the noisiest,
+            as the read noise is divided by the short EXPTIME) count as
+            much as the long ones. Use mostly long darks for the rate.
+
+        dark_rate_group_key : str or list of str, optional
+            The header keywords to group the dark frames if
+            ``dark_scalable``, e.g., ``["SET-TEMP"]`` or ``["CCD-TEMP"]``.
+
         summary_keywords : list of str, optional
             The keywords of the header to be used for the summary table.
+
+        summary_format : str, optional
+            The format of the summary tables to be read first when
+            reloaded: ``"csv"``, ``"parquet"``, or ``"feather"`` (the
+            latter two need pyarrow). In any case, the columns have the
+            dtypes of ``~.utils.SUMMARY_SCHEMA`` and the CSV files
+            (``summary_raw.csv`` and ``summary_reduced.csv``) are saved as
+            an export.
+
+        master_library : `~snuo1mpy.nights.MasterLibrary` or None, optional
+            If given, a frame whose bias (dark, flat) group has no master
+            in this night is calibrated by the nearest valid master in the
+            library, rather than processed without it.
+
+        telemetry : `~snuo1mpy.telemetry.Telemetry` or None, optional
+            If given, the time and bytes of each sub-step (header read,
+            rename, combine, calibrate, write, summary, ...) of each frame
+            and calibration group are recorded to it, including those done
+            by the worker processes.
+
+        geometry : dict or None, optional
+            The detector geometry to update that of ``instrument`` in
+            `~snuo1mpy.utils.GEOMETRY`, e.g., ``dict(trimsec="[21:4076,
+            21:4076]")`` or ``dict(biassec=..., trimsec=...)``. If it has
+            TRIMSEC (BIASSEC), only the science region is read, combined
+            and calibrated (the overscan level of each raw frame is
+            subtracted), for the masters and the object frames alike.
+
+        match_tol : dict or None, optional
+            The tolerances to update `~snuo1mpy.matching.TOLERANCES`,
+            e.g., ``{"CCD-TEMP": 2., "DATE-OBS": 1.}``. The numeric values
+            of ``xxxx_group_key`` closer than these are grouped together,
+            and a frame is calibrated by the nearest master within them
+            (see `~snuo1mpy.matching.MasterIndex`), e.g., a frame of
+            EXPTIME 30.0001 by the dark of 30.
         """
         topdir = Path(topdir)
         self.topdir = topdir  # e.g., Path('180412')
@@ -71,6 +669,22 @@ class Preprocessor():
         self.rawpaths = list(Path(rawdir).glob('*.fit'))
         self.rawpaths.sort()
         self.summary_keywords = summary_keywords
+        if summary_format not in SUMMARY_FORMATS:
+            raise ValueError("summary_format must be one of "
+                             + f"{list(SUMMARY_FORMATS)}.")
+        self.summary_format = summary_format
+        self.master_library = master_library
+        geometry = dict(GEOMETRY.get(instrument, {}),
+                        **({} if geometry is None else geometry))
+        if (geometry.get("trimsec") is None
+                and geometry.get("biassec") is None):
+            geometry = None  # the whole frame as it is
+        self.geometry = geometry
+        self.match_tol = dict(TOLERANCES,
+                              **({} if match_tol is None else match_tol))
+        if telemetry is None:
+            telemetry = Telemetry(enabled=False)
+        self.telemetry = telemetry
         self.newpaths = None
         self.summary_raw = None
         self.summary_red = None
@@ -79,12 +693,22 @@ class Preprocessor():
         self.biaspaths = None
         self.darkpaths = None
         self.flatpaths = None
+        self.manifest = Manifest(self.listdir / "manifest.json")
+        self.catalog = Catalog(self.listdir / "catalog.sqlite")
         # rawpaths: Original file paths
         # newpaths: Renamed paths
         # bias/dark/flatpaths: the dict that contains the paths to B/D/F.
         #   The keys of dict will be B/D/F_group_key and values will be the
         #   corresponding header values. These keys are NOT _group_key !!!
         #   (see below for the differences of _key and _group_key)
+        # manifest: the record of the inputs & parameters of each output,
+        #   used to skip the up-to-date outputs when ``resume=True``.
+        # catalog: the SQLite store of the paths, B/D/F paths and the
+        #   summaries, from which ``initialize_self`` reloads them.
+
+        self.dark_scalable = dark_scalable
+        if dark_scalable:
+            dark_group_key = dark_rate_group_key
 
         if not set(bias_group_key).issubset(set(dark_group_key)):
             raise KeyError(
@@ -95,7 +719,8 @@ class Preprocessor():
                 "bias_grouped_key must be a subset of flat_group_key.")
 
         _exptime_keys = ["EXPTIME", "EXPOSURE", "EXPOS"]
-        if len(set(_exptime_keys).intersection(set(dark_group_key))) == 0:
+        _has_exptime = set(_exptime_keys).intersection(set(dark_group_key))
+        if not dark_scalable and len(_has_exptime) == 0:
             warn("dark_group_key does not seem to contain exposure time!")
 
         # xyz = <bias/dark/flat> <type/group> <key/value>, e.g., btk.
@@ -125,63 +750,128 @@ class Preprocessor():
 
     def initialize_self(self):
         ''' Initialization may convenient when process was halted amid.
+        Everything is read from ``self.catalog``, or from the pickles and
+        CSVs of the previous versions if it is not in the catalog.
         '''
         if self.summary_red is None:
-            try:
-                self.summary_red = pd.read_csv(
-                    str(self.topdir / "summary_reduced.csv"))
+            self.summary_red = self._load_summary("reduced")
+            if self.summary_red is not None:
                 self.reducedpaths = self.summary_red["file"].tolist()
-            except FileNotFoundError:
-                pass
 
         if self.summary_raw is None:
-            try:
-                self.summary_raw = pd.read_csv(
-                    str(self.topdir / "summary_raw.csv"))
+            self.summary_raw = self._load_summary("raw")
+            if self.summary_raw is not None:
                 self.newpaths = self.summary_raw["file"].tolist()
-            except FileNotFoundError:
-                pass
 
         if self.newpaths is None:
-            try:
-                with open(self.listdir / "newpaths.pkl", 'rb') as pkl:
-                    self.newpaths = pickle.load(pkl)
-            except FileNotFoundError:
-                pass
+            self.newpaths = self.catalog.get_paths("new")
 
         if self.objpaths is None:
-            try:
-                with open(self.listdir / "objpaths.pkl", 'rb') as pkl:
-                    self.objpaths = pickle.load(pkl)
-            except FileNotFoundError:
-                pass
+            self.objpaths = self.catalog.get_paths("obj")
 
-        if self.biaspaths is None:
-            try:
-                with open(self.listdir / "biaspaths.pkl", 'rb') as pkl:
-                    self.biaspaths = pickle.load(pkl)
-            except FileNotFoundError:
-                pass
+        for kind in ["bias", "dark", "flat"]:
+            if getattr(self, f"{kind}paths") is None:
+                setattr(self, f"{kind}paths", self.catalog.get_masters(kind))
 
-        if self.darkpaths is None:
+        self._initialize_legacy()
+
+    def _initialize_legacy(self):
+        ''' Reads what is still ``None`` from the pickles and CSVs, which
+        were used instead of ``self.catalog`` before.
+        '''
+        if self.summary_red is None:
             try:
-                with open(self.listdir / "darkpaths.pkl", 'rb') as pkl:
-                    self.darkpaths = pickle.load(pkl)
+                self.summary_red = read_summary(
+                    self.topdir / "summary_reduced.csv")
+                self.reducedpaths = self.summary_red["file"].tolist()
             except FileNotFoundError:
                 pass
 
-        if self.flatpaths is None:
+        if self.summary_raw is None:
             try:
-                with open(self.listdir / "flatpaths.pkl", 'rb') as pkl:
-                    self.flatpaths = pickle.load(pkl)
+                self.summary_raw = read_summary(
+                    self.topdir / "summary_raw.csv")
+                self.newpaths = self.summary_raw["file"].tolist()
             except FileNotFoundError:
                 pass
 
+        for attr in ["newpaths", "objpaths",
+                     "biaspaths", "darkpaths", "flatpaths"]:
+            if getattr(self, attr) is None:
+                try:
+                    with open(self.listdir / f"{attr}.pkl", 'rb') as pkl:
+                        setattr(self, attr, pickle.load(pkl))
+                except FileNotFoundError:
+                    pass
+
+    def _summary_path(self, stage):
+        ext = SUMMARY_FORMATS[self.summary_format]
+        return self.topdir / f"summary_{stage}{ext}"
+
+    def _store_summary(self, stage, table):
+        ''' Applies the schema to the summary of ``stage`` (``"raw"`` or
+        ``"reduced"``) and saves it to the catalog (and the columnar file
+        if ``self.summary_format`` is not CSV).
+        '''
+        table = apply_schema(table)
+        self.catalog.set_summary(stage, table)
+        if self.summary_format != "csv":
+            write_summary(table, self._summary_path(stage),
+                          fmt=self.summary_format)
+        return table
+
+    def _load_summary(self, stage):
+        if self.summary_format != "csv":
+            path = self._summary_path(stage)
+            if path.exists():
+                return read_summary(path, fmt=self.summary_format)
+        table = self.catalog.get_summary(stage)
+        return None if table is None else apply_schema(table)
+
+    def _match_masters(self, table, kind):
+        ''' The keys of ``self.<kind>paths`` of the master for each row.
+        Parameters
+        ----------
+        table : pandas.DataFrame
+            The summary table, e.g., ``self.summary_raw``.
+
+        kind : str
+            One of ``"bias"``, ``"dark"``, ``"flat"``.
+
+        Returns
+        -------
+        keys : pandas.Series
+            The key of the nearest master within ``self.match_tol`` (see
+            `~snuo1mpy.matching.MasterIndex`), or ``None``, with the
+            index of ``table``.
+        '''
+        index = MasterIndex(getattr(self, f"{kind}paths") or {},
+                            type_val=getattr(self, f"{kind}_type_val"),
+                            group_key=getattr(self, f"{kind}_group_key"),
+                            tolerances=self.match_tol)
+        return pd.Series(index.match(table), index=table.index,
+                         dtype=object)
+
+    def _master_path(self, kind, key, row):
+        ''' The key and path of the master of ``kind`` for a frame (``row``
+        of the summary) with the ``key`` found by ``_match_masters``. If it
+        is ``None``, the master is found by ``_missing_master`` (and the
+        key is that of the frame itself).
+        '''
+        if key is not None:
+            return key, getattr(self, f"{kind}paths")[key]
+        key = (tuple(getattr(self, f"{kind}_type_val"))
+               + tuple(row[getattr(self, f"{kind}_group_key")].tolist()))
+        return key, self._missing_master(kind, key, row)
+
+    @_stage("organize")
     def organize_raw(self,
                      rename_by=["OBSCAM", "OBJECT", "XBINNING", "YBINNING",
                                 "YMD-HMS", "FILTER", "EXPTIME"],
                      mkdir_by=["OBJECT"], delimiter='-',
-                     archive_dir=None, verbose=False):
+                     archive_dir=None, verbose=False,
+                     fast_scan=True, n_jobs=1, batch_airmass=False,
+                     resume=False):
         ''' Rename FITS files after updating theur headers.
         Parameters
         ----------
@@ -202,6 +892,33 @@ class Preprocessor():
             original file will remain there. Deleting original FITS is
             dangerous so it is only supported to move the files. You may
             delete files manually if needed.
+
+        fast_scan : bool, optional
+            If ``True`` (default), the headers of all the raw files are
+            read at once (only the header blocks are read) before the
+            renaming, and the same header objects are used for the
+            renaming and for ``summary_raw``. Otherwise, the headers are
+            read from the files by astropy at each of these steps.
+
+        n_jobs : int or None, optional
+            The number of threads to read the headers when ``fast_scan``
+            is ``True``. ``None`` or ``-1`` means the number of CPUs.
+
+        batch_airmass : bool, optional
+            If ``True``, the airmass of all the frames (except bias and
+            dark) are calculated at once by
+            `~snuo1mpy.airmass.airmass_headers` after all the headers are
+            updated, rather than calling ``ysfitsutilpy.airmass_from_hdr``
+            for each frame. The AIRMASS agrees within 1.e-6 (relative).
+            The same AIRMASS, ALT/AZ/ZD (and their ``_MID``/``_END``),
+            COMMENT and HISTORY cards are written, but not the RA, DEC
+            and RADECSYS some versions of ``airmass_from_hdr`` add.
+
+        resume : bool, optional
+            If ``True``, the raw files renamed in the previous runs are
+            not processed again unless they (or the renamed files) have
+            changed or the renaming parameters differ. Frames moved to
+            ``archive_dir`` in the previous runs are also kept.
         '''
 
         newpaths = []
@@ -218,7 +935,32 @@ class Preprocessor():
         # NOTE: it is better to give the filename a higher priority because
         #   it is easier to change filename than FITS header.
 
-        for fpath in self.rawpaths:
+        params = dict(rename_by=rename_by, mkdir_by=mkdir_by,
+                      delimiter=delimiter, instrument=self.instrument)
+        renamed = {}  # {raw path: (new path, new header, obj)}
+        if resume:
+            # The raw file may have been moved to archive_dir.
+            for key in self.manifest.keys("organize:"):
+                rawpath = Path(key[len("organize:"):])
+                if self.manifest.is_fresh(key, [rawpath], params,
+                                          check_inputs=rawpath.exists()):
+                    newpath = self.manifest.outputs(key)[0]
+                    newhdr = read_header(newpath)
+                    renamed[rawpath] = (newpath, newhdr,
+                                        newhdr[KEYMAP["OBJECT"]])
+        rawpaths = [fpath for fpath in self.rawpaths if fpath not in renamed]
+
+        headers = {}
+        todo = []  # (fpath, hdr, cards_to_add, obj) to be renamed
+        if fast_scan:
+            # Dummy-named files are moved to useless, so no need to read.
+            scanpaths = [fpath for fpath in rawpaths
+                         if not fpath.name.startswith("CCD Image")]
+            with self.telemetry.span("header read", nframe=len(scanpaths)):
+                headers = dict(zip(scanpaths,
+                                   scan_headers(scanpaths, n_jobs=n_jobs)))
+
+        for fpath in rawpaths:
             if fpath.name.startswith("CCD Image"):
                 # The image not taken correctly are saved as dummy name
                 # "CCD Image xxx.fit". It is user's fault to have this
@@ -232,7 +974,12 @@ class Preprocessor():
                 # Use `rsplit` because sometimes there are objnames like
                 # `sa101-100`, i.e., includes the hyphen.
                 # filt_or_bd : B/V/R/I/Ha/Sii/Oiii or bias/dkXX (XX=EXPTIME)
-                hdr = fits.getheader(fpath)
+                if fast_scan:
+                    hdr = headers[fpath]
+                else:
+                    with self.telemetry.span("header read",
+                                             frame=str(fpath)):
+                        hdr = fits.getheader(fpath)
                 sp = fpath.name.rsplit('-')
                 if len(sp) == 1:
                     sp = fpath.name.rsplit('_')
@@ -298,7 +1045,7 @@ class Preprocessor():
                 cards_to_add.append(Card("BUNIT", "ADU", "Pixel value unit"))
 
             # Calculate airmass except for bias/dark
-            if obj not in ["bias", "dark"]:
+            if obj not in ["bias", "dark"] and not batch_airmass:
                 # FYI: flat require airmass just for check (twilight/night)
                 try:
                     hdr = yfu.airmass_from_hdr(hdr,
@@ -319,6 +1066,31 @@ class Preprocessor():
                         print(f"{fpath} failed in airmass calculation: "
                               + "KeyError")
 
+            todo.append((fpath, hdr, cards_to_add, obj))
+
+        if batch_airmass:
+            # FYI: flat require airmass just for check (twilight/night)
+            am_todo = [item for item in todo
+                       if item[3] not in ["bias", "dark"]]
+            failed = _airmass.airmass_headers(
+                [item[1] for item in am_todo],
+                ra_key="OBJCTRA",
+                dec_key="OBJCTDEC",
+                ut_key=KEYMAP["DATE-OBS"],
+                exptime_key=KEYMAP["EXPTIME"],
+                lon_key="SITELONG",
+                lat_key="SITELAT",
+                height_key="HEIGHT",
+                equinox="J2000",
+                frame='icrs',
+                height=147
+            )
+            if verbose:
+                for i in failed:
+                    print(f"{am_todo[i][0]} failed in airmass calculation: "
+                          + "KeyError")
+
+        for fpath, hdr, cards_to_add, obj in todo:
             datetime = Time(hdr[KEYMAP["DATE-OBS"]]).strftime("%Y%m%d-%H%M%S")
             obscam = f"SNUO_{self.instrument}"
 
@@ -329,50 +1101,305 @@ class Preprocessor():
 
             add_hdr = fits.Header(cards_to_add)
 
-            newpath = yfu.fitsrenamer(fpath,
-                                      header=hdr,
-                                      rename_by=rename_by,
-                                      delimiter=delimiter,
-                                      add_header=add_hdr,
-                                      mkdir_by=mkdir_by,
-                                      archive_dir=archive_dir,
-                                      key_deprecation=True,
-                                      keymap=KEYMAP,
-                                      verbose=verbose)
-
+            # the raw file may be moved by fitsrenamer:
+            raw_sig = self.manifest.signatures([fpath])
+            with self.telemetry.span("rename", frame=str(fpath),
+                                     bytes_read=file_size(fpath)) as span:
+                newpath = yfu.fitsrenamer(fpath,
+                                          header=hdr,
+                                          rename_by=rename_by,
+                                          delimiter=delimiter,
+                                          add_header=add_hdr,
+                                          mkdir_by=mkdir_by,
+                                          archive_dir=archive_dir,
+                                          key_deprecation=True,
+                                          keymap=KEYMAP,
+                                          verbose=verbose)
+                span["bytes_written"] = file_size(newpath)
+
+            newhdr = hdr.copy()
+            newhdr.extend(add_hdr, update=True)
+            renamed[fpath] = (newpath, newhdr, obj)
+            self.manifest.record(f"organize:{fpath}",
+                                 inputs=[fpath],
+                                 outputs=[newpath],
+                                 params=params,
+                                 input_sigs=raw_sig)
+
+        self.manifest.save()
+
+        newheaders = []
+        for fpath in sorted(renamed):
+            newpath, newhdr, obj = renamed[fpath]
             newpaths.append(newpath)
+            newheaders.append(newhdr)
             if obj not in ["flat", "skyflat", "domeflat", "bias", "dark"]:
                 objpaths.append(newpath)
 
         # Save list of file paths for future use.
-        # It doesn't take much storage and easy to erase if you want.
-        with open(self.listdir / 'newpaths.list', 'w+') as ll:
-            for p in newpaths:
-                ll.write(f"{str(p)}\n")
+        rawpaths = sorted(renamed)
+        self.catalog.set_paths("raw", rawpaths)
+        self.catalog.set_paths("new", newpaths, sources=rawpaths)
+        self.catalog.set_paths("obj", objpaths)
 
-        with open(self.listdir / 'objpaths.list', 'w+') as ll:
-            for p in objpaths:
-                ll.write(f"{str(p)}\n")
+        self.newpaths = newpaths
+        self.objpaths = objpaths
+        with self.telemetry.span("summary", stage="raw",
+                                 nframe=len(newpaths)):
+            if fast_scan:
+                self.summary_raw = summary_from_headers(
+                    newpaths,
+                    newheaders,
+                    keywords=self.summary_keywords,
+                    output=self.topdir/"summary_raw.csv"
+                )
+            else:
+                self.summary_raw = yfu.make_summary(
+                    newpaths,
+                    output=self.topdir/"summary_raw.csv",
+                    keywords=self.summary_keywords,
+                    pandas=True,
+                    verbose=verbose
+                )
+            self.summary_raw = self._store_summary("raw", self.summary_raw)
+
+    def _plan_bias(self, savedir, delimiter='-', dtype='float32',
+                   comb_kwargs=MEDCOMB_KEYS, resume=False):
+        ''' Finds the bias groups and what to do for each of them.
+        Returns
+        -------
+        biaspaths : dict
+            The paths to the master bias frames (to be made).
+
+        jobs : list of dict
+            The groups to be combined, i.e., those not up to date in
+            ``self.manifest`` (if ``resume``). Each has ``"key"``,
+            ``"inputs"``, ``"output"``, ``"params"`` for the manifest and
+            ``"args"`` for ``_make_bias``.
+        '''
+        biaspaths = {}
+        jobs = []
+        # For simplicity, crop the original data by type_key and
+        # type_val first.
+        st = self.summary_raw.copy()
+        for k, v in zip(self.bias_type_key, self.bias_type_val):
+            st = st[st[k] == v]
+        st = snap_groups(st, self.bias_group_key, self.match_tol)
 
-        # Python specific pickle
-        with open(self.listdir / 'newpaths.pkl', 'wb') as pkl:
-            pickle.dump(newpaths, pkl)
+        # For grouping, use _key (i.e., type_key + group_key). This is
+        # because (1) it is not harmful cuz type_key will have unique
+        # column values as ``st`` has already been cropped in above for
+        # loop (2) by doing this we get more information from combining
+        # process because, e.g., "images with ["OBJECT", "EXPTIME"] =
+        # ["dark", 1.0] are loaded" will be printed rather than just
+        # "images with ["EXPTIME"] = [1.0] are loaded".
+        gs = st.groupby(self.bias_key)
 
-        with open(self.listdir / 'objpaths.pkl', 'wb') as pkl:
-            pickle.dump(objpaths, pkl)
+        for bias_val, bias_group in gs:
+            if not isinstance(bias_val, tuple):
+                bias_val = tuple([str(bias_val)])
+            fname = delimiter.join([str(x) for x in bias_val]) + ".fits"
+            fpath = Path(savedir) / fname
+            biaspaths[tuple(bias_val)] = fpath
+            inputs = bias_group["file"].tolist()
+            params = self._params(dtype=dtype, comb_kwargs=comb_kwargs)
+            key = f"bias:{fpath}"
+            if resume and self.manifest.is_fresh(key, inputs, params):
+                continue
+            args = (inputs, fpath, dtype, comb_kwargs,
+                    self.bias_key, bias_val, self.geometry)
+            jobs.append(dict(key=key, inputs=inputs, output=fpath,
+                             params=params, args=args))
+        return biaspaths, jobs
+
+    def _plan_dark(self, savedir, do_bias=True, mbiaspath=None,
+                   dtype='float32', delimiter='-', comb_kwargs=MEDCOMB_KEYS,
+                   resume=False):
+        ''' Finds the dark groups and what to do for each of them.
+        See ``_plan_bias`` for the returned values.
+        '''
+        darkpaths = {}
+        jobs = []
+        # For simplicity, crop the original data by type_key and
+        # type_val first.
+        st = self.summary_raw.copy()
+        for k, v in zip(self.dark_type_key, self.dark_type_val):
+            st = st[st[k] == v]
+        # The near-equal values (e.g., EXPTIME) are in the same group.
+        st = snap_groups(st, self.dark_group_key, self.match_tol)
 
-        self.newpaths = newpaths
-        self.objpaths = objpaths
-        self.summary_raw = yfu.make_summary(
-            newpaths,
-            output=self.topdir/"summary_raw.csv",
-            keywords=self.summary_keywords,
-            pandas=True,
-            verbose=verbose
-        )
+        # For grouping, use _key (i.e., type_key + group_key). See
+        # ``_plan_bias``.
+        gs = st.groupby(self.dark_key)
+        if mbiaspath is None and do_bias:
+            bias_keys = self._match_masters(st, "bias")
 
+        for dark_val, dark_group in gs:
+            if not isinstance(dark_val, tuple):
+                dark_val = tuple([dark_val])
+            fname = delimiter.join([str(x) for x in dark_val]) + ".fits"
+            fpath = Path(savedir) / fname
+            darkpaths[tuple(dark_val)] = fpath
+
+            # set path to master bias
+            biaspath = None
+            if mbiaspath is not None:
+                biaspath = mbiaspath
+            elif do_bias:
+                # the master bias of the first frame of the group:
+                row = dark_group.iloc[0]
+                _, biaspath = self._master_path(
+                    "bias", bias_keys[dark_group.index[0]], row)
+
+            inputs = dark_group["file"].tolist() + [biaspath]
+            params = self._params(dtype=dtype, comb_kwargs=comb_kwargs)
+            if self.dark_scalable:
+                params["scalable"] = True
+            key = f"dark:{fpath}"
+            if resume and self.manifest.is_fresh(key, inputs, params):
+                continue
+            args = (dark_group["file"].tolist(), fpath, biaspath, dtype,
+                    comb_kwargs, self.dark_key, dark_val, self.dark_scalable,
+                    self.geometry)
+            jobs.append(dict(key=key, inputs=inputs, output=fpath,
+                             params=params, args=args))
+        return darkpaths, jobs
+
+    def _plan_flat(self, savedir, do_bias=True, do_dark=True,
+                   mbiaspath=None, mdarkpath=None, comb_kwargs=MEDCOMB_KEYS,
+                   delimiter='-', dtype='float32', resume=False,
+                   save_bd=False):
+        ''' Finds the flat groups and what to do for each of them.
+        See ``_plan_bias`` for the returned values.
+        '''
+        flatpaths = {}
+        jobs = []
+        # For simplicity, crop the original data by type_key and
+        # type_val first.
+        st = self.summary_raw.copy()
+        for k, v in zip(self.flat_type_key, self.flat_type_val):
+            st = st[st[k] == v]
+        st = snap_groups(st, self.flat_group_key, self.match_tol)
+
+        # For grouping, use type_key + group_key. See ``_plan_bias``.
+        gs = st.groupby(self.flat_key)
+        if mbiaspath is None and do_bias:
+            bias_keys = self._match_masters(st, "bias")
+        if mdarkpath is None and do_dark:
+            dark_keys = self._match_masters(st, "dark")
+
+        for flat_val, flat_group in gs:
+            biaspath = None
+            darkpath = None
+            # set path to master bias
+            if mbiaspath is not None:
+                biaspath = mbiaspath
+            elif do_bias:
+                # the master bias of the first frame of the group:
+                _, biaspath = self._master_path(
+                    "bias", bias_keys[flat_group.index[0]],
+                    flat_group.iloc[0])
+
+            # set path to master dark
+            if mdarkpath is not None:
+                darkpath = mdarkpath
+            elif do_dark:
+                # the master dark of the first frame of the group:
+                _, darkpath = self._master_path(
+                    "dark", dark_keys[flat_group.index[0]],
+                    flat_group.iloc[0])
+
+            if not isinstance(flat_val, tuple):
+                flat_val = tuple([flat_val])
+            fname = delimiter.join([str(x) for x in flat_val]) + ".fits"
+            fpath = Path(savedir) / fname
+            flatpaths[tuple(flat_val)] = fpath
+
+            inputs = flat_group["file"].tolist() + [biaspath, darkpath]
+            params = self._params(dtype=dtype, comb_kwargs=comb_kwargs)
+            key = f"flat:{fpath}"
+            if resume and self.manifest.is_fresh(key, inputs, params):
+                continue
+            args = (flat_group["file"].tolist(), fpath, biaspath, darkpath,
+                    dtype, comb_kwargs, self.flat_key, flat_val, save_bd,
+                    self.geometry)
+            jobs.append(dict(key=key, inputs=inputs, output=fpath,
+                             params=params, args=args))
+        return flatpaths, jobs
+
+    def _params(self, **params):
+        ''' The parameters of an output for the manifest, with the
+        geometry if the frames are trimmed (so that the outputs made
+        without it are not "fresh").
+        '''
+        if self.geometry is not None:
+            params["geometry"] = self.geometry
+        return params
+
+    def _missing_master(self, kind, key, row):
+        ''' The master of ``kind`` for a frame (``row`` of the summary) of
+        which group ``key`` has no master in this night: the nearest one in
+        ``self.master_library``, or ``None`` (processed without it).
+        '''
+        path = None
+        if self.master_library is not None:
+            path = self.master_library.nearest(kind, row, self.instrument)
+        if path is None:
+            warn(f"{kind.capitalize()} not available for {key}. "
+                 + f"Processing without {kind}.")
+        else:
+            warn(f"{kind.capitalize()} not available for {key}. "
+                 + f"Using {path} from the master library.")
+        return path
+
+    def _run_master_jobs(self, func, jobs, n_jobs=1, executor=None,
+                         memory_limit=None):
+        ''' Makes the masters of ``jobs`` (from ``_plan_xxx``) by ``func``
+        (one of ``_make_bias``, ``_make_dark``, ``_make_flat``) and records
+        each of them to the manifest as soon as it is finished.
+        '''
+        if memory_limit is not None and jobs:
+            # The groups combined at the same time share the memory.
+            nworker = min(n_workers(n_jobs), len(jobs))
+            memory_limit = memory_limit // nworker
+        run_jobs(func,
+                 [job["args"] + (memory_limit, self.telemetry.enabled)
+                  for job in jobs],
+                 n_jobs=n_jobs,
+                 executor=executor,
+                 callback=lambda i, result: self._finish_job(jobs[i],
+                                                             result))
+
+    def _finish_job(self, job, result):
+        ''' Emits the telemetry of a finished job (``result`` is the output
+        path and the records) and records it to the manifest at once, so
+        that it is not done again even if a later job fails.
+        '''
+        self.telemetry.emit(result[1])
+        self._record_job(job)
+
+    def _record_job(self, job):
+        ''' Records a finished ``job`` to the manifest and saves it.
+        '''
+        self.manifest.record(job["key"], job["inputs"], [job["output"]],
+                             job["params"])
+        if job.get("extract") is not None:
+            # The xylist made in the same task (see ``_preproc_frame``)
+            xkey, xypath, extract_kw = job["extract"]
+            self.manifest.record(xkey, [job["output"]], [xypath],
+                                 extract_kw)
+        self.manifest.save()
+
+    def _save_paths(self, kind, paths):
+        ''' Saves (to ``self.catalog``) and sets ``self.<kind>paths``.
+        '''
+        self.catalog.set_masters(kind, paths)
+        setattr(self, f"{kind}paths", paths)
+
+    @_stage("bias")
     def make_bias(self, savedir=None, delimiter='-', dtype='float32',
-                  comb_kwargs=MEDCOMB_KEYS):
+                  comb_kwargs=MEDCOMB_KEYS, resume=False, memory_limit=None,
+                  n_jobs=1, executor=None):
         ''' Finds and make bias frames.
         Parameters
         ----------
@@ -389,6 +1416,27 @@ class Preprocessor():
 
         comb_kwargs: dict or None, optional.
             The parameters for `~ysfitsutilpy.combine_ccd`.
+
+        resume : bool, optional
+            If ``True``, the master frames whose inputs and parameters have not
+            changed since the previous run (see ``self.manifest``) are not
+            made again.
+
+        memory_limit : int or None, optional
+            If given, the frames are median-combined by
+            `~snuo1mpy.combine.stream_combine` using about this much memory
+            (in bytes) rather than loading all the frames of a group at
+            once by ``combine_ccd``. Only possible if ``comb_kwargs`` is
+            a median combine without rejection (e.g., ``MEDCOMB_KEYS``).
+            If ``n_jobs > 1``, it is shared by the workers.
+
+        n_jobs : int or None, optional
+            The number of processes to combine the groups (e.g., of
+            different ``bias_group_key`` values) concurrently. ``1``
+            (default) combines them one by one in this process.
+
+        executor : `~concurrent.futures.Executor` or None, optional
+            If given, it is used instead of making a new process pool.
         '''
         # Initial settings
         self.initialize_self()
@@ -397,49 +1445,21 @@ class Preprocessor():
             savedir = self.topdir
 
         yfu.mkdir(Path(savedir))
-        biaspaths = {}
-        # For simplicity, crop the original data by type_key and
-        # type_val first.
-        st = self.summary_raw.copy()
-        for k, v in zip(self.bias_type_key, self.bias_type_val):
-            st = st[st[k] == v]
-
-        # For grouping, use _key (i.e., type_key + group_key). This is
-        # because (1) it is not harmful cuz type_key will have unique
-        # column values as ``st`` has already been cropped in above for
-        # loop (2) by doing this we get more information from combining
-        # process because, e.g., "images with ["OBJECT", "EXPTIME"] =
-        # ["dark", 1.0] are loaded" will be printed rather than just
-        # "images with ["EXPTIME"] = [1.0] are loaded".
-        gs = st.groupby(self.bias_key)
-
+        biaspaths, jobs = self._plan_bias(savedir,
+                                          delimiter=delimiter,
+                                          dtype=dtype,
+                                          comb_kwargs=comb_kwargs,
+                                          resume=resume)
         # Do bias combine:
-        for bias_val, bias_group in gs:
-            if not isinstance(bias_val, tuple):
-                bias_val = tuple([str(bias_val)])
-            fname = delimiter.join([str(x) for x in bias_val]) + ".fits"
-            fpath = Path(savedir) / fname
-            _ = yfu.combine_ccd(bias_group["file"].tolist(),
-                                output=fpath,
-                                dtype=dtype,
-                                **comb_kwargs,
-                                type_key=self.bias_key,
-                                type_val=bias_val)
-            biaspaths[tuple(bias_val)] = fpath
+        self._run_master_jobs(_make_bias, jobs, n_jobs=n_jobs,
+                              executor=executor, memory_limit=memory_limit)
 
-        # Save list of file paths for future use.
-        # It doesn't take much storage and easy to erase if you want.
-        with open(self.listdir / 'biaspaths.list', 'w+') as ll:
-            for p in list(biaspaths.values()):
-                ll.write(f"{str(p)}\n")
-
-        with open(self.listdir / 'biaspaths.pkl', 'wb') as pkl:
-            pickle.dump(biaspaths, pkl)
-
-        self.biaspaths = biaspaths
+        self._save_paths("bias", biaspaths)
 
+    @_stage("dark")
     def make_dark(self, savedir=None, do_bias=True, mbiaspath=None,
-                  dtype='float32', delimiter='-', comb_kwargs=MEDCOMB_KEYS):
+                  dtype='float32', delimiter='-', comb_kwargs=MEDCOMB_KEYS,
+                  resume=False, memory_limit=None, n_jobs=1, executor=None):
         """ Makes and saves dark (bias subtracted) images.
         Parameters
         ----------
@@ -465,6 +1485,27 @@ class Preprocessor():
 
         comb_kwargs : dict or None, optional
             The parameters for ``combine_ccd``.
+
+        resume : bool, optional
+            If ``True``, the master frames whose inputs and parameters have not
+            changed since the previous run (see ``self.manifest``) are not
+            made again.
+
+        memory_limit : int or None, optional
+            If given, the frames are median-combined by
+            `~snuo1mpy.combine.stream_combine` using about this much memory
+            (in bytes) rather than loading all the frames of a group at
+            once by ``combine_ccd``. Only possible if ``comb_kwargs`` is
+            a median combine without rejection (e.g., ``MEDCOMB_KEYS``).
+            If ``n_jobs > 1``, it is shared by the workers.
+
+        n_jobs : int or None, optional
+            The number of processes to combine the groups (e.g., of
+            different EXPTIME) concurrently. ``1`` (default) combines them
+            one by one in this process.
+
+        executor : `~concurrent.futures.Executor` or None, optional
+            If given, it is used instead of making a new process pool.
         """
         # Initial settings
         self.initialize_self()
@@ -473,76 +1514,25 @@ class Preprocessor():
             savedir = self.topdir
 
         yfu.mkdir(Path(savedir))
-        darkpaths = {}
-
-        # For simplicity, crop the original data by type_key and
-        # type_val first.
-        st = self.summary_raw.copy()
-        for k, v in zip(self.dark_type_key, self.dark_type_val):
-            st = st[st[k] == v]
-
-        # For grouping, use _key (i.e., type_key + group_key). This is
-        # because (1) it is not harmful cuz type_key will have unique
-        # column values as ``st`` has already been cropped in above for
-        # loop (2) by doing this we get more information from combining
-        # process because, e.g., "images with ["OBJECT", "EXPTIME"] =
-        # ["dark", 1.0] are loaded" will be printed rather than just
-        # "images with ["EXPTIME"] = [1.0] are loaded".
-        gs = st.groupby(self.dark_key)
-
+        darkpaths, jobs = self._plan_dark(savedir,
+                                          do_bias=do_bias,
+                                          mbiaspath=mbiaspath,
+                                          dtype=dtype,
+                                          delimiter=delimiter,
+                                          comb_kwargs=comb_kwargs,
+                                          resume=resume)
         # Do dark combine:
-        for dark_val, dark_group in gs:
-            if not isinstance(dark_val, tuple):
-                dark_val = tuple([dark_val])
-            fname = delimiter.join([str(x) for x in dark_val]) + ".fits"
-            fpath = Path(savedir) / fname
+        self._run_master_jobs(_make_dark, jobs, n_jobs=n_jobs,
+                              executor=executor, memory_limit=memory_limit)
 
-            mdark = yfu.combine_ccd(dark_group["file"].tolist(),
-                                    output=None,
-                                    dtype=dtype,
-                                    **comb_kwargs,
-                                    type_key=self.dark_key,
-                                    type_val=dark_val)
-
-            # set path to master bias
-            if mbiaspath is not None:
-                biaspath = mbiaspath
-            elif do_bias:
-                # corresponding key for biaspaths:
-                corr_bias = tuple(self.bias_type_val)
-                # if _group_key not empty, add appropriate ``group_val``:
-                if self.bias_group_key:
-                    corr_bias += tuple(dark_group[self.bias_group_key].iloc[0])
-                # else: empty. path is fully specified by _type_val.
-                try:
-                    biaspath = self.biaspaths[corr_bias]
-                except KeyError:
-                    biaspath = None
-                    warn(f"Bias not available for {corr_bias}. "
-                         + "Processing without bias.")
-
-            mdark = yfu.bdf_process(mdark,
-                                    mbiaspath=biaspath,
-                                    dtype=dtype,
-                                    unit=None)
-
-            mdark.write(fpath, output_verify='fix', overwrite=True)
-            darkpaths[tuple(dark_val)] = fpath
-
-        # Save list of file paths for future use.
-        # It doesn't take much storage and easy to erase if you want.
-        with open(self.listdir / 'darkpaths.list', 'w+') as ll:
-            for p in list(darkpaths.values()):
-                ll.write(f"{str(p)}\n")
-
-        with open(self.listdir / 'darkpaths.pkl', 'wb') as pkl:
-            pickle.dump(darkpaths, pkl)
-
-        self.darkpaths = darkpaths
+        self._save_paths("dark", darkpaths)
 
+    @_stage("flat")
     def make_flat(self, savedir=None, do_bias=True, do_dark=True,
                   mbiaspath=None, mdarkpath=None,
-                  comb_kwargs=MEDCOMB_KEYS, delimiter='-', dtype='float32'):
+                  comb_kwargs=MEDCOMB_KEYS, delimiter='-', dtype='float32',
+                  resume=False, memory_limit=None, save_bd=False,
+                  n_jobs=1, executor=None):
         '''Makes and saves flat images.
         Parameters
         ----------
@@ -569,6 +1559,33 @@ class Preprocessor():
             The data type you want for the final master bias frame. It
             is recommended to use ``float32`` or ``int16`` if there is
             no specific reason.
+
+        resume : bool, optional
+            If ``True``, the master frames whose inputs and parameters have
+            not changed since the previous run (see ``self.manifest``) are
+            not made again.
+
+        memory_limit : int or None, optional
+            If given, the frames are median-combined by
+            `~snuo1mpy.combine.stream_combine` using about this much memory
+            (in bytes) rather than loading all the frames of a group at
+            once by ``combine_ccd``. Only possible if ``comb_kwargs`` is
+            a median combine without rejection (e.g., ``MEDCOMB_KEYS``).
+            If ``n_jobs > 1``, it is shared by the workers.
+
+        save_bd : bool, optional
+            If ``True``, the bias and dark subtracted flat frames are also
+            saved as ``<stem>_BD.fits`` (float32) next to the raw flats.
+            They are never read back: the combine is always done from the
+            memory.
+
+        n_jobs : int or None, optional
+            The number of processes to combine the groups (e.g., of
+            different FILTER) concurrently. ``1`` (default) combines them
+            one by one in this process.
+
+        executor : `~concurrent.futures.Executor` or None, optional
+            If given, it is used instead of making a new process pool.
         '''
         # Initial settings
         self.initialize_self()
@@ -577,107 +1594,31 @@ class Preprocessor():
             savedir = self.topdir
 
         yfu.mkdir(savedir)
-        flatpaths = {}
-
-        # For simplicity, crop the original data by type_key and
-        # type_val first.
-        st = self.summary_raw.copy()
-        for k, v in zip(self.flat_type_key, self.flat_type_val):
-            st = st[st[k] == v]
-
-        # For grouping, use type_key + group_key. This is because (1) it
-        # is not harmful cuz type_key will have unique column values as
-        # ``st`` has already been cropped in above for loop (2) by doing
-        # this we get more information from combining process because,
-        # e.g., "images with ["OBJECT", "EXPTIME"] = ["dark", 1.0] are
-        # loaded" will be printed rather than just "images with
-        # ["EXPTIME"] = [1.0] are loaded".
-        gs = st.groupby(self.flat_key)
-
+        flatpaths, jobs = self._plan_flat(savedir,
+                                          do_bias=do_bias,
+                                          do_dark=do_dark,
+                                          mbiaspath=mbiaspath,
+                                          mdarkpath=mdarkpath,
+                                          comb_kwargs=comb_kwargs,
+                                          delimiter=delimiter,
+                                          dtype=dtype,
+                                          resume=resume,
+                                          save_bd=save_bd)
         # Do flat combine:
-        for flat_val, flat_group in gs:
-            # set path to master bias
-            if mbiaspath is not None:
-                biaspath = mbiaspath
-            elif do_bias:
-                # corresponding key for biaspaths:
-                corr_bias = tuple(self.bias_type_val)
-                # if _group_key not empty, add appropriate ``group_val``:
-                if self.bias_group_key:
-                    corr_bias += tuple(flat_group[self.bias_group_key].iloc[0])
-                # else: empty. path is fully specified by _type_val.
-                biaspath = self.biaspaths[corr_bias]
-                try:
-                    biaspath = self.biaspaths[corr_bias]
-                except KeyError:
-                    biaspath = None
-                    warn(f"Bias not available for {corr_bias}. "
-                         + "Processing without bias.")
+        self._run_master_jobs(_make_flat, jobs, n_jobs=n_jobs,
+                              executor=executor, memory_limit=memory_limit)
 
-            # set path to master dark
-            if mdarkpath is not None:
-                darkpath = mdarkpath
-            elif do_dark:
-                # corresponding key for darkpaths:
-                corr_dark = tuple(self.dark_type_val)
-                # if _group_key not empty, add appropriate ``group_val``:
-                if self.dark_group_key:
-                    corr_dark += tuple(flat_group[self.dark_group_key].iloc[0])
-                # else: empty. path is fully specified by _type_val.
-                try:
-                    darkpath = self.darkpaths[corr_dark]
-                except (KeyError):
-                    darkpath = None
-                    warn(f"Dark not available for {corr_dark}. "
-                         + "Processing without dark.")
-
-            # Do BD preproc before combine
-            flat_bd_paths = []
-            for i, flat_row in flat_group.iterrows():
-                flat_orig_path = Path(flat_row["file"])
-                flat_bd_path = (flat_orig_path.parent
-                                / (flat_orig_path.stem + "_BD.fits"))
-                ccd = yfu.load_ccd(flat_orig_path, unit='adu')
-                _ = yfu.bdf_process(ccd,
-                                    output=flat_bd_path,
-                                    mbiaspath=biaspath,
-                                    mdarkpath=darkpath,
-                                    dtype="int16",
-                                    overwrite=True,
-                                    unit=None)
-                flat_bd_paths.append(flat_bd_path)
-
-            if not isinstance(flat_val, tuple):
-                flat_val = tuple([flat_val])
-            fname = delimiter.join([str(x) for x in flat_val]) + ".fits"
-            fpath = Path(savedir) / fname
-
-            _ = yfu.combine_ccd(flat_bd_paths,
-                                output=fpath,
-                                dtype=dtype,
-                                **comb_kwargs,
-                                normalize_average=True,  # Since skyflat!!
-                                type_key=self.flat_key,
-                                type_val=flat_val)
-
-            flatpaths[tuple(flat_val)] = fpath
-
-        # Save list of file paths for future use.
-        # It doesn't take much storage and easy to erase if you want.
-        with open(self.listdir / 'flatpaths.list', 'w+') as ll:
-            for p in list(flatpaths.values()):
-                ll.write(f"{str(p)}\n")
-
-        with open(self.listdir / 'flatpaths.pkl', 'wb') as pkl:
-            pickle.dump(flatpaths, pkl)
-
-        self.flatpaths = flatpaths
+        self._save_paths("flat", flatpaths)
 
+    @_stage("preproc")
     def do_preproc(self, savedir=None, delimiter='-', dtype='float32',
                    mbiaspath=None, mdarkpath=None, mflatpath=None,
                    do_bias=True, do_dark=True, do_flat=True,
                    do_crrej=False, crrej_kwargs=None, verbose_crrej=False,
-                   verbose_bdf=True, verbose_summary=False):
+                   verbose_bdf=True, verbose_summary=False,
+                   n_jobs=1, executor=None, cache_limit=2**30,
+                   resume=False, extract=False, extract_kw=None,
+                   in_place=False, bscale=1.):
         ''' Conduct the preprocessing using simplified ``bdf_process``.
         Parameters
         ----------
@@ -690,7 +1631,9 @@ class Preprocessor():
         dtype : str or numpy.dtype object, optional.
             The data type you want for the final master bias frame. It is
             recommended to use ``float32`` or ``int16`` if there is no
-            specific reason.
+            specific reason. If ``in_place``, ``"uint16"`` or ``"int16"``
+            saves the scaled integers (BSCALE = ``bscale``, see
+            `~snuo1mpy.calib.to_integer`), i.e., half the size of float32.
 
         mbiaspath, mdarkpath, mflatpath : None, path-like, optional
             If you want to force a certain bias, dark, or flat to be used,
@@ -707,6 +1650,52 @@ class Preprocessor():
             ``print(astroscrappy.detect_cosmics.__doc__)``
             Also refer to
             https://nbviewer.jupyter.org/github/ysbach/AO2019/blob/master/Notebooks/07-Cosmic_Ray_Rejection.ipynb
+
+        n_jobs : int or None, optional
+            The number of processes to reduce the object frames. If ``1``
+            (default), frames are reduced one by one in this process. If
+            ``None`` or ``-1``, all the CPUs are used.
+
+        executor : `~concurrent.futures.Executor` or None, optional
+            If given, it is used instead of making a new process pool (and
+            ``n_jobs`` is ignored).
+
+        cache_limit : int or None, optional
+            The memory cap (in bytes) of the master frames kept in memory
+            by each process. The master bias/dark/flat are read only once
+            and the least recently used ones are dropped when the cap is
+            exceeded. ``None`` means no cap. The cache of this process is
+            cleared when the frames are reduced; that of the workers of
+            ``executor`` (if given) is kept for the next call.
+
+        resume : bool, optional
+            If ``True``, the frames whose raw file, master frames and
+            parameters have not changed since the previous run (see
+            ``self.manifest``) are not reduced again.
+
+        extract : bool, optional
+            If ``True``, the sources are extracted from each reduced frame
+            right after the reduction (in the same process, without
+            reading the frame again), and saved as the xylist for
+            solve-field. See ``extract_sources``.
+
+        extract_kw : dict or None, optional
+            The keyword arguments of `~snuo1mpy.extract.extract_sources`.
+
+        in_place : bool, optional
+            If ``True``, the frames are calibrated by
+            `~snuo1mpy.calib.calibrate` rather than ``bdf_process``: the
+            raw data are converted to float32 once and the bias, dark and
+            (reciprocal) flat are applied in place, so no float64 or
+            temporary copy of the frame is made. The pixels differ from
+            those of ``bdf_process`` by the float32 rounding (the flat is
+            multiplied by its reciprocal rather than divided). The
+            cosmic-ray rejection needs ``bdf_process``, so it is ignored
+            (with a warning) if ``do_crrej``. Default is ``False``.
+
+        bscale : float, optional
+            The BSCALE of the integer ``dtype``, e.g., ``0.1`` keeps 0.1
+            ADU (from -3276.8 to 3276.7 ADU for ``"int16"``).
         '''
         # Initial settings
         self.initialize_self()
@@ -717,234 +1706,501 @@ class Preprocessor():
         savedir = Path(savedir)
         yfu.mkdir(savedir)
 
+        savepaths, jobs = self._plan_preproc(savedir,
+                                             dtype=dtype,
+                                             mbiaspath=mbiaspath,
+                                             mdarkpath=mdarkpath,
+                                             mflatpath=mflatpath,
+                                             do_bias=do_bias,
+                                             do_dark=do_dark,
+                                             do_flat=do_flat,
+                                             do_crrej=do_crrej,
+                                             crrej_kwargs=crrej_kwargs,
+                                             verbose_crrej=verbose_crrej,
+                                             verbose_bdf=verbose_bdf,
+                                             resume=resume,
+                                             extract=extract,
+                                             extract_kw=extract_kw,
+                                             in_place=in_place,
+                                             bscale=bscale)
+
+        # The paths to masters are found above (in this process) so that
+        # the warnings are identical to the serial run. Only the heavy
+        # part (read, calibrate, crrej, write) is sent to the workers.
+        # Each frame is recorded to the manifest as soon as it is reduced,
+        # so that a failure (or a kill) does not make a resumed run redo the
+        # frames already reduced.
+        try:
+            run_jobs(_preproc_frame,
+                     [job["args"] + (cache_limit, self.telemetry.enabled)
+                      for job in jobs],
+                     n_jobs=n_jobs,
+                     executor=executor,
+                     callback=lambda i, result: self._finish_job(jobs[i],
+                                                                 result))
+        finally:
+            # The frames reduced in this process (the serial run or a
+            # thread pool) leave their masters in the cache.
+            _clear_master_cache()
+
+        self.reducedpaths = savepaths
+        self._summarize_reduced(verbose=verbose_summary)
+        if extract:
+            # Only the frames not reduced above (e.g., by ``resume``).
+            self.extract_sources(extract_kw=extract_kw, n_jobs=n_jobs,
+                                 executor=executor, resume=True)
+        return self.summary_red
+
+    def _plan_preproc(self, savedir, dtype='float32',
+                      mbiaspath=None, mdarkpath=None, mflatpath=None,
+                      do_bias=True, do_dark=True, do_flat=True,
+                      do_crrej=False, crrej_kwargs=None, verbose_crrej=False,
+                      verbose_bdf=True, resume=False, extract=False,
+                      extract_kw=None, in_place=False, bscale=1.):
+        ''' Finds the masters for each object frame.
+        Returns
+        -------
+        savepaths : list of Path
+            The paths to the reduced frames (to be made).
+
+        jobs : list of dict
+            The frames to be reduced (see ``_plan_bias``). The ``"args"``
+            are for ``_preproc_frame``.
+        '''
         savepaths = []
-        # for i, row in self.summary_raw.iterrows():
-        #     fpath = Path(row["file"])
+        jobs = []
+        if in_place and do_crrej:
+            warn("in_place is ignored: the cosmic-ray rejection (do_crrej) "
+                 + "needs bdf_process.")
+            in_place = False
+        bdf_kw = self._params(dtype=dtype,
+                              do_crrej=do_crrej,
+                              crrej_kwargs=crrej_kwargs,
+                              verbose_crrej=verbose_crrej,
+                              verbose_bdf=verbose_bdf,
+                              in_place=in_place,
+                              bscale=bscale)
+        # Match the masters of all rows in one pass (see
+        # ``_match_masters``) and index the rows by file name, rather than
+        # scanning the whole summary table for each frame.
+        st = self.summary_raw
+        rowidx = {f: i for i, f in enumerate(st["file"].astype(str))}
+        matched = {}
+        for kind, mpath, do in [("bias", mbiaspath, do_bias),
+                                ("dark", mdarkpath, do_dark),
+                                ("flat", mflatpath, do_flat)]:
+            if mpath is None and do:
+                matched[kind] = self._match_masters(st, kind).tolist()
+
         for fpath in self.objpaths:
-            savepath = savedir / Path(fpath).name
+            savepath = Path(savedir) / Path(fpath).name
             savepaths.append(savepath)
-            row = self.summary_raw[self.summary_raw["file"].values == str(
-                fpath)]
+            i = rowidx[str(fpath)]
+            biaspath, corr_bias = None, None
+            darkpath, corr_dark = None, None
+            flatpath, corr_flat = None, None
 
             if mbiaspath is not None:
                 biaspath = mbiaspath
             elif do_bias:
-                # corresponding key for biaspaths:
-                corr_bias = tuple(self.bias_type_val)
-                # if _group_key not empty, add appropriate ``group_val``:
-                if self.bias_group_key:  # not empty
-                    corr_bias += tuple(row[self.bias_group_key].iloc[0])
-                # else: empty. path is fully specified by _type_val.
-                try:
-                    biaspath = self.biaspaths[corr_bias]
-                except (KeyError):
-                    biaspath = None
-                    warn(f"Bias not available for {corr_bias}. "
-                         + "Processing without bias.")
+                corr_bias, biaspath = self._master_path(
+                    "bias", matched["bias"][i], st.iloc[i])
 
             if mdarkpath is not None:
                 darkpath = mdarkpath
             elif do_dark:
-                # corresponding key for darkpaths:
-                corr_dark = tuple(self.dark_type_val)
-                # if _group_key not empty, add appropriate ``group_val``:
-                if self.dark_group_key:
-                    corr_dark += tuple(row[self.dark_group_key].iloc[0])
-                # else: empty. path is fully specified by _type_val.
-                try:
-                    darkpath = self.darkpaths[corr_dark]
-                except (KeyError):
-                    darkpath = None
-                    warn(f"Dark not available for {corr_dark}. "
-                         + "Processing without dark.")
+                corr_dark, darkpath = self._master_path(
+                    "dark", matched["dark"][i], st.iloc[i])
 
             if mflatpath is not None:
                 flatpath = mflatpath
             elif do_flat:
-                # corresponding key for darkpaths:
-                corr_flat = tuple(self.flat_type_val)
-                # if _group_key not empty, add appropriate ``group_val``:
-                if self.flat_group_key:
-                    corr_flat += tuple(row[self.flat_group_key].iloc[0])
-                # else: empty. path is fully specified by _type_val.
-                try:
-                    flatpath = self.flatpaths[corr_flat]
-                except (KeyError):
-                    flatpath = None
-                    warn(f"Flat not available for {corr_flat}. "
-                         + "Processing without flat.")
-
-            objccd = CCDData.read(fpath)
-            _ = yfu.bdf_process(objccd,                       #
-                                output=savepath,              #
-                                unit=None,                    #
-                                mbiaspath=biaspath,           #
-                                mdarkpath=darkpath,           #
-                                mflatpath=flatpath,           #
-                                do_crrej=do_crrej,            #
-                                crrej_kwargs=crrej_kwargs,    #
-                                verbose_crrej=verbose_crrej,  #
-                                verbose_bdf=verbose_bdf)
+                corr_flat, flatpath = self._master_path(
+                    "flat", matched["flat"][i], st.iloc[i])
 
-        self.reducedpaths = savepaths
-        self.summary_red = yfu.make_summary(
-            self.reducedpaths,
-            output=self.topdir / "summary_reduced.csv",
-            pandas=True,
-            keywords=self.summary_keywords + ["PROCESS"],
-            verbose=verbose_summary
-        )
+            key = f"preproc:{savepath}"
+            inputs = [fpath, biaspath, darkpath, flatpath]
+            if resume and self.manifest.is_fresh(key, inputs, bdf_kw):
+                continue
+
+            masters = dict(bias=(corr_bias, biaspath),
+                           dark=(corr_dark, darkpath),
+                           flat=(corr_flat, flatpath))
+            job = dict(key=key, inputs=inputs, output=savepath,
+                       params=bdf_kw, extract=None,
+                       args=(fpath, savepath, masters, bdf_kw, None))
+            if extract:
+                extract_kw = {} if extract_kw is None else extract_kw
+                xypath = _extract.xylist_path(savepath)
+                job["extract"] = (f"extract:{xypath}", xypath, extract_kw)
+                job["args"] = (fpath, savepath, masters, bdf_kw, extract_kw)
+            jobs.append(job)
+        return savepaths, jobs
+
+    def _summarize_reduced(self, verbose=False):
+        with self.telemetry.span("summary", stage="reduced",
+                                 nframe=len(self.reducedpaths)):
+            self.summary_red = yfu.make_summary(
+                self.reducedpaths,
+                output=self.topdir / "summary_reduced.csv",
+                pandas=True,
+                keywords=self.summary_keywords + ["PROCESS"],
+                verbose=verbose
+            )
+            self.catalog.set_paths("reduced", self.reducedpaths,
+                                   sources=self.objpaths)
+            self.summary_red = self._store_summary("reduced",
+                                                   self.summary_red)
         return self.summary_red
 
-    def make_astrometry_script(self, output=Path("astrometry.sh"),
-                               log=Path("astrometry.log"),
-                               indexdir=Path('.'), cfg=Path("astrometry.cfg")):
+    @_stage("extract")
+    def extract_sources(self, extract_kw=None, n_jobs=1, executor=None,
+                        resume=False):
+        ''' Extracts the sources of the reduced frames for solve-field.
+        Parameters
+        ----------
+        extract_kw : dict or None, optional
+            The keyword arguments of `~snuo1mpy.extract.extract_sources`.
+
+        n_jobs : int or None, optional
+            The number of processes. ``None`` or ``-1`` means all the
+            CPUs.
+
+        executor : `~concurrent.futures.Executor` or None, optional
+            If given, it is used instead of making a new process pool.
+
+        resume : bool, optional
+            If ``True``, the xylists made from the same reduced frame with
+            the same ``extract_kw`` (see ``self.manifest``) are not made
+            again.
+
+        Returns
+        -------
+        xylists : list of Path
+            The xylist (``.xyls`` next to the frame) of each reduced frame.
+
+        Notes
+        -----
+        The background is the sigma-clipped median in a mesh and the
+        sources are the local maxima of the smoothed image, with the
+        centroids in a small window; all done by numpy/scipy on the whole
+        arrays. solve-field then only matches the brightest sources (see
+        ``use_xylist`` of ``run_astrometry``).
+        '''
+        self.initialize_self()
+        extract_kw = {} if extract_kw is None else extract_kw
+        xylists = []
+        jobs = []
+        for fpath in self.summary_red["file"]:
+            xypath = _extract.xylist_path(fpath)
+            xylists.append(xypath)
+            key = f"extract:{xypath}"
+            if (resume
+                    and self.manifest.is_fresh(key, [fpath], extract_kw)):
+                continue
+            jobs.append(dict(key=key, input=fpath, output=xypath))
+
+        def _record(i, _):
+            job = jobs[i]
+            self.manifest.record(job["key"], [job["input"]], [job["output"]],
+                                 extract_kw)
+            self.manifest.save()
+
+        run_jobs(_extract.extract_file,
+                 [(job["input"], job["output"], extract_kw) for job in jobs],
+                 n_jobs=n_jobs,
+                 executor=executor,
+                 callback=_record)
+        return xylists
+
+    def _xylists(self):
+        xylists = []
+        for fpath in self.summary_red["file"]:
+            xypath = _extract.xylist_path(fpath)
+            if xypath.exists():
+                xylists.append(xypath)
+            else:
+                warn(f"xylist not found for {fpath}; solved from the image.")
+                xylists.append(None)
+        return xylists
+
+    def run(self, n_jobs=1, executor=None, organize=True, resume=False,
+            memory_limit=None, cache_limit=2**30, organize_kw=None,
+            bias_kw=None, dark_kw=None, flat_kw=None, preproc_kw=None,
+            verbose=True):
+        ''' Runs all the stages from ``organize_raw`` to ``do_preproc``.
+        Parameters
+        ----------
+        n_jobs : int or None, optional
+            The number of tasks (combine of a calibration group or
+            reduction of an object frame) running at the same time.
+            ``None`` or ``-1`` means all the CPUs.
+
+        executor : `~concurrent.futures.Executor` or None, optional
+            If given, it is used instead of making a new process pool.
+
+        organize : bool, optional
+            Whether to run ``organize_raw`` first. If ``False``, the
+            results of the previous ``organize_raw`` are used.
+
+        resume : bool, optional
+            If ``True``, the outputs up to date in ``self.manifest`` are
+            not made again (see ``resume`` of each stage). An output is
+            made again if any of its inputs (e.g., the master bias of a
+            dark) is made again in this run.
+
+        memory_limit : int or None, optional
+            The total memory (in bytes) for combining the calibration
+            frames, shared by the ``n_jobs`` workers. See ``make_bias``.
+
+        cache_limit : int or None, optional
+            The memory cap of the master cache of each worker. See
+            ``do_preproc``.
+
+        organize_kw, bias_kw, dark_kw, flat_kw, preproc_kw : dict, optional
+            The other keyword arguments of ``organize_raw``,
+            ``make_bias``, ``make_dark``, ``make_flat``, and
+            ``do_preproc``. The arguments above (e.g., ``n_jobs`` and
+            ``resume``) are for all the stages and cannot be in them.
+
+        verbose : bool, optional
+            Whether to print the timing of each task when it is done.
+
+        Returns
+        -------
+        timings : list of dict
+            The name, start & end (UNIX) time, and duration of each task.
+            Also saved as ``self.timings``.
+
+        Notes
+        -----
+        The tasks are the combine of each calibration group and the
+        reduction of each object frame, and each task starts as soon as
+        the masters it needs are made. E.g., the V-band object frames are
+        reduced while the flats of other filters are still being combined.
+        The results are identical to calling the stages one by one.
+        '''
+        # organize_raw reads the headers by its own ``n_jobs`` threads.
+        organize_kw = _stage_kwargs(self.organize_raw, self.organize_raw,
+                                    organize_kw or {}, "organize_kw",
+                                    run_keys=["resume"])
+        # Checked before anything is done.
+        stage_kw = {}
+        for kind, kw in [("bias", bias_kw), ("dark", dark_kw),
+                         ("flat", flat_kw)]:
+            stage_kw[kind] = _stage_kwargs(getattr(self, f"make_{kind}"),
+                                           getattr(self, f"_plan_{kind}"),
+                                           kw or {}, f"{kind}_kw")
+        preproc_kw = {} if preproc_kw is None else dict(preproc_kw)
+        verbose_summary = preproc_kw.pop("verbose_summary", False)
+        stage_kw["preproc"] = _stage_kwargs(self.do_preproc,
+                                            self._plan_preproc, preproc_kw,
+                                            "preproc_kw")
+
+        timings = []
+        if organize:
+            t0 = time.time()
+            self.organize_raw(resume=resume, **organize_kw)
+            t1 = time.time()
+            timings.append(dict(name="organize_raw", start=t0, end=t1,
+                                duration=t1 - t0))
+            if verbose:
+                print(f"{'organize_raw':<50s} {t1 - t0:9.3f} s")
 
-        # It just simply assumes 1-pixel binning (no binnig).
         self.initialize_self()
 
-        str_time = (r'current_date_time="`date +%Y-%m-%d\ %H:%M:%S`";'
-                    + 'echo $current_date_time;')
-        str_mv = "mv {} {}/input.fits"
-        str_wcs = ("solve-field {}/input.fits -N {}"
-                   + " --nsigma 5 --downsample 4"
-                   + " --radius 0.2 -u app -L 0.30 -U 0.33"
-                   + " --cpulimit 300 --no-plot --overwrite --no-remove-lines")
+        # Plan everything first, so that the paths to all the masters are
+        # known before any of them is made. The freshness is checked below,
+        # as the masters to be made again are not known yet.
+        plans = []
+        for kind, func in [("bias", _make_bias), ("dark", _make_dark),
+                           ("flat", _make_flat)]:
+            kw = stage_kw[kind]
+            savedir = Path(kw.pop("savedir", None) or self.topdir)
+            yfu.mkdir(savedir)
+            plan = getattr(self, f"_plan_{kind}")
+            paths, jobs = plan(savedir, resume=False, **kw)
+            setattr(self, f"{kind}paths", paths)
+            plans.append((func, jobs))
+
+        kw = stage_kw["preproc"]
+        savedir = Path(kw.pop("savedir", None) or self.topdir)
+        yfu.mkdir(savedir)
+        savepaths, frame_jobs = self._plan_preproc(savedir, resume=False,
+                                                   **kw)
+        plans.append((_preproc_frame, frame_jobs))
+
+        if memory_limit is not None:
+            memory_limit = memory_limit // n_workers(n_jobs)
+
+        # A task depends on the tasks making any of its inputs. With
+        # ``resume``, a job is skipped only if it is fresh and none of its
+        # inputs is made again (the plans are in the order of the stages,
+        # so the producers of the inputs are already known).
+        producers = {}
+        tasks = []
+        scheduled = []
+        for func, jobs in plans:
+            last_arg = cache_limit if func is _preproc_frame else memory_limit
+            for job in jobs:
+                deps = [producers[str(p)] for p in job["inputs"]
+                        if str(p) in producers]
+                if (resume and not deps
+                        and self.manifest.is_fresh(job["key"], job["inputs"],
+                                                   job["params"])):
+                    continue
+                tasks.append(Task(job["key"], func,
+                                  job["args"] + (last_arg,
+                                                 self.telemetry.enabled),
+                                  deps=deps))
+                producers[str(job["output"])] = job["key"]
+                scheduled.append(job)
+
+        # Each task is recorded to the manifest as soon as it is finished
+        # (see ``do_preproc``).
+        jobs = {job["key"]: job for job in scheduled}
+        runner = DAGRunner(n_jobs=n_jobs, executor=executor, verbose=verbose)
+        try:
+            runner.run(tasks, callback=lambda name, result:
+                       self._finish_job(jobs[name], result))
+        finally:
+            _clear_master_cache()
+
+        for kind in ["bias", "dark", "flat"]:
+            self._save_paths(kind, getattr(self, f"{kind}paths"))
+
+        self.reducedpaths = savepaths
+        self._summarize_reduced(verbose=verbose_summary)
+        if preproc_kw.get("extract", False):
+            self.extract_sources(extract_kw=preproc_kw.get("extract_kw"),
+                                 n_jobs=n_jobs, executor=executor,
+                                 resume=True)
+        self.timings = timings + runner.timings
+        return self.timings
+
+    def make_astrometry_script(self, output=Path("astrometry.sh"),
+                               log=Path("astrometry.log"),
+                               indexdir=Path('.'), cfg=Path("astrometry.cfg"),
+                               use_hints=False, radius=0.2,
+                               use_xylist=False):
+        ''' Makes the shell script running solve-field on reduced frames.
+        Parameters
+        ----------
+        use_hints : bool, optional
+            If ``False`` (default), it just simply assumes 1-pixel binning
+            (no binnig) and a blind search. If ``True``, OBJCTRA/OBJCTDEC
+            in the summary are given as ``--ra``/``--dec`` (with
+            ``radius`` in deg), and the pixel scale bounds are scaled by
+            XBINNING/YBINNING.
+
+        use_xylist : bool, optional
+            If ``True``, the xylists from ``extract_sources`` are given to
+            solve-field (with ``--x-column`` etc) instead of the images.
+        '''
+        self.initialize_self()
+        self._check_astrometry_cfg(indexdir, cfg)
+        xylists = self._xylists() if use_xylist else None
+        if use_hints:
+            hints = _astrometry.hints_from_summary(self.summary_red)
+            options = [_astrometry.hint_options(ra=h["ra"], dec=h["dec"],
+                                                radius=radius,
+                                                xbin=h["xbin"],
+                                                ybin=h["ybin"])
+                       for h in hints]
+            _astrometry.write_script(self.summary_red["file"], output,
+                                     options=options, xylists=xylists)
+        else:
+            _astrometry.write_script(self.summary_red["file"], output,
+                                     xylists=xylists)
+
+    def _check_astrometry_cfg(self, indexdir, cfg):
         if not Path(cfg).exists():
             warn(f"astrometry config not found at {cfg} you specified.\n"
                  + f"Making it at path {cfg} using "
                  + f"the index directory ({indexdir}) you specified.")
-            str_cfg = """
-# This is a config file for the Astrometry.net 'astrometry-engine'
-# program - it contains information about where indices are stored,
-# and "site policy" items.
-
-# Check the indices in parallel?
-#
-# -if the indices you are using take less than 2 GB of space, and you have at least
-#  as much physical memory as indices, then you want this enabled.
-#
-# -if you are using a 64-bit machine and you have enough physical memory to contain
-#  the indices you are using, then you want this enabled.
-#
-# -otherwise, leave it commented-out.
-
-inparallel
-
-# If no scale estimate is given, use these limits on field width.
-# minwidth 0.1
-# maxwidth 180
-
-# If no depths are given, use these:
-#depths 10 20 30 40 50 60 70 80 90 100
-
-# Maximum CPU time to spend on a field, in seconds:
-# default is 600 (ten minutes), which is probably way overkill.
-cpulimit 300
-
-# In which directories should we search for indices?
-add_path {:s}
-
-# Load any indices found in the directories listed above.
-autoindex
-
-## Or... explicitly list the indices to load.
-#index index-219
-#index index-218
-#index index-217
-#index index-216
-#index index-215
-#index index-214
-#index index-213
-#index index-212
-#index index-211
-#index index-210
-#index index-209
-#index index-208
-#index index-207
-#index index-206
-#index index-205
-#index index-204-00
-#index index-204-01
-#index index-204-02
-#index index-204-03
-#index index-204-04
-#index index-204-05
-#index index-204-06
-#index index-204-07
-#index index-204-08
-#index index-204-09
-#index index-204-10
-#index index-204-11
-#index index-203-00
-#index index-203-01
-#index index-203-02
-#index index-203-03
-#index index-203-04
-#index index-203-05
-#index index-203-06
-#index index-203-07
-#index index-203-08
-#index index-203-09
-#index index-203-10
-#index index-203-11
-#index index-202-00
-#index index-202-01
-#index index-202-02
-#index index-202-03
-#index index-202-04
-#index index-202-05
-#index index-202-06
-#index index-202-07
-#index index-202-08
-#index index-202-09
-#index index-202-10
-#index index-202-11
-#index index-201-00
-#index index-201-01
-#index index-201-02
-#index index-201-03
-#index index-201-04
-#index index-201-05
-#index index-201-06
-#index index-201-07
-#index index-201-08
-#index index-201-09
-#index index-201-10
-#index index-201-11
-#index index-200-00
-#index index-200-01
-#index index-200-02
-#index index-200-03
-#index index-200-04
-#index index-200-05
-#index index-200-06
-#index index-200-07
-#index index-200-08
-#index index-200-09
-#index index-200-10
-#index index-200-11
-"""
-
-            with open(Path(cfg), 'w+') as ff:
-                ff.write(str_cfg.format(str(indexdir.resolve())))
-
-        with open(Path(output), "w+") as astrometry:
-            astrometry.write(str_time)
-            astrometry.write("\n")
-            for fpath in self.summary_red["file"]:
-                fpath = Path(fpath)
-                fparent = fpath.parent
-                astrometry.write(str_mv.format(fpath, fparent))
-                astrometry.write("\n")
-                astrometry.write(str_wcs.format(fparent, fpath))
-                astrometry.write("\n")
-                astrometry.write(str_time)
-                astrometry.write("\n")
-            astrometry.write(f"rm {fparent}/input.*\n")
-            astrometry.write(str_time)
-
-        # import os
-        # import tqdm
-
-        # for fpath in tqdm(self.summary_red["file"]):
+            _astrometry.write_cfg(cfg, indexdir)
+
+    @_stage("astrometry")
+    def run_astrometry(self, n_jobs=1, log=Path("astrometry.log"),
+                       indexdir=Path('.'), cfg=Path("astrometry.cfg"),
+                       scratchdir=None, timeout=None, retries=0,
+                       executable="solve-field", keep_scratch=False,
+                       use_hints=True, reuse_wcs=True, radius=0.2,
+                       use_xylist=False):
+        ''' Runs solve-field on the reduced frames concurrently.
+        Parameters
+        ----------
+        n_jobs : int or None, optional
+            The number of solve-field processes running at the same time.
+            ``None`` or ``-1`` means the number of CPUs.
+
+        log : path-like or None, optional
+            The JSON lines log of the result of each frame, appended as
+            each frame is done (see `~snuo1mpy.astrometry.run_astrometry`).
+
+        indexdir, cfg : path-like, optional
+            The index directory and the config file of astrometry.net. The
+            config is made if it does not exist.
+
+        scratchdir : path-like or None, optional
+            The directory for the scratch directory of each frame. If
+            ``None``, ``<topdir>/astrometry_scratch`` is used.
+
+        timeout : float or None, optional
+            The time limit (in seconds) of each solve-field run.
+
+        retries : int, optional
+            The number of re-trials after a failure or a timeout.
+
+        executable : str, optional
+            The solve-field executable.
+
+        keep_scratch : bool, optional
+            If ``True``, the scratch directories are not removed.
+
+        use_hints : bool, optional
+            If ``True``, OBJCTRA/OBJCTDEC in the summary are given as
+            ``--ra``/``--dec`` (with ``radius`` in deg) and the pixel scale
+            bounds are scaled by XBINNING/YBINNING. Frames without the
+            coordinates are solved blindly.
+
+        reuse_wcs : bool, optional
+            If ``True`` (and ``use_hints``), the first frame of each OBJECT
+            is solved first, and then the other frames of the OBJECT are
+            solved concurrently around its center and pixel scale.
+
+        radius : float, optional
+            The search radius (deg) around the hinted position.
+
+        use_xylist : bool, optional
+            If ``True``, the xylists from ``extract_sources`` are given to
+            solve-field instead of the images, and the solved WCS is
+            written to the header of each reduced frame.
+
+        Returns
+        -------
+        logs : list of dict
+            The result of each frame. See
+            `~snuo1mpy.astrometry.solve_field`.
+        '''
+        self.initialize_self()
+        self._check_astrometry_cfg(indexdir, cfg)
+        if scratchdir is None:
+            scratchdir = self.topdir / "astrometry_scratch"
+        hints = None
+        if use_hints:
+            hints = _astrometry.hints_from_summary(self.summary_red)
+        xylists = self._xylists() if use_xylist else None
+        return _astrometry.run_astrometry(self.summary_red["file"],
+                                          scratchdir=scratchdir,
+                                          log=log,
+                                          n_jobs=n_jobs,
+                                          executable=executable,
+                                          cfg=cfg,
+                                          timeout=timeout,
+                                          retries=retries,
+                                          keep_scratch=keep_scratch,
+                                          hints=hints,
+                                          reuse_wcs=reuse_wcs,
+                                          radius=radius,
+                                          xylists=xylists)
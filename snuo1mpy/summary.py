@@ -0,0 +1,103 @@
+from pathlib import Path
+
+import pandas as pd
+
+from .utils import SUMMARY_SCHEMA
+
+__all__ = ["SUMMARY_FORMATS", "apply_schema", "write_summary",
+           "read_summary"]
+
+# The file extension of each format. The columnar formats need pyarrow.
+SUMMARY_FORMATS = {"csv": ".csv", "parquet": ".parquet", "feather": ".feather"}
+
+
+def _as_text(col):
+    return col.map(lambda v: None if pd.isna(v) else str(v)).astype(object)
+
+
+def apply_schema(table, schema=SUMMARY_SCHEMA):
+    ''' Casts the columns of a summary table to the types of ``schema``.
+    Parameters
+    ----------
+    table : pandas.DataFrame
+        The summary table. The columns not in ``schema`` are untouched.
+
+    schema : dict, optional
+        The column names and their dtypes (``"str"`` for text).
+
+    Notes
+    -----
+    E.g., an OBJECT like ``"1"`` or a FILTER read back as float (all
+    missing) are what make the grouping by these columns go wrong.
+    '''
+    table = table.copy()
+    for col, dtype in schema.items():
+        if col not in table:
+            continue
+        if dtype == "str":
+            table[col] = _as_text(table[col])
+        else:
+            table[col] = pd.to_numeric(table[col],
+                                       errors="coerce").astype(dtype)
+    return table
+
+
+def _format(path, fmt):
+    if fmt is None:
+        suffix = Path(path).suffix
+        for name, ext in SUMMARY_FORMATS.items():
+            if ext == suffix:
+                return name
+        raise ValueError(f"Unknown summary format of {path}.")
+    if fmt not in SUMMARY_FORMATS:
+        raise ValueError(f"fmt must be one of {list(SUMMARY_FORMATS)}.")
+    return fmt
+
+
+def write_summary(table, output, fmt=None, schema=SUMMARY_SCHEMA):
+    ''' Saves the summary table with the dtypes of ``schema``.
+    Parameters
+    ----------
+    output : path-like
+        The path to save.
+
+    fmt : str or None, optional
+        One of `SUMMARY_FORMATS`. If ``None``, it is guessed from the
+        extension of ``output``.
+
+    Returns
+    -------
+    table : pandas.DataFrame
+        The table with the dtypes of ``schema``.
+    '''
+    fmt = _format(output, fmt)
+    table = apply_schema(table, schema=schema)
+    if fmt == "csv":
+        table.to_csv(output, index=False)
+    elif fmt == "parquet":
+        table.to_parquet(output, index=False)
+    else:
+        table.reset_index(drop=True).to_feather(output)
+    return table
+
+
+def read_summary(path, fmt=None, schema=SUMMARY_SCHEMA):
+    ''' Reads the summary table with the dtypes of ``schema``.
+    Parameters
+    ----------
+    fmt : str or None, optional
+        One of `SUMMARY_FORMATS`. If ``None``, it is guessed from the
+        extension of ``path``.
+    '''
+    fmt = _format(path, fmt)
+    if fmt == "csv":
+        # Read text columns as they are, not as numbers to be re-casted.
+        dtype = {col: object for col, typ in schema.items() if typ == "str"}
+        table = pd.read_csv(path, dtype=dtype)
+    elif fmt == "parquet":
+        table = pd.read_parquet(path)
+    else:
+        table = pd.read_feather(path)
+    # The dtypes stored in a columnar file are those of whoever wrote it
+    # (e.g., an older schema or another tool), so they are cast as well.
+    return apply_schema(table, schema=schema)
@@ -0,0 +1,211 @@
+import json
+import os
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+__all__ = ["Recorder", "JSONLinesSink", "Telemetry", "file_size"]
+
+
+def file_size(fpath):
+    ''' The size of a file in bytes, or ``None`` if it does not exist.
+    '''
+    try:
+        return Path(fpath).stat().st_size
+    except (OSError, TypeError):
+        return None
+
+
+class Recorder():
+    def __init__(self, enabled=True, **context):
+        """ Collects the spans (timed sub-steps) in one process.
+        Parameters
+        ----------
+        enabled : bool, optional
+            If ``False``, the spans are not recorded (and cost nothing but
+            a function call).
+
+        **context
+            Added to every record, e.g., ``frame=<path>`` or
+            ``group=<key>``.
+
+        Notes
+        -----
+        A worker of the process pool makes its own recorder and returns
+        ``recorder.records`` with its result, so that the main process
+        can send them to the sinks of `Telemetry`.
+        """
+        self.enabled = enabled
+        self.context = context
+        self.records = []
+
+    @contextmanager
+    def span(self, step, **info):
+        ''' Times the ``with`` block as ``step``.
+        The record (a dict) is given by ``as`` so that the block can add
+        to it, e.g., ``rec["bytes_written"] = nbytes``.
+        '''
+        rec = dict(step=step, **self.context, **info)
+        if not self.enabled:
+            yield rec
+            return
+        rec.update(pid=os.getpid(), start=time.time())
+        t0 = time.perf_counter()
+        try:
+            yield rec
+        finally:
+            rec["duration"] = time.perf_counter() - t0
+            self.records.append(rec)
+
+
+class JSONLinesSink():
+    def __init__(self, path):
+        """ Appends each record to a JSON lines file.
+        """
+        self.path = Path(path)
+
+    def __call__(self, record):
+        with open(self.path, 'a') as ff:
+            ff.write(json.dumps(record, default=str) + "\n")
+
+
+class Telemetry():
+    def __init__(self, sinks=None, profile_dir=None, trace_memory=False,
+                 enabled=True):
+        """ Opt-in instrumentation of `~snuo1mpy.Preprocessor`.
+        Parameters
+        ----------
+        sinks : list of (path-like or callable), optional
+            Where each record goes: a path is a JSON lines file (see
+            `JSONLinesSink`), and a callable is called with the record
+            (a dict). The records are always kept in ``self.records``.
+
+        profile_dir : path-like or None, optional
+            If given, each stage (e.g., ``do_preproc``) is run under
+            cProfile and the stats are dumped to
+            ``<profile_dir>/<stage>.prof`` (see `pstats`). Only the main
+            process is profiled.
+
+        trace_memory : bool, optional
+            If ``True``, the peak memory allocated by Python during each
+            stage (of the main process) is traced by `tracemalloc` and
+            saved as ``mem_peak`` (bytes) of the stage record. It slows
+            down the run noticeably.
+
+        enabled : bool, optional
+            If ``False``, nothing is recorded. This is what
+            `~snuo1mpy.Preprocessor` uses if no telemetry is given.
+
+        Notes
+        -----
+        Each record has the ``step`` and its ``duration`` (s), ``start``
+        (UNIX time) and ``pid``, and depending on the step, the ``frame``
+        (path) or the calibration ``group`` it is about, and
+        ``bytes_read``/``bytes_written`` (file sizes). The steps are::
+
+          header read, rename, summary          (organize_raw, summaries)
+          master, read, calibrate, crrej, write, extract
+                                                (each frame of do_preproc)
+          combine, calibrate, write             (each group of masters)
+
+        and one record per stage (``step`` is the stage name, e.g.,
+        ``"bias"``, with ``"kind": "stage"``). ``crrej`` (the cosmic-ray
+        rejection) is only there if ``do_crrej=True``.
+        """
+        self.enabled = enabled
+        self.sinks = []
+        for sink in ([] if sinks is None else sinks):
+            self.sinks.append(sink if callable(sink) else JSONLinesSink(sink))
+        self.profile_dir = None if profile_dir is None else Path(profile_dir)
+        self.trace_memory = trace_memory
+        self.records = []
+        self._depth = 0  # the number of the stages running
+
+    def emit(self, records):
+        ''' Sends the records (e.g., from the workers) to the sinks.
+        '''
+        if not self.enabled:
+            return
+        for rec in records:
+            self.records.append(rec)
+            for sink in self.sinks:
+                sink(rec)
+
+    def recorder(self, **context):
+        return Recorder(enabled=self.enabled, **context)
+
+    @contextmanager
+    def span(self, step, **info):
+        ''' `Recorder.span` in this process, emitted right away.
+        '''
+        rec = self.recorder()
+        with rec.span(step, **info) as record:
+            yield record
+        self.emit(rec.records)
+
+    @contextmanager
+    def session(self, stage):
+        ''' Records the whole ``stage`` (with the profile and memory trace
+        if asked).
+        '''
+        if not self.enabled:
+            yield
+            return
+        if self._depth:
+            # A stage run by another (e.g., extract in do_preproc) is only
+            # timed: it is in the profile and trace of the outer one.
+            self._depth += 1
+            try:
+                with self.span(stage, kind="stage"):
+                    yield
+            finally:
+                self._depth -= 1
+            return
+
+        profiler = None
+        if self.profile_dir is not None:
+            import cProfile
+            profiler = cProfile.Profile()
+        tracing = False
+        if self.trace_memory:
+            import tracemalloc
+            tracing = not tracemalloc.is_tracing()
+            if tracing:
+                tracemalloc.start()
+            elif hasattr(tracemalloc, "reset_peak"):  # Python >= 3.9
+                tracemalloc.reset_peak()
+
+        with self.span(stage, kind="stage") as rec:
+            self._depth += 1
+            if profiler is not None:
+                profiler.enable()
+            try:
+                yield
+            finally:
+                self._depth -= 1
+                if profiler is not None:
+                    profiler.disable()
+                    self.profile_dir.mkdir(parents=True, exist_ok=True)
+                    profiler.dump_stats(str(self.profile_dir
+                                            / f"{stage}.prof"))
+                if self.trace_memory:
+                    rec["mem_peak"] = tracemalloc.get_traced_memory()[1]
+                    if tracing:
+                        tracemalloc.stop()
+
+    def totals(self, by="step"):
+        ''' The number of records, the total duration and bytes of each
+        ``by`` (e.g., ``"step"``, ``"group"`` or ``"frame"``).
+        '''
+        totals = {}
+        for rec in self.records:
+            if rec.get("kind") == "stage" or by not in rec:
+                continue
+            tot = totals.setdefault(rec[by], dict(count=0, duration=0.,
+                                                  bytes_read=0,
+                                                  bytes_written=0))
+            tot["count"] += 1
+            tot["duration"] += rec["duration"]
+            tot["bytes_read"] += rec.get("bytes_read") or 0
+            tot["bytes_written"] += rec.get("bytes_written") or 0
+        return totals
@@ -1,13 +1,17 @@
 # import warnings
 from pathlib import Path
+import functools
+import importlib
 import shutil
 import os
 
-from astropy.io.fits import Card
+# NOTE: Do not import heavy packages (astropy, pandas, ...) at the top of
+#   this module: it is imported by ``import snuo1mpy``. See LazyModule.
 
 __all__ = ["MEDCOMB_KEYS", "SITE_HORIZONS", "GAIN_EPADU", "RDNOISE_E",
-           "KEYMAP", "USEFUL_KEYS",
-           "cards_gain_rdnoise"]
+           "GEOMETRY", "KEYMAP", "USEFUL_KEYS", "TEXT_KEYS", "INTEGER_KEYS",
+           "SUMMARY_SCHEMA",
+           "cards_gain_rdnoise", "parse_section", "frame_sections"]
 
 MEDCOMB_KEYS = dict(overwrite=True,
                     unit=None,
@@ -31,6 +35,15 @@ GAIN_EPADU = {"STX16803": 1.3600000143051147,
 RDNOISE_E = {"STX16803": 9.0,
              "Kepler": None}
 
+# The geometry of the unbinned full frame: the shape (ny, nx), the science
+# region (TRIMSEC) and the overscan (BIASSEC) as IRAF sections, e.g.,
+# "[1:4096,1:4096]" (1-indexed, inclusive, x first). ``None`` means the
+# whole frame (TRIMSEC) or no overscan (BIASSEC). The STX16803 (KAF-16803)
+# is read out without overscan. Use ``Preprocessor(geometry=...)`` to,
+# e.g., exclude the vignetted edges.
+GEOMETRY = {"STX16803": dict(shape=(4096, 4096), trimsec=None, biassec=None),
+            "Kepler": dict(shape=(4096, 4096), trimsec=None, biassec=None)}
+
 # <FITS Standard> : <our observatory>
 KEYMAP = {"EXPTIME": 'EXPTIME',
           "GAIN": 'EGAIN',
@@ -45,6 +58,29 @@ USEFUL_KEYS = ["DATE-OBS", "FILTER", "OBJECT", "EXPTIME", "IMAGETYP",
                "AIRMASS", "XBINNING", "YBINNING", "CCD-TEMP", "SET-TEMP",
                "OBJCTRA", "OBJCTDEC", "OBJCTALT"]
 
+# The USEFUL_KEYS of text and integer values (with the names of KEYMAP);
+# the others are float. Used to make SUMMARY_SCHEMA.
+TEXT_KEYS = [KEYMAP["DATE-OBS"], KEYMAP["FILTER"], KEYMAP["OBJECT"],
+             "IMAGETYP", "OBJCTRA", "OBJCTDEC"]
+INTEGER_KEYS = ["XBINNING", "YBINNING"]
+
+
+def _key_dtype(key):
+    if key in TEXT_KEYS:
+        return "str"
+    if key in INTEGER_KEYS:
+        return "Int64"
+    return "float64"
+
+
+# The dtypes of the summary columns (file, filesize, USEFUL_KEYS and
+# PROCESS). "str" columns keep the missing values as None. "Int64" is the
+# nullable integer of pandas.
+SUMMARY_SCHEMA = {"file": "str",
+                  "filesize": "Int64",
+                  **{key: _key_dtype(key) for key in USEFUL_KEYS},
+                  "PROCESS": "str"}
+
 
 def reset_dir(topdir):
     topdir = Path(topdir)
@@ -82,6 +118,8 @@ def cards_gain_rdnoise(instrument="STX16803", gain=None, rdnoise=None):
         The gain and read noise if you want to specify. Must be in the unit
         of electrons per ADU and electrons, respectively.
     '''
+    from astropy.io.fits import Card
+
     cs = []
 
     if gain is None:
@@ -103,3 +141,224 @@ def cards_gain_rdnoise(instrument="STX16803", gain=None, rdnoise=None):
           Card("COMMENT", rdnoisestr)]
 
     return cs
+
+
+def parse_section(section):
+    ''' Converts an IRAF section to numpy slices.
+    Parameters
+    ----------
+    section : str
+        E.g., ``"[11:4086,1:4096]"`` (1-indexed, inclusive, x first).
+
+    Returns
+    -------
+    yslice, xslice : slice
+        0-indexed, for ``data[yslice, xslice]``.
+    '''
+    try:
+        xsec, ysec = section.strip().strip("[]").split(",")
+        x1, x2 = [int(v) for v in xsec.split(":")]
+        y1, y2 = [int(v) for v in ysec.split(":")]
+    except ValueError:
+        raise ValueError(f"Invalid section: {section!r}")
+    return slice(y1 - 1, y2), slice(x1 - 1, x2)
+
+
+def _binned(sl, nbin, origin, npix):
+    # The binned pixels entirely inside the unbinned slice, relative to
+    # the origin of the (sub)frame. None if there is none.
+    start = max(-(-sl.start // nbin) - origin, 0)
+    stop = min(sl.stop // nbin - origin, npix)
+    return slice(start, stop) if stop > start else None
+
+
+def frame_sections(header, geometry):
+    ''' The science region and the overscan in the pixels of a frame.
+    Parameters
+    ----------
+    header : dict-like
+        The header of the frame: NAXIS1/2, XBINNING/YBINNING and the
+        subframe origin XORGSUBF/YORGSUBF (binned pixels, as MaxIm DL)
+        are used.
+
+    geometry : dict
+        The geometry of the unbinned full frame (see `GEOMETRY`).
+
+    Returns
+    -------
+    trim, bias : tuple of slice or None
+        The ``(yslice, xslice)`` of TRIMSEC and BIASSEC in the frame, or
+        ``None`` if not given (or BIASSEC is not in the subframe). The
+        binned pixels only partly inside a section are excluded.
+    '''
+    ny, nx = header["NAXIS2"], header["NAXIS1"]
+    xbin, ybin = int(header.get("XBINNING", 1)), int(header.get("YBINNING", 1))
+    xorg, yorg = header.get("XORGSUBF", 0), header.get("YORGSUBF", 0)
+    fullshape = geometry.get("shape")
+    if (fullshape is not None
+            and (yorg + ny > fullshape[0]//ybin
+                 or xorg + nx > fullshape[1]//xbin)):
+        # The binned full frame is shape // binning.
+        raise ValueError(f"The frame of {nx}x{ny} (binning {xbin}x{ybin}) "
+                         + f"is larger than the detector {fullshape}.")
+    sections = []
+    for key in ["trimsec", "biassec"]:
+        if geometry.get(key) is None:
+            sections.append(None)
+            continue
+        ysl, xsl = parse_section(geometry[key])
+        sec = (_binned(ysl, ybin, yorg, ny), _binned(xsl, xbin, xorg, nx))
+        if None in sec:
+            if key == "trimsec":
+                raise ValueError("TRIMSEC does not overlap the frame.")
+            sec = None  # e.g., a subframe without the overscan
+        sections.append(sec)
+    return tuple(sections)
+
+
+@functools.lru_cache(maxsize=None)
+def ccdproc_version():
+    ''' The version of ccdproc (for the headers), or ``None``.
+    '''
+    try:
+        # Not imported, as only the version is needed.
+        from importlib.metadata import PackageNotFoundError, version
+    except ImportError:
+        # Python 3.7 (importlib.metadata is new in 3.8)
+        try:
+            import ccdproc
+        except ImportError:
+            return None
+        return ccdproc.__version__
+
+    try:
+        return version("ccdproc")
+    except PackageNotFoundError:
+        return None
+
+
+def n_workers(n_jobs):
+    ''' Converts ``n_jobs`` to the actual number of workers.
+    ``None`` or non-positive values mean all the CPUs (e.g., ``-1``).
+    '''
+    if n_jobs is None or n_jobs <= 0:
+        return os.cpu_count() or 1
+    return int(n_jobs)
+
+
+def run_jobs(func, tasks, n_jobs=1, executor=None, thread=False,
+             callback=None):
+    ''' Calls ``func(*task)`` for each of ``tasks`` and returns the results.
+    Parameters
+    ----------
+    func : callable
+        The function to be called. If a process pool is used, it must be
+        picklable, i.e., defined at the top level of a module.
+
+    tasks : list of tuple
+        The positional arguments for each call.
+
+    n_jobs : int or None, optional
+        The number of workers. If ``1`` (default), everything is done
+        serially in this process without any pool. ``None`` or ``-1``
+        means all the CPUs.
+
+    executor : `~concurrent.futures.Executor` or None, optional
+        The executor to be used instead of making a new pool. It is not
+        shut down after the jobs are done, so that it can be reused.
+
+    thread : bool, optional
+        If ``True``, a thread pool is used instead of a process pool
+        (useful for I/O bound jobs).
+
+    callback : callable, optional
+        Called as ``callback(i, result)`` in this process as soon as the
+        ``i``-th job is finished (e.g., to record it to the manifest), so
+        that the jobs finished before a failure are not lost.
+
+    Notes
+    -----
+    The results are always in the same order as ``tasks``, regardless of
+    the order the jobs finish, so that the outcome is identical to the
+    serial run. If a job raises, the jobs not started yet are cancelled,
+    those already running are waited for (and passed to ``callback``),
+    and then the first error is raised.
+    '''
+    tasks = list(tasks)
+    if executor is None and (n_jobs == 1 or len(tasks) <= 1):
+        results = []
+        for i, task in enumerate(tasks):
+            results.append(func(*task))
+            if callback is not None:
+                callback(i, results[-1])
+        return results
+
+    if executor is not None:
+        return _collect_jobs(executor, func, tasks, callback)
+
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+    pool = ThreadPoolExecutor if thread else ProcessPoolExecutor
+    with pool(max_workers=min(n_workers(n_jobs), len(tasks))) as ex:
+        return _collect_jobs(ex, func, tasks, callback)
+
+
+def _collect_jobs(executor, func, tasks, callback=None):
+    ''' Submits the jobs of `run_jobs` and collects them as they finish.
+    '''
+    from concurrent.futures import CancelledError, as_completed
+
+    futures = {executor.submit(func, *task): i
+               for i, task in enumerate(tasks)}
+    results = [None]*len(tasks)
+    error = None
+    for future in as_completed(futures):
+        try:
+            result = future.result()
+        except CancelledError:
+            continue
+        except Exception as err:
+            if error is None:
+                error = err
+                for other in futures:
+                    other.cancel()
+            continue
+        i = futures[future]
+        results[i] = result
+        if callback is not None:
+            callback(i, result)
+    if error is not None:
+        raise error
+    return results
+
+
+class LazyModule():
+    def __init__(self, name, hint=None):
+        """ A module which is imported when its attribute is first used.
+        Parameters
+        ----------
+        name : str
+            The full name of the module, e.g., ``"ysfitsutilpy"``.
+
+        hint : str, optional
+            The message of the ImportError if the module is not installed.
+        """
+        self._name = name
+        self._hint = hint
+        self._module = None
+
+    def __getattr__(self, attr):
+        # Only called for the attributes not found in the instance, i.e.,
+        # never for _name, _hint, _module.
+        if self._module is None:
+            try:
+                self._module = importlib.import_module(self._name)
+            except ImportError as err:
+                if self._hint is None:
+                    raise
+                raise ImportError(self._hint) from err
+        return getattr(self._module, attr)
+
+    def __repr__(self):
+        loaded = "loaded" if self._module is not None else "not loaded"
+        return f"<LazyModule {self._name!r} ({loaded})>"
@@ -0,0 +1,99 @@
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+SHAPE = (24, 30)
+
+
+class Night():
+    def __init__(self, topdir, shape=SHAPE, start="2018-04-12T10:30:00"):
+        """ A tiny night of uint16 frames, as if already organized (see
+        `preprocessor`), for the tests of the reduction.
+        """
+        self.topdir = Path(topdir)
+        self.framedir = self.topdir / "frames"
+        self.framedir.mkdir(parents=True, exist_ok=True)
+        self.shape = shape
+        self.time = datetime.fromisoformat(start)
+        self.paths = []
+        self.headers = []
+        ny, nx = shape
+        yy, xx = np.mgrid[-1:1:ny*1j, -1:1:nx*1j]
+        self.flat = 1 - 0.1*(xx**2 + yy**2)
+        self.bias = 1000 + 5*np.sin(xx*3)
+
+    def add(self, obj, exptime=0., filt="V", n=1, level=0., ccdtemp=-25.):
+        ''' Writes ``n`` frames of OBJECT ``obj``. Returns their paths.
+        '''
+        paths = []
+        for _ in range(n):
+            idx = len(self.paths) + 1
+            rng = np.random.default_rng(idx)
+            data = (self.bias + 0.05*exptime + level*self.flat
+                    + rng.normal(0, 3, self.shape))
+            hdr = fits.Header()
+            hdr["DATE-OBS"] = self.time.strftime("%Y-%m-%dT%H:%M:%S")
+            hdr["EXPTIME"] = exptime
+            hdr["FILTER"] = filt
+            hdr["OBJECT"] = obj
+            hdr["IMAGETYP"] = "Light Frame"
+            hdr["XBINNING"] = 1
+            hdr["YBINNING"] = 1
+            hdr["CCD-TEMP"] = ccdtemp
+            hdr["SET-TEMP"] = -25.
+            hdr["BUNIT"] = "ADU"
+            path = self.framedir / f"{obj}-{idx:04d}-{filt}-{exptime:g}.fits"
+            fits.PrimaryHDU(np.clip(data, 0, 65535).astype(np.uint16),
+                            header=hdr).writeto(path, overwrite=True)
+            self.paths.append(path)
+            self.headers.append(fits.getheader(path))
+            paths.append(path)
+            self.time += timedelta(seconds=exptime + 10)
+        return paths
+
+    def add_default(self):
+        ''' bias, darks of 5 and 30 s, V/R sky flats and 4 object frames.
+        '''
+        self.add("bias", n=3)
+        self.add("dark", 5., n=3)
+        self.add("dark", 30., n=3)
+        for filt in ["V", "R"]:
+            self.add("skyflat", 5., filt, n=3, level=20000.)
+        for filt in ["V", "R", "V", "R"]:
+            self.add("M51", 30., filt, level=500.)
+        return self
+
+    def preprocessor(self, **kwargs):
+        ''' The Preprocessor of the night, with the results of
+        ``organize_raw`` (the paths and the raw summary) in its catalog.
+        '''
+        from snuo1mpy.fitsio import summary_from_headers
+        from snuo1mpy.preprocessor import Preprocessor
+        from snuo1mpy.utils import USEFUL_KEYS
+        prep = Preprocessor(self.topdir, self.topdir / "rawdata", **kwargs)
+        objpaths = [p for p, h in zip(self.paths, self.headers)
+                    if h["OBJECT"] not in ["bias", "dark", "skyflat"]]
+        prep.catalog.set_paths("new", self.paths)
+        prep.catalog.set_paths("obj", objpaths)
+        summary = summary_from_headers(self.paths, self.headers,
+                                       keywords=USEFUL_KEYS)
+        prep._store_summary("raw", summary)
+        return prep
+
+
+@pytest.fixture
+def make_night(tmp_path):
+    """ Makes a `Night` in ``tmp_path / name``, for the tests comparing
+    the reductions of the same night.
+    """
+    def make(name="night"):
+        return Night(tmp_path / name)
+    return make
+
+
+@pytest.fixture
+def night(make_night):
+    return make_night()
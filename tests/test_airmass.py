@@ -0,0 +1,112 @@
+import numpy as np
+import pytest
+from astropy import units as u
+from astropy.coordinates import AltAz, Angle, EarthLocation, SkyCoord
+from astropy.io import fits
+from astropy.time import Time
+
+from snuo1mpy.airmass import airmass_headers, calc_airmass
+
+SITE = dict(SITELONG=126.95333, SITELAT=37.45694, HEIGHT=200.)
+
+
+def _airmass_one(hdr):
+    ''' The per-file reference, ``ysfitsutilpy.airmass_from_hdr``.
+    '''
+    yfu = pytest.importorskip("ysfitsutilpy")
+    try:
+        return yfu.airmass_from_hdr(fits.Header(hdr), ra_key="OBJCTRA",
+                                    dec_key="OBJCTDEC", lon_key="SITELONG",
+                                    lat_key="SITELAT", equinox="J2000",
+                                    frame="icrs", return_header=True)
+    except ValueError:
+        pytest.skip("This ysfitsutilpy cannot parse the sexagesimal RA.")
+
+
+def _header(date_obs, exptime, alt=None, az=None, ra=None, dec=None):
+    hdr = fits.Header(SITE)
+    hdr["DATE-OBS"] = date_obs
+    hdr["EXPTIME"] = exptime
+    if alt is not None:
+        # The object at (alt, az) at the start of the exposure.
+        loc = EarthLocation(lon=SITE["SITELONG"]*u.deg,
+                            lat=SITE["SITELAT"]*u.deg,
+                            height=SITE["HEIGHT"]*u.m)
+        coo = SkyCoord(alt=alt*u.deg, az=az*u.deg, frame=AltAz(
+            obstime=Time(date_obs, scale="utc"), location=loc)).icrs
+        ra, dec = coo.ra, coo.dec
+    hdr["OBJCTRA"] = ra.to_string(unit=u.hourangle, sep=" ", precision=2)
+    hdr["OBJCTDEC"] = dec.to_string(unit=u.deg, sep=" ", precision=1,
+                                    alwayssign=True)
+    return hdr
+
+
+def test_calc_airmass():
+    assert calc_airmass(0.) == pytest.approx(1.)
+    assert calc_airmass(60.) == pytest.approx(1.9960, abs=1e-4)
+    # Finite at the horizon: sqrt(2*scale + 1).
+    assert calc_airmass(90.) == pytest.approx(np.sqrt(1501.))
+
+
+def _headers():
+    return [
+        _header("2018-04-12T14:30:00", 60., alt=75., az=180.),
+        _header("2018-04-12T15:00:00", 300., alt=40., az=250.),
+        _header("2018-04-12T16:10:00", 120., alt=20., az=100.),
+        # Near the horizon, rising during the 10-min exposure.
+        _header("2018-04-12T17:00:00", 600., alt=3., az=80.),
+        _header("2018-04-12T17:00:00", 0., ra=Angle(202.47, u.deg),
+                dec=Angle(47.195, u.deg)),
+    ]
+
+
+def test_airmass_headers():
+    headers = _headers()
+    headers[0]["ALT"] = "stale"
+    assert airmass_headers(headers) == []
+    for hdr in headers:
+        for suffix in ["", "_MID", "_END"]:
+            alt = Angle(hdr["ALT" + suffix], unit=u.deg).deg
+            assert hdr["ZD" + suffix] == pytest.approx(90 - alt, abs=1e-3)
+            Angle(hdr["AZ" + suffix], unit=u.deg)
+        # Simpson's rule of the start, middle and end.
+        ams = calc_airmass(np.array([hdr["ZD"], hdr["ZD_MID"],
+                                     hdr["ZD_END"]]))
+        assert hdr["AIRMASS"] == pytest.approx(
+            (ams[0] + 4*ams[1] + ams[2])/6, rel=1e-9)
+        assert len(hdr["HISTORY"]) == 2
+        assert "Stetson" in "".join(hdr["COMMENT"])
+    assert Angle(headers[0]["ALT"], unit=u.deg).deg == pytest.approx(75.)
+    assert headers[0]["ALT_MID"] > headers[0]["ALT_END"]  # setting
+    assert headers[3]["ALT"] < headers[3]["ALT_END"]  # rising
+    assert headers[3]["AIRMASS"] > 10
+    assert headers[4]["ZD"] == headers[4]["ZD_END"]  # EXPTIME = 0
+
+
+def test_airmass_headers_reference():
+    headers = _headers()
+    assert airmass_headers(headers) == []
+    for hdr in headers:
+        ref = _airmass_one(hdr)
+        assert hdr["AIRMASS"] == pytest.approx(ref["AIRMASS"], rel=1e-6)
+        for key in ["ZD", "ZD_MID", "ZD_END"]:
+            assert hdr[key] == pytest.approx(ref[key], abs=1e-4)
+        for key in ["ALT", "AZ", "ALT_MID", "AZ_MID", "ALT_END", "AZ_END"]:
+            assert Angle(hdr[key], unit=u.deg).deg == pytest.approx(
+                Angle(ref[key], unit=u.deg).deg, abs=1e-4)
+
+
+def test_airmass_headers_missing_keys():
+    headers = [_header("2018-04-12T14:30:00", 60., alt=60., az=180.),
+               fits.Header(dict(EXPTIME=1.)),
+               _header("2018-04-12T14:31:00", 60., alt=61., az=180.)]
+    del headers[2]["HEIGHT"]
+    assert airmass_headers(headers) == [1, 2]
+    assert "AIRMASS" in headers[0]
+    assert "AIRMASS" not in headers[1] and "AIRMASS" not in headers[2]
+    # HEIGHT is not needed if given.
+    assert airmass_headers(headers[2:], height=200.) == []
+    ref = headers[2].copy()
+    ref["HEIGHT"] = 200.
+    airmass_headers([ref])
+    assert headers[2]["AIRMASS"] == ref["AIRMASS"]
@@ -0,0 +1,280 @@
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from snuo1mpy.astrometry import run_astrometry, solve_field, wcs_hint
+
+# A fake solve-field: writes what astrometry.net would (input.solved and
+# the image with WCS, or input.wcs for an xylist) as set by STUB_MODE.
+STUB = """#!{python}
+import json, os, sys, time
+from pathlib import Path
+from astropy.io import fits
+
+args = sys.argv[1:]
+inpath = Path(args[0])
+scratch = Path(args[args.index("-D") + 1])
+newpath = Path(args[args.index("-N") + 1]) if "-N" in args else None
+mode = os.environ.get("STUB_MODE", "ok")
+target = os.path.realpath(inpath)
+with open(os.environ["STUB_CALLS"], "a") as ff:
+    ff.write(json.dumps(dict(target=target, args=args,
+                             start=time.time())) + "\\n")
+print("stub: reading", target)
+print("stub: scratch", scratch)
+if "STUB_CHILD" in os.environ:
+    # As astrometry-engine, a child which outlives solve-field if only
+    # solve-field is killed.
+    import subprocess
+    child = subprocess.Popen([sys.executable, "-c",
+                              "import time; time.sleep(60)"])
+    with open(os.environ["STUB_CHILD"], "a") as ff:
+        ff.write(f"{{child.pid}}\\n")
+time.sleep(float(os.environ.get("STUB_SLEEP", "0")))
+if mode == "flaky":
+    count = Path(os.environ["STUB_CALLS"] + ".count")
+    if not count.exists():
+        count.write_text("1")
+        mode = "fail"
+if mode == "fail":
+    print("stub: did not solve")
+    sys.exit(1)
+ra = float(args[args.index("--ra") + 1]) + 1 if "--ra" in args else 10.
+dec = float(args[args.index("--dec") + 1]) if "--dec" in args else 20.
+wcs = dict(CTYPE1="RA---TAN", CTYPE2="DEC--TAN", CRPIX1=5.5, CRPIX2=4.5,
+           CRVAL1=ra, CRVAL2=dec, CDELT1=-0.31/3600, CDELT2=0.31/3600,
+           CUNIT1="deg", CUNIT2="deg")
+(scratch / "input.solved").write_bytes(b"\\x01")
+if newpath is None:
+    fits.PrimaryHDU(header=fits.Header(wcs)).writeto(scratch / "input.wcs")
+else:
+    with fits.open(inpath) as hdul:
+        hdul[0].header.update(wcs)
+        hdul.writeto(newpath)
+print("stub: solved", target)
+"""
+
+
+@pytest.fixture
+def stub(tmp_path, monkeypatch):
+    bindir = tmp_path / "bin"
+    bindir.mkdir()
+    exe = bindir / "solve-field"
+    exe.write_text(STUB.format(python=sys.executable))
+    exe.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bindir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setenv("STUB_CALLS", str(tmp_path / "calls.jsonl"))
+
+    def calls():
+        try:
+            with open(tmp_path / "calls.jsonl") as ff:
+                return [json.loads(line) for line in ff]
+        except FileNotFoundError:
+            return []
+    return calls
+
+
+def _frame(path, value=0):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    data = np.full((8, 10), value, dtype=np.float32)
+    fits.PrimaryHDU(data).writeto(path)
+    return path
+
+
+def test_solve_field_solved(stub, tmp_path):
+    fpath = _frame(tmp_path / "red" / "M51.fits", 3)
+    log = solve_field(fpath, tmp_path / "scratch")
+    assert log["status"] == "solved"
+    assert log["attempts"] == 1
+    assert log["message"].splitlines()[-1] == f"stub: solved {fpath}"
+    assert wcs_hint(fpath)["ra"] == pytest.approx(10.)
+    assert np.all(fits.getdata(fpath) == 3)
+    # The scratch directory is in scratchdir and removed.
+    assert log["scratch"].startswith(str(tmp_path / "scratch" / "M51_"))
+    assert not os.path.exists(log["scratch"])
+    assert len(stub()) == 1
+
+
+def test_solve_field_failed(stub, tmp_path, monkeypatch):
+    monkeypatch.setenv("STUB_MODE", "fail")
+    fpath = _frame(tmp_path / "M51.fits")
+    before = fpath.read_bytes()
+    log = solve_field(fpath, tmp_path / "scratch", retries=2)
+    assert log["status"] == "failed"
+    assert log["attempts"] == 3
+    assert len(stub()) == 3
+    assert log["message"].splitlines()[-1] == "stub: did not solve"
+    # The frame is untouched.
+    assert fpath.read_bytes() == before
+
+
+def test_solve_field_timeout(stub, tmp_path, monkeypatch):
+    monkeypatch.setenv("STUB_SLEEP", "30")
+    fpath = _frame(tmp_path / "M51.fits")
+    before = fpath.read_bytes()
+    log = solve_field(fpath, tmp_path / "scratch", timeout=1, retries=1)
+    assert log["status"] == "timeout"
+    assert log["attempts"] == 2
+    assert log["duration"] < 20
+    assert fpath.read_bytes() == before
+    assert not os.path.exists(log["scratch"])
+
+
+def _running(pid):
+    try:
+        with open(f"/proc/{pid}/stat") as ff:
+            # The state is after the name (in parentheses).
+            return ff.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except FileNotFoundError:
+        return False
+
+
+@pytest.mark.skipif(not os.path.exists("/proc/self/stat"),
+                    reason="needs /proc")
+def test_solve_field_timeout_kills_children(stub, tmp_path, monkeypatch):
+    childfile = tmp_path / "children.txt"
+    monkeypatch.setenv("STUB_SLEEP", "30")
+    monkeypatch.setenv("STUB_CHILD", str(childfile))
+    fpath = _frame(tmp_path / "M51.fits")
+    log = solve_field(fpath, tmp_path / "scratch", timeout=2, retries=1)
+    assert log["status"] == "timeout"
+    pids = [int(pid) for pid in childfile.read_text().split()]
+    assert len(pids) == 2
+    # The children of each trial are killed with solve-field.
+    time.sleep(0.5)
+    assert not any(_running(pid) for pid in pids)
+
+
+def test_solve_field_retry(stub, tmp_path, monkeypatch):
+    monkeypatch.setenv("STUB_MODE", "flaky")
+    fpath = _frame(tmp_path / "M51.fits")
+    log = solve_field(fpath, tmp_path / "scratch", retries=1,
+                      keep_scratch=True)
+    assert log["status"] == "solved"
+    assert log["attempts"] == 2
+    assert wcs_hint(fpath) is not None
+    # Only the successful trial is left in the kept scratch directory.
+    assert os.path.exists(os.path.join(log["scratch"], "input.solved"))
+
+
+def test_solve_field_xylist(stub, tmp_path):
+    fpath = _frame(tmp_path / "M51.fits", 5)
+    xyls = tmp_path / "M51.xyls"
+    table = fits.BinTableHDU.from_columns(
+        [fits.Column(name=name, format="E", array=np.arange(3.))
+         for name in ["X", "Y", "FLUX"]])
+    table.header["IMAGEW"] = 10
+    table.header["IMAGEH"] = 8
+    fits.HDUList([fits.PrimaryHDU(), table]).writeto(xyls)
+    log = solve_field(fpath, tmp_path / "scratch", xylist=xyls)
+    assert log["status"] == "solved"
+    args = stub()[0]["args"]
+    assert "-N" not in args
+    assert args[args.index("--width") + 1] == "10"
+    assert wcs_hint(fpath)["dec"] == pytest.approx(20.)
+    assert np.all(fits.getdata(fpath) == 5)
+
+
+def test_run_astrometry_concurrent(stub, tmp_path, monkeypatch):
+    monkeypatch.setenv("STUB_SLEEP", "2")
+    # The same names in different directories must not share the scratch.
+    fpaths = [_frame(tmp_path / f"night{i}" / "M51.fits", i)
+              for i in range(4)]
+    log = tmp_path / "astrometry.log"
+    logs = run_astrometry(fpaths, scratchdir=tmp_path / "scratch",
+                          log=log, n_jobs=4)
+    assert [item["status"] for item in logs] == ["solved"]*4
+    assert len({item["scratch"] for item in logs}) == 4
+    for i, fpath in enumerate(fpaths):
+        assert np.all(fits.getdata(fpath) == i)
+        assert wcs_hint(fpath) is not None
+    # They ran at the same time: all started before the first finished.
+    starts = sorted(call["start"] for call in stub())
+    assert starts[-1] - starts[0] < 2
+    # In the order they are done.
+    with open(log) as ff:
+        items = [json.loads(line) for line in ff]
+    assert sorted(items, key=lambda item: item["file"]) \
+        == sorted(logs, key=lambda item: item["file"])
+
+
+def test_run_astrometry_log_on_failure(stub, tmp_path, monkeypatch):
+    from snuo1mpy import astrometry
+    monkeypatch.setenv("STUB_SLEEP", "1")
+    fpaths = [_frame(tmp_path / f"M51-{i}.fits") for i in range(3)]
+    solve = astrometry._solve_hinted
+
+    def _solve_hinted(fpath, *args):
+        if fpath == fpaths[1]:
+            # After the others have started.
+            time.sleep(0.5)
+            raise RuntimeError("crashed")
+        return solve(fpath, *args)
+
+    monkeypatch.setattr(astrometry, "_solve_hinted", _solve_hinted)
+    log = tmp_path / "astrometry.log"
+    with pytest.raises(RuntimeError, match="crashed"):
+        run_astrometry(fpaths, scratchdir=tmp_path / "scratch", log=log,
+                       n_jobs=3)
+    # The frames solved at the same time are still logged.
+    with open(log) as ff:
+        items = [json.loads(line) for line in ff]
+    assert sorted(item["file"] for item in items) \
+        == [str(fpaths[0]), str(fpaths[2])]
+    assert all(item["status"] == "solved" for item in items)
+
+
+def test_run_astrometry_reuse_wcs(stub, tmp_path):
+    fpaths = [_frame(tmp_path / f"{obj}-{i}.fits")
+              for i, obj in enumerate(["M51", "M42", "M51", "M51"])]
+    hints = [dict(ra=ra, dec=30., xbin=1, ybin=1, group=obj)
+             for ra, obj in [(200., "M51"), (80., "M42"),
+                             (200., "M51"), (200., "M51")]]
+    logs = run_astrometry(fpaths, scratchdir=tmp_path / "scratch",
+                          hints=hints, n_jobs=2, reuse_wcs=True)
+    assert [item["status"] for item in logs] == ["solved"]*4
+    calls = {os.path.basename(c["target"]): c["args"] for c in stub()}
+    order = [os.path.basename(c["target"]) for c in stub()]
+    # The first frames of the groups, then the others seeded by M51-0,
+    # which the stub solved at RA = 201.
+    assert sorted(order[:2]) == ["M42-1.fits", "M51-0.fits"]
+    for name, ra in [("M51-0.fits", 200.), ("M42-1.fits", 80.),
+                     ("M51-2.fits", 201.), ("M51-3.fits", 201.)]:
+        args = calls[name]
+        assert float(args[args.index("--ra") + 1]) == pytest.approx(ra)
+
+
+def test_run_astrometry_reuse_wcs_unsolved(stub, tmp_path, monkeypatch):
+    monkeypatch.setenv("STUB_MODE", "flaky")
+    fpaths = [_frame(tmp_path / f"M51-{i}.fits") for i in range(3)]
+    hints = [dict(ra=200., dec=30., xbin=1, ybin=1, group="M51")]*3
+    logs = run_astrometry(fpaths, scratchdir=tmp_path / "scratch",
+                          hints=hints, n_jobs=2, reuse_wcs=True)
+    # The first one failed, so the others use their own hints.
+    assert [item["status"] for item in logs] == ["failed"] + ["solved"]*2
+    for call in stub():
+        args = call["args"]
+        assert float(args[args.index("--ra") + 1]) == pytest.approx(200.)
+
+
+@pytest.mark.parametrize("seed_bin, frame_bin", [(1, 2), (2, 1)])
+def test_run_astrometry_reuse_wcs_binning(stub, tmp_path, seed_bin,
+                                          frame_bin):
+    # The stub solves any frame at 0.31 arcsec per (binned) pixel.
+    fpaths = [_frame(tmp_path / f"M51-{i}.fits") for i in range(2)]
+    hints = [dict(ra=200., dec=30., xbin=b, ybin=b, group="M51")
+             for b in [seed_bin, frame_bin]]
+    logs = run_astrometry(fpaths, scratchdir=tmp_path / "scratch",
+                          hints=hints, reuse_wcs=True)
+    assert [item["status"] for item in logs] == ["solved"]*2
+    args = stub()[1]["args"]
+    scale = 0.31*frame_bin/seed_bin
+    assert float(args[args.index("-L") + 1]) == pytest.approx(0.95*scale,
+                                                              abs=1e-4)
+    assert float(args[args.index("-U") + 1]) == pytest.approx(1.05*scale,
+                                                              abs=1e-4)
@@ -0,0 +1,76 @@
+import os
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from snuo1mpy.calib import MasterCache, to_integer, write_image
+
+
+def _masters(tmp_path, n=3, shape=(10, 10)):
+    paths = []
+    for k in range(n):
+        path = tmp_path / f"master{k}.fits"
+        fits.PrimaryHDU(np.full(shape, k + 1, dtype=np.float32)).writeto(path)
+        paths.append(path)
+    return paths
+
+
+def test_master_cache(tmp_path):
+    paths = _masters(tmp_path)
+    nbytes = 10*10*4
+    cache = MasterCache(max_bytes=2*nbytes)
+    for path in paths + paths[-1:]:
+        cache.get_array("bias", None, path)
+    assert (cache.misses, cache.hits) == (3, 1)
+    assert len(cache) == 2 and cache.nbytes == 2*nbytes
+
+    flat = cache.get_array("flat", None, paths[1], reciprocal=True)
+    np.testing.assert_allclose(flat, 0.5)
+    assert len(cache) == 2
+
+    # A lower cap evicts the least recently used frames right away, but
+    # keeps the last one.
+    cache.resize(nbytes // 2)
+    assert len(cache) == 1 and cache.nbytes == nbytes
+    cache.get_array("flat", None, paths[1], reciprocal=True)
+    assert cache.hits == 2
+
+    cache.clear()
+    assert len(cache) == 0 and cache.nbytes == 0
+
+
+def test_master_cache_header(tmp_path):
+    paths = _masters(tmp_path, n=1)
+    cache = MasterCache(max_bytes=None)
+    hdr = cache.get_header("dark", None, paths[0])
+    assert "DARKRATE" not in hdr
+    assert cache.get_header("dark", None, paths[0]) is hdr
+    assert (cache.misses, cache.hits) == (1, 1)
+
+    # Read again once the master is made again.
+    fits.writeto(paths[0], np.ones((10, 10), dtype=np.float32),
+                 fits.Header(dict(DARKRATE=True)), overwrite=True)
+    os.utime(paths[0], ns=(0, 0))
+    assert cache.get_header("dark", None, paths[0])["DARKRATE"]
+
+
+@pytest.mark.parametrize("dtype, bzero, low, high",
+                         [("uint16", 3276.8, 0., 6553.5),
+                          ("int16", 0., -3276.8, 3276.7)])
+def test_write_image_integer(tmp_path, dtype, bzero, low, high):
+    data = np.array([[1.04, 1.06, -0.04, 0.],
+                     [low - 100, low, high, high + 100]], dtype=np.float32)
+    stored, bscale, bzero_ = to_integer(data, dtype=dtype, bscale=0.1)
+    assert stored.dtype == np.int16
+    assert (bscale, bzero_) == (0.1, pytest.approx(bzero))
+
+    path = write_image(tmp_path / "int.fits", data, fits.Header(),
+                       dtype=dtype, bscale=0.1)
+    with fits.open(path) as hdul:
+        assert hdul[0].header["BITPIX"] == 16
+        assert hdul[0].header["BSCALE"] == 0.1
+        # Rounded to 0.1 and clipped to the range.
+        np.testing.assert_allclose(hdul[0].data,
+                                   [[1.0, 1.1, 0., 0.],
+                                    [low, low, high, high]], atol=1e-4)
@@ -0,0 +1,62 @@
+import sqlite3
+from contextlib import closing
+from pathlib import Path
+
+import pandas as pd
+
+from snuo1mpy.catalog import Catalog
+
+
+def test_paths(tmp_path):
+    cat = Catalog(tmp_path / "catalog.sqlite")
+    assert cat.get_paths("obj") is None
+    cat.set_paths("new", ["b.fits", "a.fits"], sources=["raw/1", None])
+    assert cat.get_paths("new") == [Path("b.fits"), Path("a.fits")]
+    assert cat.get_sources("new") == {Path("b.fits"): "raw/1",
+                                      Path("a.fits"): None}
+    # Saved with no file (e.g., a night without object frames) is not
+    # the same as never saved.
+    cat.set_paths("obj", [])
+    assert cat.get_paths("obj") == []
+    assert cat.get_paths("reduced") is None
+    cat.set_paths("new", [])
+    assert cat.get_paths("new") == []
+
+
+def test_paths_legacy(tmp_path):
+    # A catalog made before the saved kinds were recorded.
+    path = tmp_path / "catalog.sqlite"
+    with closing(sqlite3.connect(str(path))) as con, con:
+        con.execute("CREATE TABLE paths (kind TEXT, idx INTEGER, "
+                    + "path TEXT, source TEXT, PRIMARY KEY (kind, idx))")
+        con.execute("INSERT INTO paths VALUES ('new', 0, 'a.fits', NULL)")
+    cat = Catalog(path)
+    assert cat.get_paths("new") == [Path("a.fits")]
+    assert cat.get_paths("obj") is None
+
+
+def test_masters(tmp_path):
+    cat = Catalog(tmp_path / "catalog.sqlite")
+    assert cat.get_masters("dark") is None
+    cat.set_masters("dark", {("dark", 30.0): "dark-30.0.fits"})
+    assert cat.get_masters("dark") == {("dark", 30.0):
+                                       Path("dark-30.0.fits")}
+    cat.set_masters("flat", {})
+    assert cat.get_masters("flat") == {}
+    assert cat.get_masters("bias") is None
+
+
+def test_query(tmp_path):
+    cat = Catalog(tmp_path / "catalog.sqlite")
+    assert cat.get_summary("raw") is None
+    table = pd.DataFrame({"file": ["a.fits", "b.fits", "c.fits"],
+                          "OBJECT": ["M51", "M42", "M51"],
+                          "DATE-OBS": ["2018-04-12T10:00:00",
+                                       "2018-04-12T11:00:00",
+                                       "2018-04-12T12:00:00"]})
+    cat.set_summary("raw", table)
+    assert cat.get_summary("raw").equals(table)
+    m51 = cat.query("raw", where={"OBJECT": "M51"},
+                    date_range=("2018-04-12T11:00:00",
+                                "2018-04-12T13:00:00"))
+    assert m51["file"].tolist() == ["c.fits"]
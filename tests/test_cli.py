@@ -0,0 +1,58 @@
+import json
+
+import pytest
+
+from snuo1mpy.cli import main, parse_size
+
+pytest.importorskip("ysfitsutilpy")
+
+
+def _report(capsys, *argv):
+    assert main(list(argv)) == 0
+    line = capsys.readouterr().out.strip().splitlines()[-1]
+
+    def _invalid(const):
+        raise ValueError(f"{const} is not valid JSON.")
+    return json.loads(line, parse_constant=_invalid)
+
+
+def test_parse_size():
+    assert parse_size("2G") == 2*2**30
+    assert parse_size("512mb") == 512*2**20
+    assert parse_size("1048576") == 2**20
+
+
+def test_main_report(night, capsys, tmp_path):
+    night.add_default()
+    night.preprocessor()
+    topdir = str(night.topdir)
+    report = _report(capsys, "bias", topdir, "--report",
+                     str(tmp_path / "perf.jsonl"))
+    assert report["stage"] == "bias"
+    assert (report["n_input"], report["n_output"]) == (3, 1)
+    assert report["bytes_read"] == sum(p.stat().st_size
+                                       for p in night.paths[:3])
+    assert report["bytes_written"] == (night.topdir / "bias.fits").stat() \
+        .st_size
+    assert report["frames_per_s"] > 0
+    assert json.loads((tmp_path / "perf.jsonl").read_text()) == report
+
+    _report(capsys, "dark", topdir)
+    _report(capsys, "flat", topdir)
+    report = _report(capsys, "preproc", topdir, "--memory-limit", "64M",
+                     "--jobs", "2")
+    assert (report["n_input"], report["n_output"]) == (4, 4)
+
+    # Nothing is done again: nothing is read or written.
+    report = _report(capsys, "preproc", topdir, "--resume")
+    assert report["n_input"] == report["n_output"] == 0
+    assert report["bytes_read"] == report["bytes_written"] == 0
+    assert report["frames_per_s"] == 0
+
+    # Only the V flat is made again from its 4 frames.
+    night.add("skyflat", 5., "V", n=1, level=20000.)
+    night.preprocessor()
+    report = _report(capsys, "flat", topdir, "--resume")
+    assert (report["n_input"], report["n_output"]) == (4, 1)
+    assert report["bytes_written"] == (night.topdir / "skyflat-V.fits") \
+        .stat().st_size
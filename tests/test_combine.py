@@ -0,0 +1,159 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+from astropy.nddata import CCDData
+
+from snuo1mpy.combine import stream_combine
+
+yfu = pytest.importorskip("ysfitsutilpy")
+
+SHAPE = (23, 17)
+EXPTIMES = [10., 20., 30., 40., 50.]
+
+
+def _write(path, data, **cards):
+    hdu = fits.PrimaryHDU(data)
+    hdu.header.update(cards)
+    hdu.writeto(path)
+    return path
+
+
+@pytest.fixture
+def frames(tmp_path):
+    ''' Five uint16 frames (BZERO = 32768), a bias, a dark and a dark
+    current rate image, as the paths and the float64 data.
+    '''
+    rng = np.random.default_rng(42)
+    ny, nx = SHAPE
+    yy, xx = np.mgrid[:ny, :nx]
+    paths, data = [], []
+    for k, exptime in enumerate(EXPTIMES):
+        raw = np.round(1000 + 50*k + 3*xx + yy + exptime*0.5
+                       + rng.normal(0, 5, SHAPE)).astype(np.uint16)
+        paths.append(_write(tmp_path / f"frame{k}.fits", raw,
+                            EXPTIME=exptime))
+        data.append(raw.astype(np.float64))
+    masters = {}
+    for name, level in [("bias", 990.), ("dark", 4.), ("rate", 0.25)]:
+        arr = (level*(1 + 0.01*xx) + rng.normal(0, 0.1, SHAPE))
+        masters[name] = arr.astype(np.float32)
+        _write(tmp_path / f"{name}.fits", masters[name])
+    return paths, data, masters
+
+
+def _combine_ccd(arrays, normalize_average=False):
+    ccds = [CCDData(arr.astype(np.float32), unit="adu") for arr in arrays]
+    return yfu.combine_ccd(ccds, output=None, combine_method="median",
+                           reject_method=None, unit=None,
+                           normalize_average=normalize_average,
+                           combine_uncertainty_function=None,
+                           verbose=False).data
+
+
+# 2 rows per block for 5 frames of 23 rows (not a divisor).
+MEMORY_LIMIT = 2*(2*4*len(EXPTIMES)*SHAPE[1])
+
+
+@pytest.mark.parametrize("memory_limit", [MEMORY_LIMIT, 2**28])
+@pytest.mark.parametrize("normalize_average", [False, True])
+def test_stream_combine(frames, tmp_path, memory_limit, normalize_average):
+    paths, data, _ = frames
+    out = stream_combine(paths, tmp_path / "comb.fits",
+                         memory_limit=memory_limit,
+                         normalize_average=normalize_average)
+    ref = _combine_ccd(data, normalize_average=normalize_average)
+    with fits.open(out) as hdul:
+        assert hdul[0].header["NCOMBINE"] == len(paths)
+        assert hdul[0].header["BITPIX"] == -32
+        np.testing.assert_allclose(hdul[0].data, ref, rtol=1e-6)
+
+
+@pytest.mark.parametrize("normalize_average", [False, True])
+def test_stream_combine_subtract(frames, tmp_path, normalize_average):
+    paths, data, masters = frames
+    subtract = [tmp_path / "bias.fits", None, tmp_path / "dark.fits"]
+    out = stream_combine(paths, tmp_path / "comb.fits",
+                         memory_limit=MEMORY_LIMIT, subtract=subtract,
+                         normalize_average=normalize_average)
+    ref = _combine_ccd([arr - masters["bias"] - masters["dark"]
+                        for arr in data],
+                       normalize_average=normalize_average)
+    np.testing.assert_allclose(fits.getdata(out), ref, rtol=1e-5)
+
+
+@pytest.mark.parametrize("per_second", [False, True])
+def test_stream_combine_rate(frames, tmp_path, per_second):
+    paths, data, masters = frames
+    out = stream_combine(paths, tmp_path / "comb.fits",
+                         memory_limit=MEMORY_LIMIT,
+                         subtract=[tmp_path / "bias.fits"],
+                         rate=tmp_path / "rate.fits", per_second=per_second)
+    arrays = [arr - masters["bias"] - masters["rate"]*exptime
+              for arr, exptime in zip(data, EXPTIMES)]
+    if per_second:
+        arrays = [arr/exptime for arr, exptime in zip(arrays, EXPTIMES)]
+    ref = _combine_ccd(arrays)
+    np.testing.assert_allclose(fits.getdata(out), ref, rtol=1e-5,
+                               atol=1e-5)
+    assert fits.getheader(out)["EXPTIME"] == (1. if per_second else 10.)
+
+
+def test_stream_combine_geometry(frames, tmp_path):
+    paths, data, _ = frames
+    # x of 3-15 and y of 2-22 (1-indexed) are the science region, x of
+    # 16-17 is the overscan.
+    geometry = dict(shape=SHAPE, trimsec="[3:15,2:22]",
+                    biassec="[16:17,1:23]")
+    out = stream_combine(paths, tmp_path / "comb.fits",
+                         memory_limit=2*4*len(paths)*13*4,  # 4 rows
+                         normalize_average=True, geometry=geometry)
+    ref = _combine_ccd([arr[1:22, 2:15] - np.median(arr[:, 15:17])
+                        for arr in data], normalize_average=True)
+    with fits.open(out) as hdul:
+        assert hdul[0].data.shape == (21, 13)
+        assert hdul[0].header["LTV1"] == -2
+        assert hdul[0].header["LTV2"] == -1
+        np.testing.assert_allclose(hdul[0].data, ref, rtol=1e-5)
+
+
+def test_stream_combine_shape_mismatch(frames, tmp_path):
+    paths, _, _ = frames
+    _write(tmp_path / "small.fits", np.zeros((5, 5), dtype=np.float32))
+    with pytest.raises(ValueError, match="shape"):
+        stream_combine(paths, tmp_path / "comb.fits",
+                       subtract=[tmp_path / "small.fits"])
+
+
+@pytest.mark.parametrize("dtype", ["uint16", "int16"])
+def test_stream_combine_integer(frames, tmp_path, dtype):
+    paths, data, _ = frames
+    out = stream_combine(paths, tmp_path / "comb.fits",
+                         memory_limit=MEMORY_LIMIT, dtype=dtype,
+                         normalize_average=True)
+    ref = _combine_ccd(data, normalize_average=True)
+    with fits.open(out) as hdul:
+        assert hdul[0].header["BITPIX"] == 16
+        # Rounded (not truncated) to the integers of BSCALE = 1.
+        np.testing.assert_array_equal(hdul[0].data, np.rint(ref))
+
+    # Clipped, not wrapped around.
+    out = stream_combine(paths, tmp_path / "comb.fits", dtype=dtype,
+                         subtract=[paths[0]]*40)
+    info = np.iinfo(dtype)
+    assert np.all(fits.getdata(out) == info.min)
+
+    with pytest.raises(ValueError, match="dtype"):
+        stream_combine(paths, tmp_path / "comb.fits", dtype="int32")
+
+
+def test_stream_combine_provenance(frames, tmp_path):
+    paths, _, _ = frames
+    out = stream_combine(paths, tmp_path / "comb.fits")
+    ccds = [CCDData.read(path, unit="adu") for path in paths]
+    ref = tmp_path / "ref.fits"
+    yfu.combine_ccd(ccds, output=ref, combine_method="median",
+                    reject_method=None, unit=None,
+                    combine_uncertainty_function=None, verbose=False)
+    keys = set(fits.getheader(out))
+    assert set(fits.getheader(ref)) - {"EXTEND"} <= keys
+    assert fits.getheader(out)["COMBMETH"] == "median"
@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from snuo1mpy.extract import (background, extract_file, extract_sources,
+                              find_peaks, xylist_path)
+
+SHAPE = (200, 256)
+# (x, y, amplitude) of the sources (0-indexed), brightest first.
+SOURCES = [(60.3, 50.7, 4000.), (180.6, 140.2, 2000.), (120.5, 90.5, 1000.),
+           (30.8, 160.4, 500.)]
+SKY, NOISE, SIGMA = 100., 5., 1.5
+
+
+def _image(sky=SKY, seed=0):
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[:SHAPE[0], :SHAPE[1]]
+    data = sky + rng.normal(0, NOISE, SHAPE)
+    for x, y, amp in SOURCES:
+        data += amp*np.exp(-((xx - x)**2 + (yy - y)**2)/(2*SIGMA**2))
+    return data.astype(np.float32)
+
+
+def test_background():
+    # A gradient sky is followed, and the sources are clipped.
+    yy, xx = np.mgrid[:SHAPE[0], :SHAPE[1]]
+    data = _image() + 0.1*xx
+    bkg, rms = background(data, box=32)
+    assert bkg.shape == SHAPE and bkg.dtype == np.float32
+    assert rms == pytest.approx(NOISE, rel=0.1)
+    inner = (slice(32, -32), slice(32, -32))
+    np.testing.assert_allclose(bkg[inner], (SKY + 0.1*xx)[inner], atol=2.)
+
+
+def test_find_peaks():
+    data = _image()
+    bkg, rms = background(data, box=32)
+    x, y, flux = find_peaks(data, bkg, rms, fwhm=2.355*SIGMA)
+    assert len(x) == len(SOURCES)
+    # Brightest first. The centroids of the 5x5 windows are pulled
+    # toward the peak pixel, but by much less than solve-field cares.
+    np.testing.assert_allclose(x, [s[0] for s in SOURCES], atol=0.25)
+    np.testing.assert_allclose(y, [s[1] for s in SOURCES], atol=0.25)
+    assert np.all(np.diff(flux) < 0)
+
+    # Not near the edges: the one at x = 30.8 is dropped.
+    x, y, _ = find_peaks(data, bkg, rms, border=40)
+    np.testing.assert_allclose(sorted(x), [60.3, 120.5, 180.6], atol=0.25)
+
+
+def test_extract_sources():
+    x, y, flux = extract_sources(_image(), box=32, max_sources=3)
+    # 1-indexed as FITS
+    np.testing.assert_allclose(x, [s[0] + 1 for s in SOURCES[:3]],
+                               atol=0.25)
+    np.testing.assert_allclose(y, [s[1] + 1 for s in SOURCES[:3]],
+                               atol=0.25)
+    assert len(flux) == 3
+
+
+def test_extract_file(tmp_path):
+    fpath = tmp_path / "M51.fits"
+    fits.PrimaryHDU(_image()).writeto(fpath)
+    out = extract_file(fpath, extract_kw=dict(box=32))
+    assert out == xylist_path(fpath) == tmp_path / "M51.xyls"
+    ref = extract_sources(_image(), box=32)
+    # What solve-field reads: X, Y, FLUX and the image size in ext 1.
+    with fits.open(out) as hdul:
+        table = hdul[1]
+        assert table.columns.names == ["X", "Y", "FLUX"]
+        assert table.header["IMAGEW"] == SHAPE[1]
+        assert table.header["IMAGEH"] == SHAPE[0]
+        for col, arr in zip(["X", "Y", "FLUX"], ref):
+            np.testing.assert_allclose(table.data[col], arr, rtol=1e-6)
+
+    # The data in memory are used instead of the file.
+    out = extract_file(fpath, tmp_path / "other.xyls",
+                       extract_kw=dict(box=32, max_sources=1),
+                       data=_image(sky=1000.))
+    assert len(fits.getdata(out, 1)) == 1
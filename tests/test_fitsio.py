@@ -0,0 +1,164 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+from astropy.io import fits
+from astropy.nddata import CCDData
+
+from snuo1mpy.fitsio import (BLOCK, CARD, LazyImage, read_header,
+                             scan_headers, summary_from_headers, trim_header)
+from snuo1mpy.utils import parse_section
+
+
+def _write(path, header, data=None):
+    fits.PrimaryHDU(data, header=header).writeto(path)
+    return path
+
+
+def test_read_header_continue(tmp_path):
+    hdr = fits.Header()
+    hdr["OBJECT"] = "M51"
+    hdr["LONGSTR"] = "a long string " * 20
+    hdr.add_history("history")
+    path = _write(tmp_path / "long.fits", hdr,
+                  np.zeros((4, 5), dtype=np.uint16))
+    assert b"CONTINUE" in path.read_bytes()[:2*BLOCK]
+    ref = fits.getheader(path)
+    read = read_header(path)
+    assert read["LONGSTR"] == ref["LONGSTR"] == hdr["LONGSTR"]
+    assert list(read.items()) == list(ref.items())
+
+
+def test_read_header_block_boundary(tmp_path):
+    # SIMPLE, BITPIX, NAXIS, NAXIS1, NAXIS2, 30 keys and END: 36 cards,
+    # i.e., END is the last card of the first block.
+    hdr = fits.Header([(f"KEY{i}", i) for i in range(30)])
+    data = np.arange(20, dtype=np.int16).reshape(4, 5)
+    path = _write(tmp_path / "exact.fits", hdr, data)
+    raw = path.read_bytes()
+    assert raw[BLOCK - CARD:BLOCK].rstrip() == b"END"
+    read = read_header(path)
+    assert read == fits.getheader(path)
+    assert read["KEY29"] == 29 and read["NAXIS1"] == 5
+
+    # One more key: END moves to the second block.
+    hdr["KEY30"] = 30
+    path = _write(tmp_path / "next.fits", hdr, data)
+    assert read_header(path)["KEY30"] == 30
+    assert read_header(path) == fits.getheader(path)
+
+
+@pytest.mark.parametrize("nbytes", [0, 100, BLOCK, BLOCK + 1000])
+def test_read_header_truncated(tmp_path, nbytes):
+    hdr = fits.Header([(f"KEY{i}", i) for i in range(40)])
+    raw = _write(tmp_path / "full.fits", hdr).read_bytes()
+    path = tmp_path / "truncated.fits"
+    path.write_bytes(raw[:nbytes])
+    with pytest.raises(OSError, match="END card not found"):
+        read_header(path)
+
+
+def test_scan_headers(night):
+    night.add_default()
+    for n_jobs in [1, 3]:
+        headers = scan_headers(night.paths, n_jobs=n_jobs)
+        assert len(headers) == len(night.paths)
+        for path, hdr in zip(night.paths, headers):
+            assert hdr == fits.getheader(path)
+
+
+def test_summary_from_headers(night, tmp_path):
+    night.add_default()
+    keywords = ["OBJECT", "EXPTIME", "FILTER", "NOTAKEY"]
+    headers = scan_headers(night.paths)
+    summary = summary_from_headers(night.paths, headers, keywords,
+                                   output=tmp_path / "summary.csv")
+    assert list(summary.columns) == ["file", "filesize"] + keywords
+    assert summary["file"].tolist() == sorted(str(p) for p in night.paths)
+    for _, row in summary.iterrows():
+        hdr = fits.getheader(row["file"])
+        assert row["filesize"] == Path(row["file"]).stat().st_size
+        for key in keywords[:-1]:
+            assert row[key] == hdr[key]
+    assert summary["NOTAKEY"].isna().all()
+    assert (tmp_path / "summary.csv").exists()
+
+
+def _scaled(path, bscale, bzero, shape=(12, 16)):
+    # Integers stored as int16 with BSCALE/BZERO, e.g., the raw uint16
+    # frames (BSCALE=1, BZERO=32768).
+    rng = np.random.default_rng(0)
+    data = rng.integers(0, 60000, shape).astype(np.float64)*bscale
+    hdu = fits.PrimaryHDU(data)
+    hdu.scale("int16", bscale=bscale, bzero=bzero)
+    hdu.writeto(path)
+    return path
+
+
+@pytest.mark.parametrize("bscale, bzero", [(1, 32768), (0.1, 3000.)])
+def test_lazy_image_blocks(tmp_path, bscale, bzero):
+    path = _scaled(tmp_path / "scaled.fits", bscale, bzero)
+    ref = CCDData.read(path, unit="adu").data
+    with LazyImage(path) as img:
+        assert (img.bscale, img.bzero) == (bscale, bzero)
+        assert img.raw.dtype == np.dtype(">i2")
+        out = np.empty((5, 16), dtype=np.float32)
+        for rows in [slice(0, 5), slice(5, 10)]:
+            block = img.block(rows, out)
+            assert block is out and block.dtype == np.float32
+            np.testing.assert_allclose(block, ref[rows], rtol=1e-6)
+        np.testing.assert_allclose(img.block(slice(10, 12)), ref[10:],
+                                   rtol=1e-6)
+        np.testing.assert_allclose(img.read(), ref, rtol=1e-6)
+    assert img.raw is None
+
+
+def test_lazy_image_geometry(tmp_path):
+    path = _scaled(tmp_path / "raw.fits", 1, 32768)
+    ref = CCDData.read(path, unit="adu").data
+    # The last 3 columns are the overscan.
+    geometry = dict(shape=(12, 16), trimsec="[2:12,3:10]",
+                    biassec="[14:16,1:12]")
+    with LazyImage(path) as img:
+        img.apply_geometry(geometry)
+        assert img.trim == (slice(2, 10), slice(1, 12))
+        assert img.offset == np.median(ref[:, 13:])
+        assert img.shape == (8, 11)
+        np.testing.assert_allclose(img.read(),
+                                   ref[2:10, 1:12] - img.offset, rtol=1e-6)
+
+    with LazyImage(path) as img:
+        with pytest.raises(ValueError, match="larger than the detector"):
+            img.apply_geometry(dict(shape=(8, 8)))
+
+
+def test_trim_header():
+    hdr = fits.Header()
+    trim_header(hdr)
+    assert len(hdr) == 0
+
+    trim = parse_section("[2:12,3:10]")
+    trim_header(hdr, trim, offset=1002.5)
+    # The pixel (x, y) of the trimmed frame is (x - LTV1, y - LTV2) of the
+    # untrimmed one, as IRAF.
+    assert (hdr["LTV1"], hdr["LTV2"]) == (-1, -2)
+    assert hdr["OVERSCAN"] == 1002.5
+    history = str(hdr["HISTORY"])
+    assert history == "Trimmed to [2:12,3:10]"
+    assert parse_section(history.split()[-1]) == trim
+
+
+def test_read_header_non_ascii(tmp_path):
+    hdr = fits.Header(dict(OBJECT="M51", OBSERVER="Kim"))
+    path = _write(tmp_path / "latin.fits", hdr,
+                  np.zeros((4, 5), dtype=np.uint16))
+    raw = bytearray(path.read_bytes())
+    raw[raw.index(b"M51") + 1] = 0xe9  # e.g., latin-1 from a log
+    raw[raw.index(b"Kim") + 1] = 0xc3
+    path.write_bytes(bytes(raw))
+    with pytest.warns(UserWarning, match="non-ASCII"):
+        read = read_header(path)
+    ref = fits.getheader(path)
+    assert read["OBJECT"] == ref["OBJECT"] == "M?1"
+    assert read["OBSERVER"] == ref["OBSERVER"] == "K?m"
+    assert list(read.items()) == list(ref.items())
@@ -0,0 +1,21 @@
+import subprocess
+import sys
+
+
+def _run(code):
+    return subprocess.run([sys.executable, "-c", code], check=True,
+                          capture_output=True, text=True).stdout.split()
+
+
+def test_import_is_lazy():
+    out = _run("import sys, snuo1mpy; "
+               + "print('snuo1mpy.preprocessor' in sys.modules, "
+               + "'Preprocessor' in dir(snuo1mpy), "
+               + "'Preprocessor' in snuo1mpy.__all__)")
+    assert out == ["False", "True", "True"]
+
+
+def test_star_import():
+    out = _run("from snuo1mpy import *; "
+               + "print(Preprocessor.__name__, KEYMAP['EXPTIME'])")
+    assert out == ["Preprocessor", "EXPTIME"]
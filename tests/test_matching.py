@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from snuo1mpy.matching import MasterIndex, snap_groups
+
+
+def _snap(values, tol=0.01):
+    table = pd.DataFrame({"EXPTIME": values})
+    return snap_groups(table, ["EXPTIME"], {"EXPTIME": tol})["EXPTIME"]
+
+
+def test_snap_groups_bounded():
+    # Each value is within the tolerance of the next, but a group must not
+    # span more than the tolerance.
+    vals = [1.0, 1.009, 1.018, 1.027, 1.036]
+    snapped = _snap(vals)
+    assert snapped.tolist() == [1.0, 1.0, 1.018, 1.018, 1.036]
+    assert np.all(np.abs(snapped - vals) <= 0.01)
+
+
+def test_snap_groups_most_common():
+    assert _snap([30.0, 30.0001, 30.005]).tolist() == [30.0]*3
+    assert _snap([30.0001, 30.0, 30.0001, 30.005]).tolist() == [30.0001]*4
+    # NaN is not snapped, and the order of the rows is kept.
+    snapped = _snap([5., np.nan, 30.005, 30.])
+    assert snapped[[0, 2, 3]].tolist() == [5., 30., 30.]
+    assert np.isnan(snapped[1])
+
+
+def test_snap_groups_matched_by_index():
+    tols = {"EXPTIME": 0.01}
+    table = pd.DataFrame({"OBJECT": "dark",
+                          "EXPTIME": [1.0, 1.009, 1.018, 1.027, 1.036, 5.]})
+    snapped = snap_groups(table, ["EXPTIME"], tols)
+    paths = {("dark", t): f"dark-{t}.fits" for t in snapped["EXPTIME"]}
+    index = MasterIndex(paths, ["dark"], ["EXPTIME"], tolerances=tols,
+                        dates={})
+    # Each frame is matched to the master made from its own group.
+    assert index.match(table) == [("dark", t) for t in snapped["EXPTIME"]]
+
+
+def test_plan_dark_master_names(night):
+    pytest.importorskip("ysfitsutilpy")
+    for exptime in [30.0, 30.0001, 30.005, 30.0001, 60., 1.0, 1.009, 1.018]:
+        night.add("dark", exptime)
+    prep = night.preprocessor()
+    prep.initialize_self()
+    with pytest.warns(UserWarning, match="Bias not available"):
+        darkpaths, jobs = prep._plan_dark(night.topdir / "calib")
+    names = {key: path.name for key, path in darkpaths.items()}
+    assert names == {("dark", 1.0): "dark-1.0.fits",
+                     ("dark", 1.018): "dark-1.018.fits",
+                     ("dark", 30.0001): "dark-30.0001.fits",
+                     ("dark", 60.): "dark-60.0.fits"}
+    # The inputs are the raw frames and the master bias (None here).
+    ninputs = {job["output"].name: len(job["inputs"]) - 1 for job in jobs}
+    assert ninputs == {"dark-1.0.fits": 2, "dark-1.018.fits": 1,
+                       "dark-30.0001.fits": 4, "dark-60.0.fits": 1}
@@ -0,0 +1,85 @@
+import sqlite3
+from contextlib import closing
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+pytest.importorskip("ysfitsutilpy")
+
+from snuo1mpy.nights import MasterLibrary, reduce_nights  # noqa: E402
+
+
+def test_reduce_nights(make_night, tmp_path):
+    night1 = make_night("night1").add_default()
+    night2 = make_night("night2")
+    # No flat in the second night.
+    night2.add("bias", n=3)
+    night2.add("dark", 30., n=3)
+    for filt in ["V", "R"]:
+        night2.add("M51", 30., filt, level=500.)
+    for night in [night1, night2]:
+        night.preprocessor()
+
+    with pytest.warns(UserWarning, match="master library"):
+        library = reduce_nights([night1.topdir, night2.topdir],
+                                tmp_path / "library.sqlite",
+                                organize=False,
+                                preproc_kw=dict(in_place=True))
+    assert isinstance(library, MasterLibrary)
+
+    # The masters of both nights are in the library, with their nights.
+    with closing(sqlite3.connect(str(library.path))) as con:
+        rows = con.execute("SELECT kind, night, exptime, filter FROM "
+                           + "masters ORDER BY kind, night, exptime, "
+                           + "filter").fetchall()
+    n1, n2 = str(night1.topdir), str(night2.topdir)
+    assert [row[:3] for row in rows] == [
+        ("bias", n1, 0.), ("bias", n2, 0.),
+        ("dark", n1, 5.), ("dark", n1, 30.), ("dark", n2, 30.),
+        ("flat", n1, 5.), ("flat", n1, 5.)]
+    assert [row[3] for row in rows[-2:]] == ["R", "V"]
+
+    # The second night uses its own bias and dark and the flats of the
+    # first night, as recorded in the reduced frames.
+    prep2 = night2.preprocessor()
+    reduced = sorted(night2.topdir.glob("M51*.fits"))
+    assert len(reduced) == 2
+    for path in reduced:
+        hdr = fits.getheader(path)
+        filt = hdr["FILTER"]
+        assert hdr["BIASFRM"] == str(night2.topdir / "bias.fits")
+        assert hdr["DARKFRM"] == str(night2.topdir / "dark-30.0.fits")
+        assert hdr["FLATFRM"] == str(night1.topdir / f"skyflat-{filt}.fits")
+        assert hdr["PROCESS"] == "B-D-F"
+        assert library.nearest("flat", hdr, prep2.instrument) \
+            == night1.topdir / f"skyflat-{filt}.fits"
+        # Flat-fielded: the flat pattern of the Night is gone.
+        data = fits.getdata(path)
+        assert np.std(data) < 0.01*np.mean(data)
+
+
+def _master(path, **cards):
+    fits.PrimaryHDU(np.zeros((2, 2), dtype=np.float32),
+                    header=fits.Header(cards)).writeto(path)
+    return path
+
+
+def test_library_nearest(tmp_path):
+    library = MasterLibrary(tmp_path / "library.sqlite", max_days=None)
+    frame = {"DATE-OBS": "2018-04-12T10:30:00", "EXPTIME": 30.,
+             "CCD-TEMP": -25.}
+    # Within the EXPTIME tolerance of matching.TOLERANCES (0.01 s).
+    near = _master(tmp_path / "near.fits", EXPTIME=30.005,
+                   **{"DATE-OBS": "2018-04-01T10:00:00"})
+    far = _master(tmp_path / "far.fits", EXPTIME=30.05,
+                  **{"DATE-OBS": "2018-04-12T10:00:00"})
+    library.add("dark", [near, far], "STX16803")
+    assert library.nearest("dark", frame, "STX16803") == near
+
+    # An undated master is used only if no dated one matches.
+    undated = _master(tmp_path / "undated.fits", EXPTIME=30.)
+    library.add("dark", [undated], "STX16803")
+    assert library.nearest("dark", frame, "STX16803") == near
+    near.unlink()
+    assert library.nearest("dark", frame, "STX16803") == undated
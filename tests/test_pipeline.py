@@ -0,0 +1,394 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+pytest.importorskip("ysfitsutilpy")
+
+
+def _names(timings):
+    return sorted(t["name"].split(":")[0] for t in timings
+                  if ":" in t["name"])
+
+
+def test_run_resume_skips_fresh(night):
+    night.add_default()
+    timings = night.preprocessor().run(organize=False, verbose=False)
+    # 1 bias, 2 darks, 2 flats and 4 object frames
+    assert _names(timings) == ["bias"] + ["dark"]*2 + ["flat"]*2 \
+        + ["preproc"]*4
+
+    timings = night.preprocessor().run(organize=False, resume=True,
+                                       verbose=False)
+    assert _names(timings) == []
+
+
+def test_run_resume_remakes_downstream(night):
+    night.add_default()
+    prep = night.preprocessor()
+    prep.run(organize=False, verbose=False)
+    darks = {p: fits.getdata(p) for p in prep.darkpaths.values()}
+    # The bias cancels out in the reduced data, (obj - B) - (dark - B).
+    reduced = {p: p.stat().st_mtime_ns for p in prep.reducedpaths}
+
+    # A new bias: the master bias and everything made from it are stale.
+    night.add("bias", n=1)
+    prep = night.preprocessor()
+    timings = prep.run(organize=False, resume=True, verbose=False)
+    assert _names(timings) == ["bias"] + ["dark"]*2 + ["flat"]*2 \
+        + ["preproc"]*4
+    for path, data in darks.items():
+        assert not np.array_equal(fits.getdata(path), data)
+    for path, mtime in reduced.items():
+        assert path.stat().st_mtime_ns > mtime
+
+    # ... and all of them are recorded as fresh.
+    timings = night.preprocessor().run(organize=False, resume=True,
+                                       verbose=False)
+    assert _names(timings) == []
+
+
+def test_run_resume_remakes_only_dependents(night):
+    night.add_default()
+    night.preprocessor().run(organize=False, verbose=False)
+
+    # A new V flat: only the V flat and the V object frames are stale.
+    night.add("skyflat", 5., "V", n=1, level=20000.)
+    timings = night.preprocessor().run(organize=False, resume=True,
+                                       verbose=False)
+    names = sorted(t["name"] for t in timings if ":" in t["name"])
+    assert len(names) == 3
+    assert names[0].startswith("flat:") and names[0].endswith("-V.fits")
+    assert all(name.startswith("preproc:") and "-V-" in name
+               for name in names[1:])
+
+
+def test_in_place_provenance(night):
+    night.add_default()
+    prep = night.preprocessor()
+    prep.run(organize=False, verbose=False,
+             preproc_kw=dict(in_place=True))
+    hdr = fits.getheader(prep.reducedpaths[0])
+    data = [fits.getdata(path) for path in prep.reducedpaths]
+    prep.do_preproc(savedir=night.topdir / "bdf", in_place=False,
+                    verbose_bdf=False)
+    ref = fits.getheader(prep.reducedpaths[0])
+    # The same pixels, up to the float32 rounding (a few ULP).
+    for arr, path in zip(data, prep.reducedpaths):
+        np.testing.assert_allclose(arr, fits.getdata(path), rtol=2e-7,
+                                   atol=3e-5)
+    assert hdr["OBJECT"] == ref["OBJECT"] == "M51"
+    # The same keys as bdf_process writes (the masters are given to it as
+    # CCDData, so their paths are not known).
+    for key in ["CCDPROCV", "FLATNORM", "SUBTRACT_BIAS", "SUBBIAS",
+                "SUBTRACT_DARK", "SUBDARK", "FLAT_CORRECT", "FLATCOR"]:
+        assert hdr[key] == ref[key]
+    assert hdr["PROCESS"] == ref["PROCESS"] == "B-D-F"
+    for kind in ["BIAS", "DARK", "FLAT"]:
+        assert Path(hdr[f"{kind}FRM"]).exists() and f"{kind}FRM" in ref
+    assert [h for h in ref["HISTORY"] if not h.startswith(".")] \
+        == list(hdr["HISTORY"])
+
+
+@pytest.mark.parametrize("kinds", [("bias", "dark", "flat"),
+                                   ("bias", "flat"), ("dark",)])
+def test_add_process_matches_bdf_process(night, kinds):
+    import ysfitsutilpy as yfu
+    from astropy.nddata import CCDData
+    from snuo1mpy.preprocessor import _add_process
+    fpath = night.add("M51", 30., level=500.)[0]
+    masters = {}
+    for kind, value in [("bias", 1000.), ("dark", 1.5), ("flat", 0.9)]:
+        path = None
+        if kind in kinds:
+            path = night.topdir / f"{kind}.fits"
+            fits.PrimaryHDU(np.full(night.shape, value, dtype=np.float32),
+                            header=night.headers[-1]).writeto(path)
+        masters[kind] = path
+
+    ccd = CCDData.read(fpath, unit="adu")
+    ref = yfu.bdf_process(ccd, output=None, unit=None,
+                          mbiaspath=masters["bias"],
+                          mdarkpath=masters["dark"],
+                          mflatpath=masters["flat"],
+                          verbose_bdf=False).header
+    hdr = ccd.header.copy()
+    _add_process(hdr, masters)
+
+    def _cards(header):
+        return [key for key in header
+                if key not in ["HISTORY", "COMMENT", "FITS-TLM"]]
+
+    # The same cards in the same order, and the same values but the paths
+    # of the masters (not known to bdf_process as it reads them itself).
+    assert _cards(hdr) == _cards(ref)
+    for key in _cards(ref):
+        if key.endswith("FRM"):
+            assert hdr[key] == str(masters[key[:-3].lower()])
+        else:
+            assert hdr[key] == ref[key], key
+    assert list(hdr["HISTORY"]) \
+        == [h for h in ref["HISTORY"] if not h.startswith(".")]
+
+
+def test_in_place_ignored_with_crrej(night):
+    night.add_default()
+    prep = night.preprocessor()
+    prep.run(organize=False, verbose=False)
+    with pytest.warns(UserWarning, match="in_place is ignored"):
+        _, jobs = prep._plan_preproc(night.topdir, do_crrej=True,
+                                     crrej_kwargs={}, in_place=True)
+    assert not any(job["params"]["in_place"] for job in jobs)
+
+
+@pytest.mark.parametrize("in_place", [True, False])
+def test_do_preproc_n_jobs(make_night, in_place):
+    results = []
+    for n_jobs in [1, 2]:
+        night = make_night(f"jobs{n_jobs}").add_default()
+        prep = night.preprocessor()
+        prep.run(organize=False, verbose=False,
+                 preproc_kw=dict(in_place=in_place))
+        prep.do_preproc(n_jobs=n_jobs, in_place=in_place,
+                        verbose_bdf=False)
+        results.append(prep)
+    serial, pool = results
+    assert ([Path(p).name for p in serial.reducedpaths]
+            == [Path(p).name for p in pool.reducedpaths])
+    for spath, ppath in zip(serial.reducedpaths, pool.reducedpaths):
+        shdr, phdr = fits.getheader(spath), fits.getheader(ppath)
+        assert np.array_equal(fits.getdata(spath), fits.getdata(ppath))
+        assert list(shdr.keys()) == list(phdr.keys())
+        assert shdr["PROCESS"] == phdr["PROCESS"]
+    cols = [c for c in serial.summary_red.columns if c != "file"]
+    assert serial.summary_red[cols].equals(pool.summary_red[cols])
+
+
+@pytest.mark.parametrize("memory_limit", [None, 2**20])
+def test_make_masters_n_jobs(make_night, monkeypatch, memory_limit):
+    from snuo1mpy import preprocessor
+    run_jobs = preprocessor.run_jobs
+    limits = []
+
+    def _run_jobs(func, tasks, **kwargs):
+        tasks = list(tasks)
+        # The memory_limit given to each group (see _run_master_jobs).
+        limits.append([task[-2] for task in tasks])
+        return run_jobs(func, tasks, **kwargs)
+
+    monkeypatch.setattr(preprocessor, "run_jobs", _run_jobs)
+
+    masters = {}
+    for n_jobs in [1, 2]:
+        night = make_night(f"jobs{n_jobs}").add_default()
+        prep = night.preprocessor()
+        limits.clear()
+        for kind in ["bias", "dark", "flat"]:
+            getattr(prep, f"make_{kind}")(memory_limit=memory_limit,
+                                          n_jobs=n_jobs)
+        # 1 bias, 2 darks and 2 flats: the groups combined at the same
+        # time share the memory_limit.
+        ngroups = [1, 2, 2]
+        if memory_limit is None:
+            assert limits == [[None]*ngroup for ngroup in ngroups]
+        else:
+            assert limits == [[memory_limit // min(n_jobs, ngroup)]*ngroup
+                              for ngroup in ngroups]
+        masters[n_jobs] = {
+            Path(p).name: fits.getdata(p)
+            for kind in ["bias", "dark", "flat"]
+            for p in getattr(prep, f"{kind}paths").values()}
+
+    assert sorted(masters[1]) == sorted(masters[2])
+    for name, data in masters[1].items():
+        assert np.array_equal(data, masters[2][name]), name
+
+
+def test_run_stage_kwargs(night):
+    night.add_default()
+    prep = night.preprocessor()
+    timings = prep.run(organize=False, verbose=False,
+                       bias_kw=dict(delimiter="_", dtype="float32"),
+                       dark_kw=dict(savedir=night.topdir / "calib",
+                                    delimiter="_"),
+                       flat_kw=dict(savedir=night.topdir / "calib",
+                                    save_bd=False),
+                       preproc_kw=dict(savedir=night.topdir / "reduced",
+                                       delimiter="-", in_place=False,
+                                       verbose_bdf=False,
+                                       verbose_summary=False))
+    assert _names(timings) == ["bias"] + ["dark"]*2 + ["flat"]*2 \
+        + ["preproc"]*4
+    assert prep.biaspaths[("bias",)].name == "bias.fits"
+    assert prep.darkpaths[("dark", 30.)] == night.topdir / "calib" \
+        / "dark_30.0.fits"
+    assert all(Path(p).parent == night.topdir / "reduced"
+               for p in prep.reducedpaths)
+
+
+def test_run_savedir_none(night):
+    night.add_default()
+    prep = night.preprocessor()
+    # None is the default (topdir), as for the stage methods.
+    prep.run(organize=False, verbose=False,
+             bias_kw=dict(savedir=None), preproc_kw=dict(savedir=None))
+    assert prep.biaspaths[("bias",)] == night.topdir / "bias.fits"
+    assert all(Path(p).parent == night.topdir for p in prep.reducedpaths)
+
+
+@pytest.mark.parametrize("kwargs, match", [
+    (dict(bias_kw=dict(resume=True)), "give it to run"),
+    (dict(dark_kw=dict(memory_limit=2**20)), "give it to run"),
+    (dict(preproc_kw=dict(n_jobs=2)), "give it to run"),
+    (dict(organize_kw=dict(resume=True)), "give it to run"),
+    (dict(flat_kw=dict(in_place=True)), "not the arguments of make_flat"),
+])
+def test_run_stage_kwargs_invalid(night, kwargs, match):
+    night.add_default()
+    prep = night.preprocessor()
+    with pytest.raises(TypeError, match=match):
+        prep.run(organize=False, verbose=False, **kwargs)
+    # Nothing is done.
+    assert not list(night.topdir.glob("*.fits"))
+
+
+def test_do_preproc_clears_cache(night):
+    from snuo1mpy import preprocessor
+    night.add_default()
+    prep = night.preprocessor()
+    prep.run(organize=False, verbose=False)
+    assert len(preprocessor._CACHE) == 0
+    # ... also if it is made with a cap and reused with a lower one.
+    cache = preprocessor._master_cache(2**30)
+    cache.get_array("bias", None, next(iter(prep.biaspaths.values())))
+    assert preprocessor._master_cache(0) is cache and len(cache) == 1
+    prep.do_preproc(in_place=True, cache_limit=0)
+    assert len(cache) == 0
+
+
+def test_in_place_reads_dark_header_once(night, monkeypatch):
+    from snuo1mpy import calib
+    night.add_default()
+    prep = night.preprocessor(dark_scalable=True,
+                              dark_rate_group_key=["SET-TEMP"])
+    prep.run(organize=False, verbose=False)
+    read_header = calib.read_header
+    read = []
+
+    def _read_header(path):
+        read.append(path)
+        return read_header(path)
+
+    monkeypatch.setattr(calib, "read_header", _read_header)
+    prep.do_preproc(in_place=True, verbose_bdf=False)
+    # One dark (rate) for the 4 frames.
+    assert read == [prep.darkpaths[("dark", -25.)]]
+
+
+@pytest.mark.parametrize("memory_limit", [None, 2**20])
+def test_dark_scalable(make_night, memory_limit):
+    reduced = {}
+    for scalable in [False, True]:
+        night = make_night(f"scalable{scalable}").add_default()
+        prep = night.preprocessor(dark_scalable=scalable,
+                                  dark_rate_group_key=["SET-TEMP"])
+        prep.run(organize=False, memory_limit=memory_limit, verbose=False,
+                 preproc_kw=dict(in_place=True))
+        reduced[scalable] = [fits.getdata(p) for p in prep.reducedpaths]
+
+    # One rate master (per 1 s) instead of those of 5 and 30 s.
+    assert list(prep.darkpaths) == [("dark", -25.)]
+    data, mhdr = fits.getdata(prep.darkpaths[("dark", -25.)], header=True)
+    assert mhdr["DARKRATE"] and mhdr["EXPTIME"] == 1.
+    # The dark current of the Night is 0.05 ADU/s.
+    assert np.median(data) == pytest.approx(0.05, abs=0.02)
+    hdr = fits.getheader(prep.reducedpaths[0])
+    assert hdr["DARKFRM"] == str(prep.darkpaths[("dark", -25.)])
+    assert "Dark scaling using EXPTIME" in str(hdr["HISTORY"])
+
+    # The same within the noise (3 ADU of each dark): the rates of the
+    # 5-s darks, scaled to 30 s, are the noisiest.
+    for ref, arr in zip(reduced[False], reduced[True]):
+        diff = arr - ref
+        assert abs(np.mean(diff)) < 0.5
+        assert np.std(diff) < 6
+        assert np.max(np.abs(diff)) < 30
+
+
+@pytest.mark.parametrize("memory_limit", [None, 2**20])
+def test_make_flat_in_memory(night, memory_limit):
+    import ysfitsutilpy as yfu
+    from snuo1mpy.utils import MEDCOMB_KEYS
+    night.add_default()
+    prep = night.preprocessor()
+    prep.make_bias()
+    prep.make_dark()
+    prep.make_flat(memory_limit=memory_limit)
+    # Nothing but the masters is written.
+    assert not list(night.framedir.glob("*_BD.fits"))
+
+    # The old way: each flat saved as int16 _BD.fits and read back.
+    biaspath = prep.biaspaths[("bias",)]
+    darkpath = prep.darkpaths[("dark", 5.)]
+    fpaths = [p for p in night.paths if p.name.startswith("skyflat")
+              and "-V-" in p.name]
+    bdpaths = []
+    for fpath in fpaths:
+        bdpath = night.topdir / f"old_{fpath.stem}_BD.fits"
+        yfu.bdf_process(yfu.load_ccd(fpath, unit='adu'), output=bdpath,
+                        mbiaspath=biaspath, mdarkpath=darkpath,
+                        dtype="int16", overwrite=True, unit=None)
+        bdpaths.append(bdpath)
+    ref = yfu.combine_ccd(bdpaths, output=None, **MEDCOMB_KEYS,
+                          normalize_average=True, verbose=False)
+    # Up to the int16 truncation of the old _BD.fits (1 ADU of ~20000).
+    np.testing.assert_allclose(fits.getdata(prep.flatpaths[("skyflat",
+                                                            "V")]),
+                               ref.data, rtol=1e-4)
+
+    prep.make_flat(memory_limit=memory_limit, save_bd=True)
+    bdpaths = sorted(night.framedir.glob("*_BD.fits"))
+    assert [p.name for p in bdpaths] == sorted(
+        p.stem + "_BD.fits" for p in night.paths
+        if p.name.startswith("skyflat"))
+    for fpath in fpaths:
+        new = fits.getdata(night.framedir / f"{fpath.stem}_BD.fits")
+        old = fits.getdata(night.topdir / f"old_{fpath.stem}_BD.fits")
+        assert new.dtype.kind == "f"
+        np.testing.assert_allclose(new, old, atol=1)
+
+
+@pytest.mark.parametrize("n_jobs", [1, 2])
+def test_run_resume_after_failure(night, n_jobs):
+    night.add_default()
+    # The last object frame is broken, so that the others are reduced
+    # before it fails (in the serial run).
+    broken = night.paths[-1]
+    raw = broken.read_bytes()
+    broken.write_bytes(b"not a FITS file")
+    with pytest.raises(Exception):
+        night.preprocessor().run(organize=False, n_jobs=n_jobs,
+                                 verbose=False)
+
+    # All the masters and the frames reduced before the failure (all but
+    # the broken one in the serial run; those finished or running when it
+    # failed with a pool) are recorded.
+    prep = night.preprocessor()
+    assert len(prep.manifest.keys("bias:")) == 1
+    assert len(prep.manifest.keys("dark:")) == 2
+    assert len(prep.manifest.keys("flat:")) == 2
+    frames = {f"preproc:{night.topdir / p.name}" for p in night.paths
+              if p.name.startswith("M51")}
+    done = set(prep.manifest.keys("preproc:"))
+    rerun = frames - done
+    assert f"preproc:{night.topdir / broken.name}" in rerun
+    if n_jobs == 1:
+        assert rerun == {f"preproc:{night.topdir / broken.name}"}
+
+    broken.write_bytes(raw)
+    timings = prep.run(organize=False, n_jobs=n_jobs, resume=True,
+                       verbose=False)
+    # Exactly the frames not recorded are reduced: no master, no frame
+    # reduced before the failure.
+    assert {t["name"] for t in timings if ":" in t["name"]} == rerun
@@ -0,0 +1,56 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from snuo1mpy.summary import SUMMARY_FORMATS, read_summary, write_summary
+from snuo1mpy.utils import SUMMARY_SCHEMA, USEFUL_KEYS
+
+
+def _table():
+    # As read from headers: an OBJECT like a number, a FILTER missing in
+    # all rows and EXPTIME as text.
+    return pd.DataFrame({"file": ["a.fits", "b.fits"],
+                         "filesize": [2880, 5760],
+                         "OBJECT": [1, "M51"],
+                         "FILTER": [None, None],
+                         "EXPTIME": ["30", "5.5"],
+                         "XBINNING": [1, None],
+                         "OBJCTALT": ["65.1234", None]})
+
+
+def _check(table):
+    assert table["EXPTIME"].dtype == np.float64
+    assert table["EXPTIME"].tolist() == [30., 5.5]
+    assert table["FILTER"].dtype == object
+    assert table["FILTER"].isna().all()
+    assert table["OBJECT"].tolist() == ["1", "M51"]
+    assert str(table["XBINNING"].dtype) == "Int64"
+    assert table["OBJCTALT"].dtype == np.float64
+
+
+def test_schema_of_useful_keys():
+    assert set(USEFUL_KEYS) < set(SUMMARY_SCHEMA)
+    assert SUMMARY_SCHEMA["EXPTIME"] == "float64"
+    assert SUMMARY_SCHEMA["FILTER"] == "str"
+
+
+@pytest.mark.parametrize("fmt", list(SUMMARY_FORMATS))
+def test_summary_round_trip(tmp_path, fmt):
+    if fmt != "csv":
+        pytest.importorskip("pyarrow")
+    path = tmp_path / f"summary{SUMMARY_FORMATS[fmt]}"
+    written = write_summary(_table(), path)
+    _check(written)
+    read = read_summary(path)
+    _check(read)
+    pd.testing.assert_frame_equal(read, written)
+
+
+@pytest.mark.parametrize("fmt", ["parquet", "feather"])
+def test_read_summary_casts_columnar(tmp_path, fmt):
+    pytest.importorskip("pyarrow")
+    # Written by another tool, with the dtypes of its own.
+    table = _table().astype({"OBJECT": str, "XBINNING": float})
+    path = tmp_path / f"summary{SUMMARY_FORMATS[fmt]}"
+    getattr(table, f"to_{fmt}")(path)
+    _check(read_summary(path))
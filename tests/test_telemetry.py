@@ -0,0 +1,117 @@
+import json
+import pstats
+
+import pytest
+
+from snuo1mpy.telemetry import JSONLinesSink, Recorder, Telemetry, file_size
+
+
+def test_recorder():
+    rec = Recorder(frame="a.fits")
+    with rec.span("read", bytes_read=10) as span:
+        span["bytes_written"] = 5
+    with pytest.raises(RuntimeError):
+        with rec.span("write"):
+            raise RuntimeError
+    assert [r["step"] for r in rec.records] == ["read", "write"]
+    first = rec.records[0]
+    assert first["frame"] == "a.fits"
+    assert first["bytes_read"] == 10 and first["bytes_written"] == 5
+    assert first["duration"] >= 0 and "pid" in first and "start" in first
+
+    off = Recorder(False, frame="a.fits")
+    with off.span("read") as span:
+        span["bytes_read"] = 10
+    assert off.records == []
+
+
+def test_file_size(tmp_path):
+    path = tmp_path / "a.bin"
+    path.write_bytes(b"x"*123)
+    assert file_size(path) == 123
+    assert file_size(tmp_path / "none.bin") is None
+    assert file_size(None) is None
+
+
+def test_telemetry_sinks(tmp_path):
+    got = []
+    tel = Telemetry(sinks=[tmp_path / "log.jsonl", got.append])
+    with tel.span("header read", nframe=2):
+        pass
+    tel.emit([dict(step="read", frame="a", duration=1., bytes_read=10),
+              dict(step="read", frame="b", duration=2., bytes_read=None),
+              dict(step="write", frame="a", duration=.5,
+                   bytes_written=7)])
+    assert len(tel.records) == len(got) == 4
+    lines = (tmp_path / "log.jsonl").read_text().splitlines()
+    assert [json.loads(line) for line in lines[1:]] == got[1:]
+    assert json.loads(lines[0])["nframe"] == 2
+
+    totals = tel.totals()
+    assert totals["read"] == dict(count=2, duration=3., bytes_read=10,
+                                  bytes_written=0)
+    assert totals["write"]["bytes_written"] == 7
+    assert set(tel.totals(by="frame")) == {"a", "b"}
+
+    sink = JSONLinesSink(tmp_path / "log.jsonl")
+    sink(dict(step="x", path=tmp_path))  # not JSON serializable as is
+    assert json.loads((tmp_path / "log.jsonl").read_text()
+                      .splitlines()[-1])["path"] == str(tmp_path)
+
+    off = Telemetry(sinks=[got.append], enabled=False)
+    with off.session("bias"):
+        with off.span("combine"):
+            pass
+    off.emit([dict(step="read")])
+    assert off.records == [] and len(got) == 4
+
+
+def test_telemetry_session(tmp_path):
+    tel = Telemetry(profile_dir=tmp_path / "prof", trace_memory=True)
+    with tel.session("preproc"):
+        data = [bytearray(2**20)]
+        with tel.session("extract"):
+            pass
+        del data
+    stages = {r["step"]: r for r in tel.records if r.get("kind") == "stage"}
+    assert set(stages) == {"preproc", "extract"}
+    assert stages["preproc"]["mem_peak"] >= 2**20
+    # The inner stage is only timed.
+    assert "mem_peak" not in stages["extract"]
+    assert [p.name for p in (tmp_path / "prof").iterdir()] \
+        == ["preproc.prof"]
+    pstats.Stats(str(tmp_path / "prof" / "preproc.prof"))
+    assert tel.totals() == {}
+
+
+@pytest.mark.parametrize("in_place, do_crrej", [(True, False),
+                                                (False, False),
+                                                (False, True)])
+def test_preproc_frame_spans(night, in_place, do_crrej):
+    pytest.importorskip("ysfitsutilpy")
+    night.add_default()
+    tel = Telemetry()
+    prep = night.preprocessor(telemetry=tel)
+    prep.make_bias()
+    prep.make_dark()
+    prep.make_flat()
+    prep.objpaths = prep.objpaths[:1]
+    tel.records.clear()
+    prep.do_preproc(in_place=in_place, do_crrej=do_crrej,
+                    crrej_kwargs=dict(sigclip=10.), verbose_bdf=False)
+
+    fpath = str(prep.objpaths[0])
+    records = [r for r in tel.records if r.get("frame") == fpath]
+    steps = ["master", "read", "calibrate", "write"]
+    if do_crrej:
+        steps.insert(3, "crrej")
+    assert [r["step"] for r in records] == steps
+    records = {r["step"]: r for r in records}
+    # The first frame is of V and 30 s; the masters are read once.
+    masters = [prep.biaspaths[("bias",)], prep.darkpaths[("dark", 30.)],
+               prep.flatpaths[("skyflat", "V")]]
+    assert records["master"]["bytes_read"] == sum(map(file_size, masters))
+    assert records["read"]["bytes_read"] == file_size(fpath)
+    assert records["write"]["bytes_written"] \
+        == file_size(prep.reducedpaths[0])
+    assert all(r["duration"] >= 0 for r in records.values())
@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+
+from snuo1mpy.utils import _binned, frame_sections, parse_section
+
+
+def test_parse_section():
+    ysl, xsl = parse_section(" [11:4086,1:4096] ")
+    assert (ysl, xsl) == (slice(0, 4096), slice(10, 4086))
+
+    # 1-indexed and inclusive, x first: [2:4,3:3] is x = 2..4 at y = 3.
+    data = np.arange(5*6).reshape(5, 6)
+    ysl, xsl = parse_section("[2:4,3:3]")
+    np.testing.assert_array_equal(data[ysl, xsl], [[13, 14, 15]])
+
+    for bad in ["[1:4096]", "[a:2,1:3]", "1,2"]:
+        with pytest.raises(ValueError, match="Invalid section"):
+            parse_section(bad)
+
+
+def test_binned():
+    # Unbinned 1..20 (slice(0, 20)) binned by 2: binned pixels 0..9.
+    assert _binned(slice(0, 20), 2, 0, 100) == slice(0, 10)
+    # A binned pixel only partly inside is excluded, at both ends.
+    assert _binned(slice(1, 19), 2, 0, 100) == slice(1, 9)
+    # Relative to the origin of the subframe, and clipped to it.
+    assert _binned(slice(0, 20), 2, 3, 4) == slice(0, 4)
+    assert _binned(slice(10, 20), 2, 3, 100) == slice(2, 7)
+    assert _binned(slice(0, 4), 2, 3, 100) is None
+
+
+def _header(nx, ny, xbin=1, ybin=1, xorg=0, yorg=0):
+    return dict(NAXIS1=nx, NAXIS2=ny, XBINNING=xbin, YBINNING=ybin,
+                XORGSUBF=xorg, YORGSUBF=yorg)
+
+
+def test_frame_sections():
+    geometry = dict(shape=(12, 16), trimsec="[2:12,3:10]",
+                    biassec="[14:16,1:12]")
+    trim, bias = frame_sections(_header(16, 12), geometry)
+    assert trim == (slice(2, 10), slice(1, 12))
+    assert bias == (slice(0, 12), slice(13, 16))
+    # Missing sections are None.
+    assert frame_sections(_header(16, 12), dict(shape=(12, 16))) \
+        == (None, None)
+
+
+def test_frame_sections_binned():
+    geometry = dict(shape=(24, 32), trimsec="[2:24,5:20]",
+                    biassec="[29:32,1:24]")
+    trim, bias = frame_sections(_header(16, 12, 2, 2), geometry)
+    # x 2..24 is binned 1..11 (0-indexed, the half-covered 0 excluded).
+    assert trim == (slice(2, 10), slice(1, 12))
+    assert bias == (slice(0, 12), slice(14, 16))
+
+    # A subframe (origin in binned pixels) without the overscan.
+    trim, bias = frame_sections(_header(8, 6, 2, 2, xorg=4, yorg=3),
+                                geometry)
+    assert trim == (slice(0, 6), slice(0, 8))
+    assert bias is None
+
+    with pytest.raises(ValueError, match="larger than the detector"):
+        frame_sections(_header(16, 12, 1, 1), dict(geometry, shape=(8, 8)))
+    with pytest.raises(ValueError, match="TRIMSEC does not overlap"):
+        frame_sections(_header(4, 4, 2, 2, xorg=12, yorg=0), geometry)
+
+
+def test_ccdproc_version_py37(monkeypatch):
+    import builtins
+    from snuo1mpy.utils import ccdproc_version
+    ccdproc = pytest.importorskip("ccdproc")
+    real_import = builtins.__import__
+
+    def _import(name, *args, **kwargs):
+        # As Python 3.7, without importlib.metadata.
+        if name == "importlib.metadata":
+            raise ModuleNotFoundError(name)
+        return real_import(name, *args, **kwargs)
+
+    ccdproc_version.cache_clear()
+    monkeypatch.setattr(builtins, "__import__", _import)
+    try:
+        assert ccdproc_version() == ccdproc.__version__
+    finally:
+        ccdproc_version.cache_clear()